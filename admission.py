@@ -0,0 +1,126 @@
+"""姿勢推定の混雑に応じた品質レベルの選択（アドミッション制御）
+
+推定中・待機中のリクエスト数と最近の推論時間から、このリクエストの完了までにかかる時間を見積もり、
+レイテンシの予算に収まる最も高い品質レベルを選ぶ。どのレベルでも収まらなければ推論せず、
+デフォルトの関節点を返す（呼び出し側で degraded として扱う）。ただし空いているワーカーがあれば
+最も軽いレベルで推論し、見積もりが実際の推論時間で更新されるようにする（1回の遅い推論で
+見積もりが膨らんだまま、推論を省略し続けないため）。
+姿勢推定プールはgunicornワーカーごとにあるため、集計もプロセスごとに行う。
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+# 品質レベル（上から順に高品質）。cost は full に対する推論時間の比の初期値
+DEFAULT_LEVELS = (
+    {'name': 'full', 'model_complexity': 1, 'input_size': 512, 'refine': True, 'cost': 1.0},
+    {'name': 'reduced', 'model_complexity': 1, 'input_size': 384, 'refine': False, 'cost': 0.8},
+    {'name': 'lite', 'model_complexity': 0, 'input_size': 256, 'refine': False, 'cost': 0.35},
+)
+
+# 推論せずにデフォルトの関節点を返すときのレベル
+DEFAULT_JOINTS_LEVEL = {'name': 'default', 'model_complexity': None, 'input_size': None, 'refine': False, 'cost': 0.0}
+
+
+class AdmissionController:
+    """推論の混雑度から品質レベルを決める
+
+    推論時間は full 相当に換算した指数移動平均で持ち、各レベルの見積もりはそれに cost を掛けて求める。
+    待たずに推論できたリクエストの時間だけを記録し、待ち時間で見積もりが膨らみ続けないようにする。
+    """
+
+    def __init__(self, levels=DEFAULT_LEVELS, workers=1, budget=3.0, initial_latency=0.3, smoothing=0.2):
+        self.levels = [dict(level) for level in levels]
+        self.workers = max(1, workers)
+        self.budget = budget
+        self.smoothing = smoothing
+        self._latency = initial_latency
+        self._samples = 0
+        self._in_flight = 0
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def estimate(self, level, in_flight):
+        """in_flight 件が推定中・待機中のときに、このリクエストが level で完了するまでの見積もり（秒）"""
+        waiting = max(0, in_flight + 1 - self.workers)
+        return self._latency * level['cost'] * (1 + waiting / self.workers)
+
+    def _choose(self, in_flight):
+        for level in self.levels:
+            if self.estimate(level, in_flight) <= self.budget:
+                return level
+        if in_flight < self.workers:
+            return self.levels[-1]
+        return DEFAULT_JOINTS_LEVEL
+
+    @contextmanager
+    def admit(self, adaptive=True, weight=1):
+        """品質レベルを選んでリクエストを受け付ける（with ブロックの間は推定中として数える）
+
+        adaptive=False（非同期ジョブ・一括分析）は常に最高品質で推定するが、混雑度には数える。
+        weight は1リクエストで行う推論の回数で、その数だけ推定中として数える。
+        yield する Admission の level が DEFAULT_JOINTS_LEVEL なら推論しない。
+        """
+        with self._lock:
+            level = self._choose(self._in_flight) if adaptive else self.levels[0]
+            admission = Admission(self, level, queued=self._in_flight >= self.workers)
+            self._counts[level['name']] = self._counts.get(level['name'], 0) + 1
+            if level is not DEFAULT_JOINTS_LEVEL:
+                self._in_flight += weight
+        try:
+            yield admission
+        finally:
+            if level is not DEFAULT_JOINTS_LEVEL:
+                with self._lock:
+                    self._in_flight -= weight
+
+    def record(self, level, seconds):
+        """待たずに推論できたときの推論時間を記録する"""
+        if not level['cost']:
+            return
+        with self._lock:
+            normalized = seconds / level['cost']
+            if self._samples == 0:
+                self._latency = normalized
+            else:
+                self._latency += self.smoothing * (normalized - self._latency)
+            self._samples += 1
+
+    def status(self):
+        """ヘルスチェック用の状態（今リクエストが来たときに選ばれるレベルを含む）"""
+        with self._lock:
+            return {
+                'level': self._choose(self._in_flight)['name'],
+                'in_flight': self._in_flight,
+                'workers': self.workers,
+                'budget_seconds': self.budget,
+                'latency_seconds': {level['name']: round(self._latency * level['cost'], 4) for level in self.levels},
+                'latency_samples': self._samples,
+                'admitted': dict(self._counts)
+            }
+
+
+class Admission:
+    """受け付けたリクエストの品質レベルと残りの予算"""
+
+    def __init__(self, controller, level, queued):
+        self.controller = controller
+        self.level = level
+        self.queued = queued
+        self.started = time.monotonic()
+
+    @property
+    def degraded(self):
+        return self.level is not self.controller.levels[0]
+
+    def remaining(self):
+        """レイテンシの予算の残り（秒）"""
+        return self.controller.budget - (time.monotonic() - self.started)
+
+    def wait_budget(self):
+        """空きワーカーを待てる時間（予算の残りから推論時間の見積もりを引いたもの）"""
+        return max(0.0, self.remaining() - self.controller.estimate(self.level, 0))
+
+    def record(self, seconds):
+        if not self.queued:
+            self.controller.record(self.level, seconds)
@@ -0,0 +1,123 @@
+"""分析結果の保存（チーム共有URL用）
+
+分析結果は組み込みSQLite（WALモード）に保存する。保存後は変更されないため、
+共有URLは主キーでの1回の検索で表示でき、HTTPキャッシュも永続的に効かせられる。
+"""
+import os
+import json
+import time
+import secrets
+import sqlite3
+import threading
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+    id TEXT PRIMARY KEY,
+    athlete TEXT,
+    team TEXT,
+    analysis_type TEXT NOT NULL,
+    image_hash TEXT,
+    image_url TEXT,
+    keypoints TEXT NOT NULL,
+    angles TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_analyses_athlete_created ON analyses (athlete, created_at);
+CREATE INDEX IF NOT EXISTS idx_analyses_team_created ON analyses (team, created_at);
+CREATE INDEX IF NOT EXISTS idx_analyses_created ON analyses (created_at);
+CREATE INDEX IF NOT EXISTS idx_analyses_image_hash ON analyses (image_hash);
+"""
+
+# SQL文は固定文字列にしてパラメータで値を渡す（sqlite3の接続ごとのステートメントキャッシュで再利用される）
+_INSERT = (
+    "INSERT INTO analyses (id, athlete, team, analysis_type, image_hash, image_url, keypoints, angles, created_at) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+_SELECT_BY_ID = "SELECT * FROM analyses WHERE id = ?"
+_SELECT_IDS_BY_IMAGE = "SELECT id FROM analyses WHERE image_hash = ?"
+_COLUMNS = "id, athlete, team, analysis_type, image_hash, image_url, created_at"
+
+
+class AnalysisStore:
+    """分析結果のSQLiteストア"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connect().executescript(_SCHEMA)
+
+    def _connect(self):
+        # フォーク前に作った接続は子プロセスで使わない
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, cached_statements=64)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def save(self, analysis_type, keypoints, angles, athlete=None, team=None, image_hash=None, image_url=None):
+        """分析結果を保存してIDを返す"""
+        analysis_id = secrets.token_urlsafe(9)
+        self._connect().execute(_INSERT, (
+            analysis_id, athlete, team, analysis_type, image_hash, image_url,
+            json.dumps(keypoints), json.dumps(angles), time.time()
+        ))
+        return analysis_id
+
+    def get(self, analysis_id):
+        """IDで分析結果を取得する（無ければNone）"""
+        row = self._connect().execute(_SELECT_BY_ID, (analysis_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'analysis_id': row['id'],
+            'athlete': row['athlete'],
+            'team': row['team'],
+            'analysis_type': row['analysis_type'],
+            'image_hash': row['image_hash'],
+            'image_url': row['image_url'],
+            'keypoints': json.loads(row['keypoints']),
+            'angles': json.loads(row['angles']),
+            'created_at': row['created_at']
+        }
+
+    def ids_for_image(self, image_hash):
+        """同じ画像の分析のIDのリスト"""
+        return [row['id'] for row in self._connect().execute(_SELECT_IDS_BY_IMAGE, (image_hash,))]
+
+    def search(self, athlete=None, team=None, since=None, until=None, limit=50):
+        """選手・チーム・日時で絞り込んだ分析の一覧（新しい順）"""
+        conditions = []
+        params = []
+        if athlete:
+            conditions.append('athlete = ?')
+            params.append(athlete)
+        if team:
+            conditions.append('team = ?')
+            params.append(team)
+        if since is not None:
+            conditions.append('created_at >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('created_at < ?')
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        params.append(limit)
+        rows = self._connect().execute(
+            f"SELECT {_COLUMNS} FROM analyses {where} ORDER BY created_at DESC LIMIT ?", params
+        ).fetchall()
+        return [{
+            'analysis_id': row['id'],
+            'athlete': row['athlete'],
+            'team': row['team'],
+            'analysis_type': row['analysis_type'],
+            'image_hash': row['image_hash'],
+            'image_url': row['image_url'],
+            'created_at': row['created_at']
+        } for row in rows]
@@ -1,51 +1,250 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory, render_template_string
+import time
+_IMPORT_STARTED = time.perf_counter()
+
+from flask import Flask, Response, g, render_template, request, jsonify, send_file, send_from_directory, render_template_string
+import re
 import math
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 import io
 import base64
 import os
 import sys
 import json
-import traceback
-from werkzeug.utils import secure_filename
+import logging
+import sqlite3
+import hashlib
+import threading
+import importlib.util
+from pose_pool import PosePool, PoseWorkerError, PoseUnavailableError, PoseTrackerLimitError, PoseBusyError
+from video_analysis import allowed_video, detect_key_frames
+from upload_store import UploadStore, PoseCache
+from image_pipeline import (ImageTooLargeError, open_image, decode_for_pose, resize_image, landmarks_to_keypoints,
+                            oriented_size, orient_image)
+from jobs import JobQueue, QueueFullError
+from analysis_store import AnalysisStore
+from metrics import Metrics
+from metric_engine import MetricEngine, load_metric_sets
+from derivatives import DerivativeStore, OVERLAY_VERSION, RESIZED_VERSION
+from structured_logging import configure_logging
+from live_stream import LatestFrame
+from roi import RegionTracker, still_region, to_pixels, to_full_frame, landmark_box
+from multi_athlete import detect_athletes, tile_regions
+from reference_index import ReferenceIndex, InvalidPoseError
+import athlete_history
+from athlete_history import HistoryStore
+from admission import AdmissionController, DEFAULT_LEVELS, DEFAULT_JOINTS_LEVEL
+
+# ライブカメラ（WebSocket）は flask-sock がインストールされている場合のみ有効
+try:
+    from flask_sock import Sock
+    from simple_websocket import ConnectionClosed
+except ImportError:
+    Sock = None
+
+APP_VERSION = '1.0.0'
 
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'static/uploads'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', 'static/uploads')
+app.config['UPLOAD_INDEX_DB'] = os.environ.get('UPLOAD_INDEX_DB', 'cache/uploads.sqlite3')
+app.config['UPLOAD_MAX_BYTES'] = int(os.environ.get('UPLOAD_MAX_BYTES', 10 * 1024 ** 3))  # 合計容量の上限（0で無制限）
+app.config['UPLOAD_TTL_DAYS'] = float(os.environ.get('UPLOAD_TTL_DAYS', 30))  # 最終アクセスからの保存期間（0で無期限）
+app.config['UPLOAD_SWEEP_INTERVAL'] = float(os.environ.get('UPLOAD_SWEEP_INTERVAL', 600))  # 削除処理の間隔（秒）
+app.config['MAX_CONTENT_LENGTH'] = 200 * 1024 * 1024  # 200MB max request size (video)
+app.config['MAX_IMAGE_LENGTH'] = 16 * 1024 * 1024  # 16MB max image size
+app.config['MAX_IMAGE_PIXELS'] = int(os.environ.get('MAX_IMAGE_PIXELS', 50_000_000))  # 解凍爆弾対策
+app.config['POSE_INPUT_SIZE'] = int(os.environ.get('POSE_INPUT_SIZE', 512))  # 推論用画像の長辺
+app.config['POSE_WORKERS'] = int(os.environ.get('POSE_WORKERS', os.cpu_count() or 1))
+app.config['POSE_TIMEOUT'] = float(os.environ.get('POSE_TIMEOUT', 10))
+app.config['POSE_POOL_START_METHOD'] = os.environ.get('POSE_POOL_START_METHOD')  # 既定: forkserver（利用可能な場合）
+app.config['VIDEO_TIMEOUT'] = float(os.environ.get('VIDEO_TIMEOUT', 120))
+app.config['VIDEO_TARGET_FPS'] = float(os.environ.get('VIDEO_TARGET_FPS', 60))
+app.config['VIDEO_MAX_FRAMES'] = int(os.environ.get('VIDEO_MAX_FRAMES', 3000))
+app.config['MAX_BATCH_ITEMS'] = int(os.environ.get('MAX_BATCH_ITEMS', 10000))
+app.config['POSE_CACHE_DIR'] = os.environ.get('POSE_CACHE_DIR', 'cache/pose')
+app.config['POSE_CACHE_SIZE'] = int(os.environ.get('POSE_CACHE_SIZE', 1024))
+app.config['POSE_CACHE_TTL_DAYS'] = float(os.environ.get('POSE_CACHE_TTL_DAYS', 30))  # 使われない姿勢キャッシュを削除するまでの日数（0で無期限）
+app.config['JOB_DB'] = os.environ.get('JOB_DB', 'cache/jobs.sqlite3')
+app.config['JOB_QUEUE_SIZE'] = int(os.environ.get('JOB_QUEUE_SIZE', 32))
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', app.config['POSE_WORKERS']))
+app.config['JOB_EVENTS_MAX_STREAMS'] = int(os.environ.get('JOB_EVENTS_MAX_STREAMS', 2))  # Webワーカーあたりの進捗配信（SSE）の同時接続数
+app.config['JOB_EVENTS_MAX_SECONDS'] = float(os.environ.get('JOB_EVENTS_MAX_SECONDS', 60))  # 1回の進捗配信を続ける秒数
+app.config['ANALYSIS_DB'] = os.environ.get('ANALYSIS_DB', 'data/analyses.sqlite3')
+app.config['REFERENCE_DB'] = os.environ.get('REFERENCE_DB', 'data/references.sqlite3')  # 基準姿勢ライブラリ
+app.config['HISTORY_DIR'] = os.environ.get('HISTORY_DIR', 'data/history')  # 選手ごとの角度の履歴（列ごとの追記専用ファイル）
+app.config['MAX_REFERENCE_MATCHES'] = int(os.environ.get('MAX_REFERENCE_MATCHES', 50))  # 類似検索で返す件数の上限
+app.config['METRIC_SETS_FILE'] = os.environ.get('METRIC_SETS_FILE')  # 独自の角度指標定義（JSON）
+app.config['DERIVATIVE_DIR'] = os.environ.get('DERIVATIVE_DIR', 'cache/derivatives')
+app.config['THUMBNAIL_SIZE'] = int(os.environ.get('THUMBNAIL_SIZE', 256))  # サムネイルの長辺
+app.config['PREVIEW_SIZE'] = int(os.environ.get('PREVIEW_SIZE', 1280))  # 表示用プレビューの長辺
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR', 'cache/metrics')  # gunicornワーカー間での集計用
+app.config['ADMISSION_ENABLED'] = os.environ.get('ADMISSION_ENABLED', '1').lower() in ('1', 'true', 'yes')  # 混雑時に品質を下げる
+app.config['POSE_LATENCY_BUDGET'] = float(os.environ.get('POSE_LATENCY_BUDGET', 3.0))  # 1リクエストの姿勢推定にかける時間の上限（秒）
+app.config['ROI_ENABLED'] = os.environ.get('ROI_ENABLED', '1').lower() in ('1', 'true', 'yes')  # 選手の周囲を切り出して推定
+app.config['ROI_PADDING'] = float(os.environ.get('ROI_PADDING', 0.3))  # 切り出す余白（関節点の範囲に対する割合）
+app.config['ROI_STILL_MAX_AREA'] = float(os.environ.get('ROI_STILL_MAX_AREA', 0.5))  # 静止画で切り出して推定し直す領域の面積の上限
+app.config['HEAT_INPUT_SIZE'] = int(os.environ.get('HEAT_INPUT_SIZE', 1920))  # ヒート写真をタイルに分ける前の長辺
+app.config['HEAT_COLUMNS'] = int(os.environ.get('HEAT_COLUMNS', 4))  # ヒート写真を横に分ける列数（タイルは半分ずつ重ね、推論は1枚あたり列数×2回）
+app.config['HEAT_MAX_ATHLETES'] = int(os.environ.get('HEAT_MAX_ATHLETES', 8))  # ヒート写真から検出する選手数の上限
+app.config['LIVE_MAX_SESSIONS'] = int(os.environ.get('LIVE_MAX_SESSIONS', 2))  # 同時に開けるライブカメラのセッション数
+app.config['LIVE_INPUT_SIZE'] = int(os.environ.get('LIVE_INPUT_SIZE', 256))  # ライブ推論用画像の長辺
+app.config['LIVE_MODEL_COMPLEXITY'] = int(os.environ.get('LIVE_MODEL_COMPLEXITY', 0))  # 0: 軽量, 1: 標準, 2: 高精度
+app.config['LIVE_MAX_FRAME_BYTES'] = int(os.environ.get('LIVE_MAX_FRAME_BYTES', 2 * 1024 * 1024))
+app.config['LIVE_IDLE_TIMEOUT'] = float(os.environ.get('LIVE_IDLE_TIMEOUT', 30))  # フレームが届かなければ切断（秒）
+app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO')
+app.config['LOG_FORMAT'] = os.environ.get('LOG_FORMAT', 'json')  # json または text
 
-# アップロードフォルダが存在しない場合は作成
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-print(f"Upload folder created/exists: {app.config['UPLOAD_FOLDER']}")
-print(f"Upload folder is writable: {os.access(app.config['UPLOAD_FOLDER'], os.W_OK)}")
-try:
-    print(f"Upload folder contents: {os.listdir(app.config['UPLOAD_FOLDER'])}")
-except Exception as e:
-    print(f"Error listing upload folder: {e}")
+configure_logging(app.config['LOG_LEVEL'], app.config['LOG_FORMAT'])
+logger = logging.getLogger('crouch_analyzer')
 
-# 依存関係が失敗してもアプリが動作するように修正
-DEPENDENCIES_AVAILABLE = True
-try:
-    import cv2
-    import mediapipe as mp
-    import numpy as np
-    print("✅ All dependencies loaded successfully")
-    
-    # MediaPipe姿勢推定の初期化
-    mp_pose = mp.solutions.pose
-    mp_drawing = mp.solutions.drawing_utils
-    pose = mp_pose.Pose(static_image_mode=True, min_detection_confidence=0.5)
-    MEDIAPIPE_AVAILABLE = True
-    print("✅ MediaPipe initialized successfully")
-except ImportError as e:
+# 処理段階ごとのレイテンシと件数（/metrics で公開）
+metrics = Metrics(app.config['METRICS_DIR'])
+metrics.histogram('crouch_request_duration_seconds', 'Request latency by endpoint.')
+metrics.histogram('crouch_stage_duration_seconds', 'Time spent in each processing stage.')
+metrics.counter('crouch_requests_total', 'Requests by endpoint and status code.')
+metrics.counter('crouch_upload_bytes_total', 'Bytes received in uploads by kind.')
+metrics.counter('crouch_keypoints_total', 'Keypoint results by source (ai, cache, default).')
+metrics.counter('crouch_fallbacks_total', 'Default-joint fallbacks by reason.')
+metrics.counter('crouch_errors_total', 'Errors by processing stage.')
+metrics.counter('crouch_quality_total', 'Image pose requests by admitted quality level.')
+metrics.counter('crouch_over_budget_total', 'Adaptive pose inferences that finished after the latency budget.')
+metrics.counter('crouch_live_frames_total', 'Live camera frames by outcome (processed, dropped, no_pose, invalid).')
+
+# 重い依存関係（OpenCV / MediaPipe / NumPy）は起動時にインポートせず、インストールの有無だけ確認する。
+# MediaPipeとOpenCVは姿勢推定ワーカー側でのみ読み込み、NumPyは初回の配列計算時に読み込む。
+def _module_available(name):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+DEPENDENCIES_AVAILABLE = all(_module_available(name) for name in ('cv2', 'mediapipe', 'numpy'))
+# 角度の一括計算・基準姿勢の検索・履歴の集計はNumPyだけで動く（MediaPipeが無くても使う）
+NUMPY_AVAILABLE = _module_available('numpy')
+HISTORY_AVAILABLE = NUMPY_AVAILABLE
+MEDIAPIPE_AVAILABLE = DEPENDENCIES_AVAILABLE
+np = None
+_numpy_lock = threading.Lock()
+
+def load_numpy():
+    """NumPyを初回利用時に読み込む（利用できなければNone）"""
+    global np
+    if np is None and NUMPY_AVAILABLE:
+        with _numpy_lock:
+            if np is None:
+                import numpy
+                np = numpy
+    return np
+
+def mark_ai_unavailable(reason):
+    """姿勢推定ワーカーで依存関係を読み込めなかった場合に基本モードへ切り替える"""
+    global DEPENDENCIES_AVAILABLE, MEDIAPIPE_AVAILABLE
     DEPENDENCIES_AVAILABLE = False
     MEDIAPIPE_AVAILABLE = False
-    print(f"⚠️ Dependencies not available: {e}")
-    print("🔧 Running in basic mode - manual joint point setting will be available")
-    # 基本機能のみで動作させる
-    cv2 = None
-    mp = None
-    pose = None
-    np = None
+    logger.warning('AI dependencies not available, running in basic mode', extra={'reason': str(reason)})
+
+# 起動時間の計測結果（/api/health で確認できる）
+STARTUP_INFO = {
+    'preloaded': os.environ.get('PRELOAD_APP', '').lower() in ('1', 'true', 'yes'),
+    'import_seconds': None,
+    'pose_pool_warmup_seconds': None
+}
+
+Image.MAX_IMAGE_PIXELS = app.config['MAX_IMAGE_PIXELS']
+
+# 画像ハッシュをキーにした姿勢推定結果キャッシュ
+pose_cache = PoseCache(
+    app.config['POSE_CACHE_DIR'],
+    max_entries=app.config['POSE_CACHE_SIZE'],
+    ttl=app.config['POSE_CACHE_TTL_DAYS'] * 86400
+)
+
+# 非同期分析ジョブのキュー（ワーカースレッドは初回登録時または起動時に開始）
+job_queue = JobQueue(
+    app.config['JOB_DB'],
+    max_pending=app.config['JOB_QUEUE_SIZE'],
+    workers=app.config['JOB_WORKERS']
+)
+
+# 角度指標の定義（起動時に1回だけコンパイルする）
+metric_engine = MetricEngine(load_metric_sets(app.config['METRIC_SETS_FILE']))
+
+# サムネイル・プレビュー・骨格オーバーレイのディスクキャッシュ
+derivative_store = DerivativeStore(app.config['DERIVATIVE_DIR'], {
+    'thumb': app.config['THUMBNAIL_SIZE'],
+    'preview': app.config['PREVIEW_SIZE']
+})
+
+def discard_upload_caches(image_hash):
+    """削除したアップロードの派生画像（共有の骨格オーバーレイを含む）と姿勢推定のキャッシュを削除する"""
+    derivative_store.discard(image_hash, legacy_overlay_keys=analysis_store.ids_for_image(image_hash))
+    pose_cache.discard(image_hash, f'{image_hash}-heat')
+
+# 共有用の分析結果ストア（アップロードの削除時に、その画像の共有オーバーレイを探すため先に作る）
+analysis_store = AnalysisStore(app.config['ANALYSIS_DB'])
+
+# アップロードの保存先と索引（期限切れ・容量超過のファイルはスイーパーが削除する）
+upload_store = UploadStore(
+    app.config['UPLOAD_FOLDER'],
+    app.config['UPLOAD_INDEX_DB'],
+    max_bytes=app.config['UPLOAD_MAX_BYTES'],
+    ttl=app.config['UPLOAD_TTL_DAYS'] * 86400,
+    sweep_interval=app.config['UPLOAD_SWEEP_INTERVAL'],
+    on_remove=lambda filename: discard_upload_caches(filename.rsplit('.', 1)[0]),
+    on_sweep=pose_cache.sweep
+)
+
+# 基準姿勢ライブラリ（類似検索用、前足は角度の分析と同じ定義で判定する）
+reference_index = ReferenceIndex(app.config['REFERENCE_DB'], metric_engine)
+
+# 選手ごとの角度の履歴（集計はNumPyのmemmapで行う）
+history_store = HistoryStore(app.config['HISTORY_DIR'])
+
+# 共有ページのETag（保存済みの分析は変わらないため、アプリとテンプレートが同じなら同じ内容になる）
+with open(os.path.join(app.root_path, 'templates', 'index.html'), 'rb') as f:
+    SHARE_PAGE_VERSION = f"{APP_VERSION}-{hashlib.sha1(f.read()).hexdigest()[:8]}"
+
+# 混雑に応じた品質レベルの選択（最高品質の入力サイズは POSE_INPUT_SIZE）
+QUALITY_LEVELS = [
+    dict(level, input_size=app.config['POSE_INPUT_SIZE']) if index == 0 else level
+    for index, level in enumerate(DEFAULT_LEVELS)
+]
+admission = AdmissionController(
+    QUALITY_LEVELS if app.config['ADMISSION_ENABLED'] else QUALITY_LEVELS[:1],
+    workers=app.config['POSE_WORKERS'],
+    budget=app.config['POSE_LATENCY_BUDGET']
+)
+
+# 姿勢推定ワーカープール（初回利用時または起動時に生成）
+pose_pool = None
+_pose_pool_lock = threading.Lock()
+
+def get_pose_pool():
+    """姿勢推定ワーカープールを取得（未起動なら起動してウォームアップ）"""
+    global pose_pool
+    if pose_pool is None:
+        with _pose_pool_lock:
+            if pose_pool is None:
+                pool = PosePool(
+                    workers=app.config['POSE_WORKERS'],
+                    timeout=app.config['POSE_TIMEOUT'],
+                    min_detection_confidence=0.5,
+                    start_method=app.config['POSE_POOL_START_METHOD'],
+                    max_trackers=app.config['LIVE_MAX_SESSIONS'],
+                    model_complexities=tuple(dict.fromkeys(level['model_complexity'] for level in admission.levels))
+                )
+                try:
+                    pool.start()
+                except PoseUnavailableError as e:
+                    mark_ai_unavailable(e)
+                    raise
+                pose_pool = pool
+                STARTUP_INFO['pose_pool_warmup_seconds'] = round(pool.startup_seconds, 3)
+                logger.info('Pose worker pool started', extra={
+                    'workers': pool.size,
+                    'start_method': pool.start_method,
+                    'startup_seconds': round(pool.startup_seconds, 3)
+                })
+    return pose_pool
 
 # MediaPipe landmark indices to frontend joint mapping
 MEDIAPIPE_TO_FRONTEND = {
@@ -85,7 +284,7 @@ def calculate_angle(point1, point2, point3):
         vector2 = [point3[0] - point2[0], point3[1] - point2[1]]
         
         # 内積を計算
-        if DEPENDENCIES_AVAILABLE and 'np' in globals():
+        if DEPENDENCIES_AVAILABLE and np is not None:
             # numpy利用可能な場合
             vector1 = np.array(vector1)
             vector2 = np.array(vector2)
@@ -112,214 +311,1079 @@ def calculate_angle(point1, point2, point3):
         angle = math.degrees(math.acos(cos_theta))
         
         return round(angle, 1)
-    except Exception as e:
-        print(f"⚠️ Angle calculation error: {e}")
+    except Exception:
+        logger.warning('Angle calculation error', exc_info=True)
         return 0
 
-def analyze_crouch_angles(keypoints, analysis_type="set"):
-    """クラウチングスタートの角度分析を行う"""
-    analysis_result = {}
-    
+FRONT_LEG_OPTIONS = ('auto', 'left', 'right')
+
+def analyze_crouch_angles(keypoints, analysis_type="set", front_leg='auto'):
+    """クラウチングスタートの角度分析を行う
+
+    指標は metric_engine の定義に従って計算する。前足は front_leg='auto' なら関節点の位置から判定する。
+    """
     try:
-        if analysis_type == "set":
-            # セット姿勢の分析
-            # 前足の膝角度（左膝を前足と仮定）
-            if all(joint in keypoints for joint in ['LHip', 'LKnee', 'LAnkle']):
-                hip = keypoints['LHip']
-                knee = keypoints['LKnee']
-                ankle = keypoints['LAnkle']
-                front_angle = calculate_angle([hip['x'], hip['y']], [knee['x'], knee['y']], [ankle['x'], ankle['y']])
-                analysis_result['front_angle'] = front_angle
-            
-            # 後足の膝角度（右膝を後足と仮定）
-            if all(joint in keypoints for joint in ['RHip', 'RKnee', 'RAnkle']):
-                hip = keypoints['RHip']
-                knee = keypoints['RKnee']
-                ankle = keypoints['RAnkle']
-                rear_angle = calculate_angle([hip['x'], hip['y']], [knee['x'], knee['y']], [ankle['x'], ankle['y']])
-                analysis_result['rear_angle'] = rear_angle
-            
-            # 前足股関節角度
-            if all(joint in keypoints for joint in ['LShoulder', 'LHip', 'LKnee']):
-                shoulder = keypoints['LShoulder']
-                hip = keypoints['LHip']
-                knee = keypoints['LKnee']
-                front_hip_angle = calculate_angle([shoulder['x'], shoulder['y']], [hip['x'], hip['y']], [knee['x'], knee['y']])
-                analysis_result['front_hip_angle'] = front_hip_angle
-                
-        elif analysis_type == "takeoff":
-            # 飛び出し分析
-            # 下半身角度（腰-膝-足首）
-            if all(joint in keypoints for joint in ['LHip', 'LKnee', 'LAnkle']):
-                hip = keypoints['LHip']
-                knee = keypoints['LKnee']
-                ankle = keypoints['LAnkle']
-                lower_angle = calculate_angle([hip['x'], hip['y']], [knee['x'], knee['y']], [ankle['x'], ankle['y']])
-                analysis_result['lower_angle'] = lower_angle
-            
-            # 上半身角度（肩-腰-膝）
-            if all(joint in keypoints for joint in ['LShoulder', 'LHip', 'LKnee']):
-                shoulder = keypoints['LShoulder']
-                hip = keypoints['LHip']
-                knee = keypoints['LKnee']
-                upper_angle = calculate_angle([shoulder['x'], shoulder['y']], [hip['x'], hip['y']], [knee['x'], knee['y']])
-                analysis_result['upper_angle'] = upper_angle
-            
-            # くの字角度（肩-腰-足首）
-            if all(joint in keypoints for joint in ['LShoulder', 'LHip', 'LAnkle']):
-                shoulder = keypoints['LShoulder']
-                hip = keypoints['LHip']
-                ankle = keypoints['LAnkle']
-                kunoji_angle = calculate_angle([shoulder['x'], shoulder['y']], [hip['x'], hip['y']], [ankle['x'], ankle['y']])
-                analysis_result['kunoji_angle'] = kunoji_angle
-        
-        analysis_result['analysis_type'] = analysis_type
-        return analysis_result
-        
+        return metric_engine.analyze(keypoints, analysis_type, front_leg)
     except Exception as e:
-        print(f"⚠️ Analysis error: {str(e)}")
-        traceback.print_exc()
+        logger.exception('Angle analysis error')
         return {'error': f'角度計算エラー: {str(e)}', 'analysis_type': analysis_type}
 
+def analyze_crouch_angles_batch(keypoints_list, analysis_types=('set', 'takeoff'), front_leg='auto'):
+    """複数の関節点セットをまとめて角度分析する
+
+    全指標をNumPyで一括計算し、モードごとに analyze_crouch_angles と同じ形式の結果リストを返す。
+    """
+    return metric_engine.analyze_batch(keypoints_list, analysis_types, front_leg, np=load_numpy())
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """エンドポイントごとのレイテンシと件数を記録する（URLではなくルート単位で集計）"""
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('crouch_request_duration_seconds', time.perf_counter() - started, endpoint=endpoint)
+        metrics.inc('crouch_requests_total', endpoint=endpoint, status=response.status_code)
+    return response
+
+def stage_timer(stage):
+    """処理段階の所要時間を計測するコンテキストマネージャ"""
+    return metrics.timer('crouch_stage_duration_seconds', stage=stage)
+
+def timed_jsonify(data):
+    """JSONレスポンスの生成時間を serialization 段階として計測する"""
+    with stage_timer('serialization'):
+        return jsonify(data)
+
 @app.route('/')
 def index():
     """メインページ"""
     return render_template('index.html')
 
+def wants_async():
+    """非同期ジョブとして処理するか（?async=1 またはフォーム項目 async）"""
+    value = request.args.get('async') or request.form.get('async') or ''
+    return value.lower() in ('1', 'true', 'yes')
+
+def submit_job(kind, payload):
+    """ジョブを登録して202レスポンスを返す（キューが満杯なら429）"""
+    try:
+        job_id = job_queue.submit(kind, payload)
+    except QueueFullError as e:
+        response = jsonify({'error': f'{e}。しばらくしてから再試行してください'})
+        response.headers['Retry-After'] = '5'
+        return response, 429
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': f'/jobs/{job_id}',
+        'events_url': f'/jobs/{job_id}/events'
+    }), 202
+
+def detect_image_keypoints(img, image_hash, adaptive=True):
+    """画像の関節点を推定する
+
+    キャッシュ → ワーカープールでの推定 → デフォルト関節点 の順に試す。
+    adaptive=True なら混雑に応じて品質レベルを下げ、予算内に推定できなければデフォルト関節点を返す。
+    戻り値は (関節点, AI推定を使ったか, キャッシュヒットか, 品質レベル名, デフォルト関節点にした理由)。
+    理由は overload（混雑で省略）/ error / no_pose / unavailable のいずれかで、AI推定を使えばNone。
+    """
+    width, height = oriented_size(img)
+    keypoints_data = {}
+    ai_detection_used = False
+    cache_hit = False
+    fallback_reason = 'unavailable'
+    quality = DEFAULT_JOINTS_LEVEL['name']
+    
+    if MEDIAPIPE_AVAILABLE:
+        # ワーカープールで姿勢推定（同じ画像の結果はキャッシュから返す）
+        try:
+            cached = pose_cache.get(image_hash)
+            if cached is not None:
+                landmarks = cached['landmarks']
+                cache_hit = True
+                quality = admission.levels[0]['name']
+            else:
+                landmarks, level = infer_landmarks(img, adaptive)
+                quality = level['name']
+                # 品質を下げた結果はキャッシュせず、空いているときに推定し直す
+                if level is admission.levels[0]:
+                    pose_cache.put(image_hash, {'landmarks': landmarks})
+            
+            if landmarks:
+                # MediaPipeの関節点を元画像の座標に戻してフロントエンド形式に変換
+                keypoints_data = landmarks_to_keypoints(landmarks, MEDIAPIPE_TO_FRONTEND, width, height)
+                ai_detection_used = True
+                fallback_reason = None
+            else:
+                fallback_reason = 'no_pose'
+        except PoseBusyError as e:
+            fallback_reason = 'overload'
+            quality = DEFAULT_JOINTS_LEVEL['name']
+            logger.info('Pose detection skipped under load', extra={'image_hash': image_hash, 'error': str(e)})
+        except PoseWorkerError as e:
+            fallback_reason = 'error'
+            metrics.inc('crouch_errors_total', stage='pose_inference')
+            logger.warning('Pose detection failed', extra={'image_hash': image_hash, 'error': str(e)})
+        except Exception:
+            fallback_reason = 'error'
+            metrics.inc('crouch_errors_total', stage='pose_inference')
+            logger.exception('Pose detection failed', extra={'image_hash': image_hash})
+    
+    if keypoints_data:
+        metrics.inc('crouch_keypoints_total', source='cache' if cache_hit else 'ai')
+    else:
+        # MediaPipeが利用できない場合またはランドマークが検出されない場合のデフォルト
+        metrics.inc('crouch_keypoints_total', source='default')
+        metrics.inc('crouch_fallbacks_total', reason=fallback_reason)
+        logger.debug('Using default joint positions', extra={'image_hash': image_hash, 'reason': fallback_reason})
+        # デフォルトの関節点位置を画像サイズに合わせてスケール
+        scale_x = width / 400  # 基準サイズ400px
+        scale_y = height / 500  # 基準サイズ500px
+        
+        for joint_name, default_pos in DEFAULT_JOINTS.items():
+            keypoints_data[joint_name] = {
+                'x': int(default_pos['x'] * scale_x),
+                'y': int(default_pos['y'] * scale_y)
+            }
+    
+    return keypoints_data, ai_detection_used, cache_hit, quality, fallback_reason
+
+def infer_landmarks(img, adaptive=True):
+    """混雑に応じた品質レベルで姿勢を推定し、(ランドマーク, 品質レベル) を返す
+
+    空きワーカーを待つのはデコード後のレイテンシの予算の残りまでで、超えたら（またはワーカーが
+    すべて推定中で、どのレベルでも予算に収まらない見積もりなら）PoseBusyError になる。
+    空いているワーカーがあれば予算が残っていなくても推論する。adaptive=False なら常に最高品質で待つ。
+    """
+    adaptive = adaptive and app.config['ADMISSION_ENABLED']
+    with admission.admit(adaptive) as ticket:
+        level = ticket.level
+        metrics.inc('crouch_quality_total', level=level['name'])
+        if level is DEFAULT_JOINTS_LEVEL:
+            raise PoseBusyError('混雑のため姿勢推定を省略しました')
+        with stage_timer('decode'):
+            image_rgb = decode_for_pose(img, level['input_size'])
+        wait_timeout = ticket.wait_budget() if adaptive else None
+        started = time.perf_counter()
+        with stage_timer('pose_inference'):
+            # 予算で区切るのは待ち時間だけにする（推論の打ち切りは正常なワーカーの入れ替えになるため）
+            landmarks = get_pose_pool().detect(image_rgb, wait_timeout=wait_timeout, model_complexity=level['model_complexity'])
+        elapsed = time.perf_counter() - started
+        ticket.record(elapsed)
+        if adaptive and ticket.remaining() < 0:
+            # 予算を超えても結果は使い、再推定はしない
+            metrics.inc('crouch_over_budget_total', level=level['name'])
+        # 切り出しての再推定は、もう1回推論できる予算が残っている場合だけ行う
+        if landmarks and level['refine'] and app.config['ROI_ENABLED'] and (not adaptive or ticket.remaining() > elapsed):
+            landmarks = refine_in_region(img, landmarks, wait_timeout=ticket.wait_budget() if adaptive else None)
+        return landmarks, level
+
+def refine_in_region(img, landmarks, wait_timeout=None):
+    """選手が小さく写っている静止画は、1回目の推定結果の周囲を切り出して推定し直す
+
+    切り出した領域を推論用の解像度に縮小するため、選手に割り当てられる画素が増える。
+    戻り値は元画像全体の正規化座標のランドマーク（推定し直せなければ1回目の結果）。
+    """
+    region = still_region(landmarks, app.config['ROI_PADDING'], app.config['ROI_STILL_MAX_AREA'])
+    if region is None:
+        return landmarks
+    # JPEGは1回目のデコードで縮小されている場合があるため、向きを適用した現在のサイズで切り出す
+    with stage_timer('decode'):
+        oriented = orient_image(img)
+        width, height = oriented.size
+        box = to_pixels(region, width, height)
+        crop_rgb = decode_for_pose(oriented.crop(box), app.config['POSE_INPUT_SIZE'])
+    try:
+        with stage_timer('pose_inference'):
+            refined = get_pose_pool().detect(crop_rgb, wait_timeout=wait_timeout)
+    except PoseBusyError:
+        return landmarks
+    except PoseWorkerError as e:
+        # 再推定の失敗で1回目の結果まで捨てない
+        metrics.inc('crouch_errors_total', stage='roi_refine')
+        logger.warning('Pose refinement failed', extra={'error': str(e)})
+        return landmarks
+    if not refined:
+        return landmarks
+    return to_full_frame(refined, box, width, height)
+
+def analyze_uploaded_image(img, filename, image_hash, adaptive=True):
+    """保存済み画像の関節点を推定し、/upload のレスポンス内容を返す"""
+    width, height = oriented_size(img)
+    keypoints_data, ai_detection_used, cache_hit, quality, fallback_reason = detect_image_keypoints(img, image_hash, adaptive)
+    # 混雑で品質を下げたか推定を省略した場合だけ degraded にする（推定の失敗は fallback_reason で返す）
+    degraded = fallback_reason == 'overload' or quality not in (admission.levels[0]['name'], DEFAULT_JOINTS_LEVEL['name'])
+    if ai_detection_used:
+        detection_method = 'AI pose detection' + (f' ({quality} quality, server busy)' if degraded else '')
+    elif degraded:
+        detection_method = 'Default positions (server busy, manual adjustment recommended)'
+    elif fallback_reason == 'error':
+        detection_method = 'Default positions (pose detection failed, manual adjustment recommended)'
+    else:
+        detection_method = 'Default positions (manual adjustment recommended)'
+    
+    return {
+        'success': True,
+        'filename': filename,
+        'image_hash': image_hash,
+        'keypoints': keypoints_data,
+        'image_url': f'/static/uploads/{filename}',
+        **media_urls(filename),
+        'image_width': width,
+        'image_height': height,
+        'ai_detection_used': ai_detection_used,
+        'cache_hit': cache_hit,
+        'quality': quality,
+        'degraded': degraded,
+        'fallback_reason': fallback_reason,
+        'detection_method': detection_method,
+        'dependencies_available': DEPENDENCIES_AVAILABLE
+    }
+
+def analyze_heat_image(img, filename, image_hash):
+    """ヒート写真の選手ごとの関節点と角度を推定し、/upload（multi_athlete）のレスポンス内容を返す
+
+    選手の検出はタイルごとの推定をワーカープールでまとめて実行し、角度は全選手分を一括計算する。
+    推定できなければ PoseWorkerError を送出する（デフォルト関節点は選手ごとに置けないため）。
+    """
+    width, height = oriented_size(img)
+    cache_key = f'{image_hash}-heat'
+    cached = pose_cache.get(cache_key)
+    if cached is not None:
+        athlete_landmarks = cached['athletes']
+        cache_hit = True
+    else:
+        with stage_timer('decode'):
+            work_img = resize_image(img, app.config['HEAT_INPUT_SIZE'])
+        # タイルごとの推論でワーカーを占有するため、混雑度にはタイル数を数えて最高品質で推定する
+        inferences = len(tile_regions(app.config['HEAT_COLUMNS']))
+        with admission.admit(adaptive=False, weight=inferences), stage_timer('pose_inference'):
+            athlete_landmarks = detect_athletes(
+                work_img,
+                get_pose_pool().detect_batch,
+                app.config['POSE_INPUT_SIZE'],
+                columns=app.config['HEAT_COLUMNS'],
+                max_athletes=app.config['HEAT_MAX_ATHLETES']
+            )
+        pose_cache.put(cache_key, {'athletes': athlete_landmarks})
+        cache_hit = False
+    metrics.inc('crouch_keypoints_total', len(athlete_landmarks), source='cache' if cache_hit else 'ai')
+
+    keypoints_list = [landmarks_to_keypoints(landmarks, MEDIAPIPE_TO_FRONTEND, width, height) for landmarks in athlete_landmarks]
+    with stage_timer('angle_analysis'):
+        analyses = analyze_crouch_angles_batch(keypoints_list, ('set', 'takeoff'))
+    athletes = []
+    for index, (landmarks, keypoints) in enumerate(zip(athlete_landmarks, keypoints_list)):
+        x0, y0, x1, y1 = to_pixels(landmark_box(landmarks), width, height)
+        athletes.append({
+            'index': index + 1,
+            'keypoints': keypoints,
+            'box': {'x': x0, 'y': y0, 'width': x1 - x0, 'height': y1 - y0},
+            'analysis': {mode: results[index] for mode, results in analyses.items()}
+        })
+
+    return {
+        'success': True,
+        'filename': filename,
+        'image_hash': image_hash,
+        'image_url': f'/static/uploads/{filename}',
+        **media_urls(filename),
+        'image_width': width,
+        'image_height': height,
+        'athletes': athletes,
+        'athlete_count': len(athletes),
+        'ai_detection_used': bool(athletes),
+        'cache_hit': cache_hit,
+        'detection_method': 'AI multi-athlete detection' if athletes else 'No athletes detected'
+    }
+
+def run_heat_job(payload, report):
+    """ヒート写真の分析ジョブ"""
+    report(0.1, '画像を読み込み中')
+    with open(payload['filepath'], 'rb') as f:
+        img = open_image(f.read(), app.config['MAX_IMAGE_PIXELS'])
+    with img:
+        report(0.3, '選手を検出中')
+        return analyze_heat_image(img, payload['filename'], payload['image_hash'])
+
+def wants_multi_athlete():
+    """ヒート写真として選手ごとに分析するか（?multi_athlete=1 またはフォーム項目 multi_athlete）"""
+    value = request.args.get('multi_athlete') or request.form.get('multi_athlete') or ''
+    return value.lower() in ('1', 'true', 'yes')
+
+def run_image_job(payload, report):
+    """画像分析ジョブ"""
+    report(0.1, '画像を読み込み中')
+    with open(payload['filepath'], 'rb') as f:
+        img = open_image(f.read(), app.config['MAX_IMAGE_PIXELS'])
+    with img:
+        report(0.3, '姿勢推定中')
+        # 非同期ジョブは応答を待たせないため、混雑していても最高品質で推定する
+        return analyze_uploaded_image(img, payload['filename'], payload['image_hash'], adaptive=False)
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     """画像アップロード処理"""
-    print("=== アップロードリクエスト受信 ===")
-    
     if 'file' not in request.files:
-        print("'file'フィールドがありません")
         return jsonify({'error': 'ファイルが選択されていません'}), 400
     
     file = request.files['file']
     if file.filename == '':
-        print("ファイル名が空です")
         return jsonify({'error': 'ファイルが選択されていません'}), 400
     
+    if request.content_length and request.content_length > app.config['MAX_IMAGE_LENGTH']:
+        return jsonify({'error': f"画像サイズは{app.config['MAX_IMAGE_LENGTH'] // 1024 // 1024}MBまでです"}), 413
+    
+    multi_athlete = wants_multi_athlete()
+    if multi_athlete and not MEDIAPIPE_AVAILABLE:
+        return jsonify({'error': '複数選手の検出にはAI姿勢推定（MediaPipe）が必要です'}), 503
+    
     if file and allowed_file(file.filename):
         try:
-            # ファイルを保存
-            filename = secure_filename(file.filename)
-            if not filename:
-                filename = 'uploaded_image.jpg'
-            
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-            print(f"ファイル保存完了: {filepath}")
-            
-            # 画像の情報を取得
-            with Image.open(filepath) as img:
-                width, height = img.size
-            
-            print(f"画像サイズ: {width}x{height}px")
-            
-            # AIを使わずデフォルト関節点を設定（軽量処理モード）
-            # Renderで安定して動作させるために、MediaPipeを使わずデフォルト設定にする
-            use_ai = False  # 最初はAIなしで試す（安定性優先）
-            
-            keypoints_data = {}
-            ai_detection_used = False
+            # 受信しながらハッシュを計算し、内容に応じたファイル名で保存
+            # 受信データはメモリにも保持し、ディスクから再読み込みせずにデコードする
+            extension = file.filename.rsplit('.', 1)[1].lower()
+            data = io.BytesIO()
+            with stage_timer('upload_receive'):
+                image_hash, filename, filepath = upload_store.save(file.stream, extension, buffer=data)
+            metrics.inc('crouch_upload_bytes_total', data.tell(), kind='image')
             
-            if use_ai and MEDIAPIPE_AVAILABLE and cv2 is not None:
-                # MediaPipeで姿勢推定（必要に応じて有効化）
-                try:
-                    print("AI姿勢推定を開始...")
-                    image = cv2.imread(filepath)
-                    if image is not None:
-                        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                        results = pose.process(image_rgb)
-                        
-                        if results.pose_landmarks:
-                            # MediaPipeの関節点をフロントエンド形式に変換
-                            for mp_idx, frontend_name in MEDIAPIPE_TO_FRONTEND.items():
-                                if mp_idx < len(results.pose_landmarks.landmark):
-                                    landmark = results.pose_landmarks.landmark[mp_idx]
-                                    x = int(landmark.x * width)
-                                    y = int(landmark.y * height)
-                                    keypoints_data[frontend_name] = {'x': x, 'y': y}
-                            ai_detection_used = True
-                            print("✅ AI姿勢推定成功")
-                except Exception as e:
-                    print(f"⚠️ AI姿勢推定エラー: {e}")
-                    traceback.print_exc()
+            # ヘッダーのみ読み込んで画像サイズを取得（デコードは推論が必要な場合のみ）
+            try:
+                img = open_image(data.getvalue(), app.config['MAX_IMAGE_PIXELS'])
+            except ImageTooLargeError as e:
+                upload_store.remove(filename)
+                return jsonify({'error': str(e)}), 413
+            except UnidentifiedImageError:
+                upload_store.remove(filename)
+                return jsonify({'error': '画像を読み込めませんでした'}), 400
             
-            # MediaPipeが利用できない場合またはランドマークが検出されない場合のデフォルト
-            if not keypoints_data:
-                print("🔧 デフォルト関節点を使用 - 手動調整が必要です")
-                # デフォルトの関節点位置を画像サイズに合わせてスケール
-                scale_x = width / 400  # 基準サイズ400px
-                scale_y = height / 500  # 基準サイズ500px
-                
-                for joint_name, default_pos in DEFAULT_JOINTS.items():
-                    keypoints_data[joint_name] = {
-                        'x': int(default_pos['x'] * scale_x),
-                        'y': int(default_pos['y'] * scale_y)
-                    }
+            logger.debug('Image received', extra={'image_hash': image_hash, 'size': oriented_size(img)})
             
-            # レスポンスを返す前に成功を記録
-            print("✅ アップロード処理が完了しました")
+            if wants_async():
+                img.close()
+                return submit_job('heat' if multi_athlete else 'image',
+                                  {'filename': filename, 'filepath': filepath, 'image_hash': image_hash})
             
-            response_data = {
-                'success': True,
-                'filename': filename,
-                'keypoints': keypoints_data,
-                'image_url': f'/static/uploads/{filename}',
-                'image_width': width,
-                'image_height': height,
-                'ai_detection_used': ai_detection_used,
-                'detection_method': 'AI pose detection' if ai_detection_used else 'Default positions (manual adjustment recommended)',
-                'dependencies_available': DEPENDENCIES_AVAILABLE
-            }
+            with img:
+                if multi_athlete:
+                    response_data = analyze_heat_image(img, filename, image_hash)
+                else:
+                    response_data = analyze_uploaded_image(img, filename, image_hash)
             
-            return jsonify(response_data)
+            return timed_jsonify(response_data)
             
+        except PoseWorkerError as e:
+            metrics.inc('crouch_errors_total', stage='pose_inference')
+            logger.warning('Multi-athlete detection failed', extra={'error': str(e)})
+            return jsonify({'error': f'選手の検出に失敗しました: {str(e)}'}), 503
         except Exception as e:
-            print(f"⚠️ 画像処理エラー: {str(e)}")
-            traceback.print_exc()
+            metrics.inc('crouch_errors_total', stage='upload')
+            logger.exception('Image upload failed')
             return jsonify({'error': f'画像処理中にエラーが発生しました: {str(e)}'}), 500
     
-    print("⚠️ 無効なファイル形式です")
     return jsonify({'error': '無効なファイル形式です。JPG, PNG, WEBP形式をサポートしています。'}), 400
 
+def build_angle_series(frames, width, height):
+    """フレームごとの関節点から角度の時系列を作る"""
+    joint_names = list(MEDIAPIPE_TO_FRONTEND.values())
+    series = []
+    detected = []
+    for index, timestamp, landmarks in frames:
+        entry = {'frame': index, 'time': timestamp, 'keypoints': None}
+        if landmarks:
+            entry['keypoints'] = {
+                name: {'x': int(x * width), 'y': int(y * height)}
+                for name, (x, y) in zip(joint_names, landmarks)
+            }
+            detected.append(entry)
+        series.append(entry)
+    
+    # 全フレームの角度を一括計算（前足はフレームごとではなく動画全体で揃える）
+    with stage_timer('angle_analysis'):
+        keypoints_list = [entry['keypoints'] for entry in detected]
+        front_leg = metric_engine.dominant_front_leg(keypoints_list)
+        batch = analyze_crouch_angles_batch(keypoints_list, ('set', 'takeoff'), front_leg)
+    for mode, mode_results in batch.items():
+        for entry, angles in zip(detected, mode_results):
+            angles.pop('analysis_type', None)
+            entry[mode] = angles
+    return series
+
+def analyze_uploaded_video(filepath, filename, video_hash, report=None):
+    """保存済み動画をフレームごとに追跡し、/upload/video のレスポンス内容を返す"""
+    if report:
+        report(0.1, '姿勢を追跡中')
+    
+    # 動画全体の追跡は1つのワーカーで実行する（トラッキング状態を保つため）
+    joints = list(MEDIAPIPE_TO_FRONTEND.keys())
+    # 動画の解析中はワーカーを1つ占有するため、混雑度に数える
+    with stage_timer('video_tracking'), admission.admit(adaptive=False):
+        info = get_pose_pool().run(
+            'track_video',
+            timeout=app.config['VIDEO_TIMEOUT'],
+            path=os.path.abspath(filepath),
+            joints=joints,
+            target_fps=app.config['VIDEO_TARGET_FPS'],
+            max_frames=app.config['VIDEO_MAX_FRAMES'],
+            roi_padding=app.config['ROI_PADDING'] if app.config['ROI_ENABLED'] else None
+        )
+    
+    if report:
+        report(0.8, '角度を分析中')
+    series = build_angle_series(info['frames'], info['width'], info['height'])
+    set_index, takeoff_index = detect_key_frames(series, info['fps'] / info['stride'])
+    
+    logger.info('Video analyzed', extra={'video_hash': video_hash, 'frames': len(series)})
+    
+    return {
+        'success': True,
+        'filename': filename,
+        'video_hash': video_hash,
+        'video_url': f'/static/uploads/{filename}',
+        'video_width': info['width'],
+        'video_height': info['height'],
+        'fps': info['fps'],
+        'frame_count': info['frame_count'],
+        'frame_stride': info['stride'],
+        'roi_area': round(info['roi_area'], 3) if info.get('roi_area') is not None else None,
+        'analyzed_frames': len(series),
+        'detected_frames': sum(1 for entry in series if entry['keypoints']),
+        'series': series,
+        'set_frame': series[set_index] if set_index is not None else None,
+        'takeoff_frame': series[takeoff_index] if takeoff_index is not None else None
+    }
+
+def run_video_job(payload, report):
+    """動画分析ジョブ"""
+    return analyze_uploaded_video(payload['filepath'], payload['filename'], payload['video_hash'], report)
+
+@app.route('/upload/video', methods=['POST'])
+def upload_video():
+    """動画アップロード処理（フレームごとの姿勢追跡）"""
+    if 'file' not in request.files:
+        return jsonify({'error': 'ファイルが選択されていません'}), 400
+    
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'ファイルが選択されていません'}), 400
+    
+    if not allowed_video(file.filename):
+        return jsonify({'error': '無効なファイル形式です。MP4, MOV, AVI, WEBM形式をサポートしています。'}), 400
+    
+    if not MEDIAPIPE_AVAILABLE:
+        return jsonify({'error': '動画解析にはAI姿勢推定（MediaPipe）が必要です'}), 503
+    
+    try:
+        extension = file.filename.rsplit('.', 1)[1].lower()
+        with stage_timer('upload_receive'):
+            video_hash, filename, filepath = upload_store.save(file.stream, extension)
+        metrics.inc('crouch_upload_bytes_total', os.path.getsize(filepath), kind='video')
+        
+        if wants_async():
+            return submit_job('video', {'filename': filename, 'filepath': filepath, 'video_hash': video_hash})
+        
+        return timed_jsonify(analyze_uploaded_video(filepath, filename, video_hash))
+        
+    except PoseWorkerError as e:
+        metrics.inc('crouch_errors_total', stage='video_tracking')
+        logger.warning('Video analysis failed', extra={'error': str(e)})
+        return jsonify({'error': f'動画解析中にエラーが発生しました: {str(e)}'}), 500
+    except Exception as e:
+        metrics.inc('crouch_errors_total', stage='video_upload')
+        logger.exception('Video upload failed')
+        return jsonify({'error': f'動画処理中にエラーが発生しました: {str(e)}'}), 500
+
+job_queue.register('image', run_image_job)
+job_queue.register('video', run_video_job)
+job_queue.register('heat', run_heat_job)
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """ジョブの状態を取得（ポーリング用）"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+    return jsonify(job)
+
+# 進捗の配信は接続中ずっとスレッドを使うため、同時接続数を制限して通常のリクエスト用のスレッドを残す
+_event_streams = threading.BoundedSemaphore(max(1, app.config['JOB_EVENTS_MAX_STREAMS']))
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """ジョブの進捗をServer-Sent Eventsで配信（上限を超えたら429で状態のポーリングを促す）"""
+    if job_queue.get(job_id) is None:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+    if not _event_streams.acquire(blocking=False):
+        response = jsonify({
+            'error': '進捗の配信数が上限に達しています。status_url をポーリングしてください',
+            'status_url': f'/jobs/{job_id}'
+        })
+        response.headers['Retry-After'] = '2'
+        return response, 429
+    released = threading.Event()
+
+    def release():
+        # 配信が始まる前に切断された場合も、応答を閉じたときに1回だけ返す
+        if not released.is_set():
+            released.set()
+            _event_streams.release()
+
+    try:
+        response = Response(
+            job_queue.events(job_id, max_duration=app.config['JOB_EVENTS_MAX_SECONDS']),
+            mimetype='text/event-stream'
+        )
+    except Exception:
+        release()
+        raise
+    response.call_on_close(release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def clean_label(value, max_length=200):
+    """保存用の文字列項目を整える（空や文字列以外はNone）"""
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    return value[:max_length] or None
+
 @app.route('/analyze', methods=['POST'])
 def analyze():
     """姿勢分析処理"""
     try:
-        print("=== 分析リクエスト受信 ===")
         data = request.get_json()
         keypoints = data.get('keypoints', {})
         analysis_mode = data.get('analysis_mode', 'set')
-        
-        print(f"分析モード: {analysis_mode}")
+        front_leg = data.get('front_leg', 'auto')
+        reference_k = data.get('reference_k', 0)
         
         if not keypoints:
-            print("⚠️ 関節点データがありません")
             return jsonify({'error': '関節点データがありません'}), 400
+        if front_leg not in FRONT_LEG_OPTIONS:
+            return jsonify({'error': 'front_leg は auto / left / right のいずれかです'}), 400
+        if not isinstance(reference_k, int) or not 0 <= reference_k <= app.config['MAX_REFERENCE_MATCHES']:
+            return jsonify({'error': f"reference_k は0〜{app.config['MAX_REFERENCE_MATCHES']}の整数です"}), 400
+        
+        with stage_timer('angle_analysis'):
+            result = analyze_crouch_angles(keypoints, analysis_mode, front_leg)
+        
+        # 指定されれば、同じモードの最も近い基準姿勢も返す
+        if reference_k and 'error' not in result:
+            try:
+                with stage_timer('reference_search'):
+                    result['reference_matches'] = reference_index.search(
+                        keypoints, reference_k, analysis_type=analysis_mode, np=load_numpy(), front_leg=front_leg)
+            except InvalidPoseError as e:
+                result['reference_matches'] = []
+                result['reference_error'] = str(e)
+        
+        # 共有用に分析結果を保存
+        if 'error' not in result:
+            image_filename = issued_upload(data.get('image_url'))
+            try:
+                angles = {key: value for key, value in result.items() if key != 'analysis_type'}
+                analysis_id = analysis_store.save(
+                    analysis_mode, keypoints, angles,
+                    athlete=clean_label(data.get('athlete')),
+                    team=clean_label(data.get('team')),
+                    # 画像はこのサーバーが発行したアップロードのURLだけを保存する（ハッシュはファイル名から求める）
+                    image_hash=image_filename.rsplit('.', 1)[0] if image_filename else None,
+                    image_url=f'/static/uploads/{image_filename}' if image_filename else None
+                )
+                result['analysis_id'] = analysis_id
+                result['share_url'] = f'/share/{analysis_id}'
+            except Exception:
+                metrics.inc('crouch_errors_total', stage='analysis_store')
+                logger.exception('Failed to save analysis')
+            
+            # 選手名があれば角度の履歴に追記
+            athlete = clean_label(data.get('athlete'))
+            if athlete:
+                try:
+                    history_store.append(athlete, analysis_mode, result)
+                except Exception:
+                    metrics.inc('crouch_errors_total', stage='history')
+                    logger.exception('Failed to append athlete history')
+        
+        return timed_jsonify({'success': True, **result})
+        
+    except Exception as e:
+        metrics.inc('crouch_errors_total', stage='angle_analysis')
+        logger.exception('Analysis failed')
+        return jsonify({'error': f'分析中にエラーが発生しました: {str(e)}'}), 500
+
+@app.route('/analyze/batch', methods=['POST'])
+def analyze_batch():
+    """複数の関節点セットの一括分析"""
+    try:
+        data = request.get_json(silent=True) or {}
+        keypoints_list = data.get('keypoints_list')
+        analysis_modes = data.get('analysis_modes') or [data.get('analysis_mode', 'set')]
+        front_leg = data.get('front_leg', 'auto')
+        
+        if not isinstance(keypoints_list, list) or not keypoints_list:
+            return jsonify({'error': '関節点データがありません'}), 400
+        if len(keypoints_list) > app.config['MAX_BATCH_ITEMS']:
+            return jsonify({'error': f"一度に分析できるのは{app.config['MAX_BATCH_ITEMS']}件までです"}), 413
+        if not all(isinstance(keypoints, dict) for keypoints in keypoints_list):
+            return jsonify({'error': '関節点データの形式が正しくありません'}), 400
+        if not isinstance(analysis_modes, list):
+            analysis_modes = [analysis_modes]
+        if front_leg not in FRONT_LEG_OPTIONS:
+            return jsonify({'error': 'front_leg は auto / left / right のいずれかです'}), 400
         
-        result = analyze_crouch_angles(keypoints, analysis_mode)
-        print(f"✅ 分析完了: {result}")
-        return jsonify({'success': True, **result})
+        with stage_timer('angle_analysis'):
+            results = analyze_crouch_angles_batch(keypoints_list, analysis_modes, front_leg)
+        return timed_jsonify({'success': True, 'count': len(keypoints_list), 'results': results})
         
     except Exception as e:
-        print(f"⚠️ 分析エラー: {str(e)}")
-        traceback.print_exc()
+        metrics.inc('crouch_errors_total', stage='angle_analysis')
+        logger.exception('Batch analysis failed')
         return jsonify({'error': f'分析中にエラーが発生しました: {str(e)}'}), 500
 
+sock = Sock(app) if Sock is not None else None
+LIVE_AVAILABLE = sock is not None
+
+def analyze_live_frame(tracker, regions, data, analysis_mode, front_leg):
+    """ライブカメラの1フレームを推定・分析する（regions があれば前のフレームの選手の周囲だけを推定する）"""
+    img = open_image(data, app.config['MAX_IMAGE_PIXELS'])
+    with img:
+        width, height = img.size
+        box = regions.pixel_box(width, height) if regions else None
+        with stage_timer('decode'):
+            image = decode_for_pose(img.crop(box) if box else img, app.config['LIVE_INPUT_SIZE'])
+    with stage_timer('live_tracking'):
+        landmarks = tracker.detect(image)
+    if landmarks and box:
+        landmarks = to_full_frame(landmarks, box, width, height)
+    if regions:
+        regions.update(landmarks)
+    if not landmarks:
+        return {'detected': False, 'image_width': width, 'image_height': height}
+    keypoints = landmarks_to_keypoints(landmarks, MEDIAPIPE_TO_FRONTEND, width, height)
+    with stage_timer('angle_analysis'):
+        angles = analyze_crouch_angles(keypoints, analysis_mode, front_leg)
+    return {'detected': True, 'image_width': width, 'image_height': height, 'keypoints': keypoints, 'angles': angles}
+
+def live_session(ws):
+    """ライブカメラのセッション
+
+    ブラウザはJPEGのフレームをバイナリメッセージで送り、設定の変更はJSONのテキストメッセージで送る
+    （{"analysis_mode": "set", "front_leg": "auto"}）。サーバーはフレームごとに関節点と角度をJSONで返す。
+    受信は別スレッドで行い、推論中に届いたフレームは最新の1枚だけを残して捨てる。
+    """
+    if not MEDIAPIPE_AVAILABLE:
+        ws.send(json.dumps({'type': 'error', 'error': 'ライブカメラにはAI姿勢推定（MediaPipe）が必要です'}))
+        return
+    try:
+        tracker = get_pose_pool().open_tracker(model_complexity=app.config['LIVE_MODEL_COMPLEXITY'])
+    except PoseTrackerLimitError as e:
+        ws.send(json.dumps({'type': 'error', 'error': str(e)}))
+        return
+    except PoseWorkerError as e:
+        logger.warning('Failed to start live tracker', extra={'error': str(e)})
+        ws.send(json.dumps({'type': 'error', 'error': '姿勢推定を開始できませんでした'}))
+        return
+    
+    frames = LatestFrame()
+    regions = RegionTracker(app.config['ROI_PADDING']) if app.config['ROI_ENABLED'] else None
+    settings = {'analysis_mode': 'set', 'front_leg': 'auto'}
+    
+    def receive():
+        try:
+            while True:
+                message = ws.receive(timeout=app.config['LIVE_IDLE_TIMEOUT'])
+                if message is None:
+                    break
+                if isinstance(message, str):
+                    try:
+                        update = json.loads(message)
+                    except ValueError:
+                        continue
+                    if update.get('analysis_mode') in metric_engine.definitions:
+                        settings['analysis_mode'] = update['analysis_mode']
+                    if update.get('front_leg') in FRONT_LEG_OPTIONS:
+                        settings['front_leg'] = update['front_leg']
+                elif len(message) <= app.config['LIVE_MAX_FRAME_BYTES']:
+                    frames.put(message)
+                else:
+                    metrics.inc('crouch_live_frames_total', outcome='invalid')
+        except ConnectionClosed:
+            pass
+        finally:
+            frames.close()
+    
+    receiver = threading.Thread(target=receive, name='live-receive', daemon=True)
+    receiver.start()
+    logger.info('Live session started')
+    dropped = 0
+    try:
+        while True:
+            frame = frames.get()
+            if frame is None:
+                break
+            data, received_at = frame
+            metrics.inc('crouch_live_frames_total', frames.dropped - dropped, outcome='dropped')
+            dropped = frames.dropped
+            try:
+                result = analyze_live_frame(tracker, regions, data, settings['analysis_mode'], settings['front_leg'])
+            except (UnidentifiedImageError, ImageTooLargeError, OSError):
+                metrics.inc('crouch_live_frames_total', outcome='invalid')
+                ws.send(json.dumps({'type': 'error', 'error': 'フレームを読み込めませんでした'}))
+                continue
+            metrics.inc('crouch_live_frames_total', outcome='processed' if result['detected'] else 'no_pose')
+            ws.send(json.dumps({
+                'type': 'result',
+                **result,
+                'analysis_mode': settings['analysis_mode'],
+                'received': frames.received,
+                'dropped': dropped,
+                'processing_ms': round((time.monotonic() - received_at) * 1000, 1)
+            }))
+    except ConnectionClosed:
+        pass
+    except PoseWorkerError as e:
+        metrics.inc('crouch_errors_total', stage='live_tracking')
+        logger.warning('Live tracking failed', extra={'error': str(e)})
+        try:
+            ws.send(json.dumps({'type': 'error', 'error': f'姿勢推定中にエラーが発生しました: {str(e)}'}))
+        except ConnectionClosed:
+            pass
+    finally:
+        frames.close()
+        tracker.close()
+        logger.info('Live session ended', extra={'frames': frames.received, 'dropped': frames.dropped})
+
+if LIVE_AVAILABLE:
+    sock.route('/live')(live_session)
+
+@app.route('/api/metric-sets')
+def metric_sets():
+    """利用できる分析モードと角度指標の定義"""
+    return jsonify({'success': True, 'metric_sets': metric_engine.definitions})
+
+def parse_reference_keypoints(data):
+    """基準姿勢APIのリクエストから関節点と分析モードを取り出す（不正なら (None, None, エラーレスポンス)）"""
+    keypoints = data.get('keypoints')
+    analysis_type = data.get('analysis_type') or None
+    if not isinstance(keypoints, dict) or not keypoints:
+        return None, None, (jsonify({'error': '関節点データがありません'}), 400)
+    if analysis_type is not None and analysis_type not in metric_engine.definitions:
+        return None, None, (jsonify({'error': f"analysis_type は {' / '.join(metric_engine.definitions)} のいずれかです"}), 400)
+    return keypoints, analysis_type, None
+
+@app.route('/api/references', methods=['POST'])
+def add_reference():
+    """基準姿勢をライブラリに追加する"""
+    data = request.get_json(silent=True) or {}
+    keypoints, analysis_type, error = parse_reference_keypoints(data)
+    if error:
+        return error
+    label = clean_label(data.get('label'))
+    if not label:
+        return jsonify({'error': 'label（基準姿勢の名前）を指定してください'}), 400
+    try:
+        reference_id = reference_index.add(
+            keypoints, label,
+            athlete=clean_label(data.get('athlete')),
+            analysis_type=analysis_type or 'set',
+            source=clean_label(data.get('source'))
+        )
+    except InvalidPoseError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'success': True, 'reference_id': reference_id, 'reference_url': f'/api/references/{reference_id}'}), 201
+
+@app.route('/api/references/search', methods=['POST'])
+def search_references():
+    """関節点に最も近い基準姿勢を返す（位置・大きさ・撮影した側によらない比較）"""
+    data = request.get_json(silent=True) or {}
+    keypoints, analysis_type, error = parse_reference_keypoints(data)
+    if error:
+        return error
+    k = data.get('k', 5)
+    if not isinstance(k, int) or not 1 <= k <= app.config['MAX_REFERENCE_MATCHES']:
+        return jsonify({'error': f"k は1〜{app.config['MAX_REFERENCE_MATCHES']}の整数です"}), 400
+    try:
+        with stage_timer('reference_search'):
+            matches = reference_index.search(keypoints, k, analysis_type=analysis_type, np=load_numpy())
+    except InvalidPoseError as e:
+        return jsonify({'error': str(e)}), 400
+    return timed_jsonify({'success': True, 'count': len(matches), 'matches': matches})
+
+@app.route('/api/references/<reference_id>', methods=['GET', 'DELETE'])
+def reference_detail(reference_id):
+    """基準姿勢の取得・削除"""
+    if request.method == 'DELETE':
+        if not reference_index.delete(reference_id):
+            return jsonify({'error': '基準姿勢が見つかりません'}), 404
+        return jsonify({'success': True})
+    reference = reference_index.get(reference_id)
+    if reference is None:
+        return jsonify({'error': '基準姿勢が見つかりません'}), 404
+    return jsonify({'success': True, **reference})
+
+def parse_float_list(value, default):
+    """カンマ区切りの数値（不正ならNone）"""
+    if not value:
+        return list(default)
+    try:
+        return [float(item) for item in value.split(',') if item.strip()]
+    except ValueError:
+        return None
+
+@app.route('/api/athletes/<athlete>/history')
+@app.route('/api/athletes/<athlete>/history/<any(rolling, percentiles, trend):aggregate>')
+def athlete_history_view(athlete, aggregate='summary'):
+    """選手の角度の履歴の集計（mode / metrics / since / until で絞り込み）
+
+    summary は件数・平均・最新値、rolling は移動平均（window 件、points 点まで）、
+    percentiles はパーセンタイル（q）、trend は回帰直線（1日あたりの変化）。
+    """
+    if not HISTORY_AVAILABLE:
+        return jsonify({'error': '履歴の集計にはNumPyが必要です'}), 503
+    athlete = clean_label(athlete)
+    mode = request.args.get('mode', 'set')
+    if not athlete:
+        return jsonify({'error': '選手名を指定してください'}), 400
+    if mode not in metric_engine.definitions:
+        return jsonify({'error': f"mode は {' / '.join(metric_engine.definitions)} のいずれかです"}), 400
+    window = request.args.get('window', 10, type=int)
+    points = request.args.get('points', 200, type=int)
+    quantiles = parse_float_list(request.args.get('q'), (10, 25, 50, 75, 90))
+    if not 1 <= window <= 10000 or not 1 <= points <= 2000:
+        return jsonify({'error': 'window は1〜10000、points は1〜2000です'}), 400
+    if not quantiles or not all(0 <= q <= 100 for q in quantiles):
+        return jsonify({'error': 'q は0〜100のカンマ区切りの数値です'}), 400
+
+    recorded = history_store.metrics(athlete, mode)
+    requested = request.args.get('metrics')
+    names = [name for name in requested.split(',') if name in recorded] if requested else recorded
+    with stage_timer('history_query'):
+        loaded = history_store.columns(
+            athlete, mode, names,
+            since=request.args.get('since', type=float),
+            until=request.args.get('until', type=float)
+        )
+        results = {}
+        sessions = 0
+        if loaded is not None:
+            timestamps, columns = loaded
+            sessions = len(timestamps)
+            for name, values in columns.items():
+                if aggregate == 'rolling':
+                    results[name] = athlete_history.rolling_mean(timestamps, values, window, points)
+                elif aggregate == 'percentiles':
+                    results[name] = athlete_history.percentiles(values, quantiles)
+                elif aggregate == 'trend':
+                    results[name] = athlete_history.trend(timestamps, values)
+                else:
+                    results[name] = athlete_history.summarize(timestamps, values)
+    return timed_jsonify({
+        'success': True,
+        'athlete': athlete,
+        'mode': mode,
+        'aggregate': aggregate,
+        'sessions': sessions,
+        'metrics': results
+    })
+
+# 内容が変わらないファイルのキャッシュ期間（1年）
+CACHE_MAX_AGE = 31536000
+# 共有ページのキャッシュ期間（画像の保存期間が過ぎると内容が変わるため短くする）
+SHARE_PAGE_MAX_AGE = 300
+MEDIA_KINDS = ('thumb', 'preview')
+_CONTENT_ADDRESSED = re.compile(r'[0-9a-f]{64}\.[a-z0-9]+')
+
+def is_content_addressed(filename):
+    """内容ハッシュのファイル名か（内容が変わらないため長期キャッシュできる）"""
+    return _CONTENT_ADDRESSED.fullmatch(filename) is not None
+
+def upload_filename(image_url):
+    """/static/uploads/<ファイル名> のURLからファイル名を取り出す"""
+    prefix = '/static/uploads/'
+    if not image_url or not image_url.startswith(prefix):
+        return None
+    return image_url[len(prefix):]
+
+def issued_upload(image_url):
+    """このサーバーが発行したアップロードのURLならファイル名を返す（それ以外はNone）"""
+    filename = upload_filename(image_url) if isinstance(image_url, str) else None
+    if not filename or not is_content_addressed(filename):
+        return None
+    return filename
+
+def media_urls(filename):
+    """アップロード画像のサムネイルとプレビューのURL"""
+    if not is_content_addressed(filename):
+        return {}
+    return {
+        'thumbnail_url': f'/media/thumb/{filename}?v={RESIZED_VERSION}',
+        'preview_url': f'/media/preview/{filename}?v={RESIZED_VERSION}'
+    }
+
+def send_cached_file(path, etag, mimetype):
+    """ディスク上の変更されないファイルを ETag / Last-Modified と長期キャッシュ付きで返す"""
+    response = send_file(os.path.abspath(path), mimetype=mimetype, conditional=True, etag=etag, max_age=CACHE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
+def resolve_upload(filename):
+    """アップロードのファイル名から保存先のパスを返し、最終アクセス時刻を更新する（無ければNone）"""
+    if not filename or not is_content_addressed(filename):
+        return None
+    path = upload_store.resolve(filename)
+    if path is not None:
+        upload_store.touch(filename)
+    return path
+
 @app.route('/static/uploads/<filename>')
 def uploaded_file(filename):
-    """アップロードされた画像を配信"""
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    """アップロードされた画像を配信（内容ハッシュのファイル名は長期キャッシュ）"""
+    if not is_content_addressed(filename):
+        # 内容ハッシュ方式より前のファイル名はフォルダ直下にある
+        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    path = resolve_upload(filename)
+    if path is None:
+        return jsonify({'error': '画像が見つかりません'}), 404
+    response = send_file(os.path.abspath(path), conditional=True, max_age=CACHE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/media/<kind>/<filename>')
+def media_derivative(kind, filename):
+    """アップロード画像のサムネイル（thumb）・プレビュー（preview）"""
+    source = resolve_upload(filename) if kind in MEDIA_KINDS and allowed_file(filename) else None
+    if source is None:
+        return jsonify({'error': '画像が見つかりません'}), 404
+    key = filename.rsplit('.', 1)[0]
+    try:
+        with stage_timer('derivative'):
+            path = derivative_store.resized(kind, source, key)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        metrics.inc('crouch_errors_total', stage='derivative')
+        logger.exception('Failed to render derivative', extra={'kind': kind, 'upload': filename})
+        return jsonify({'error': '画像を読み込めませんでした'}), 400
+    return send_cached_file(path, f'{kind}-{key}-v{RESIZED_VERSION}', 'image/jpeg')
+
+def shared_media(shared_analysis):
+    """共有ページ用に、プレビュー・オーバーレイのURLと元画像のサイズを加える"""
+    filename = issued_upload(shared_analysis.get('image_url'))
+    source = resolve_upload(filename)
+    if source is None:
+        # 保存期間を過ぎて削除された画像や、アップロード以外のURLは表示しない
+        return {**shared_analysis, 'image_url': None}
+    try:
+        with Image.open(source) as img:
+            width, height = oriented_size(img)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        return shared_analysis
+    return {
+        **shared_analysis,
+        **media_urls(filename),
+        'overlay_url': f"/share/{shared_analysis['analysis_id']}/overlay.png?v={OVERLAY_VERSION}",
+        'image_width': width,
+        'image_height': height
+    }
+
+def immutable_response(etag, build, max_age=None):
+    """変更されないリソースを ETag と長期キャッシュ付きで返す
+
+    If-None-Match が一致すれば build を呼ばずに304を返す。
+    max_age を渡すと immutable にせず、その秒数だけキャッシュする（期間後は ETag で再検証する）。
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = build()
+        if not isinstance(response, Response):
+            response = app.make_response(response)
+        if response.status_code != 200:
+            return response
+    response.set_etag(etag)
+    if max_age is None:
+        response.headers['Cache-Control'] = f'public, max-age={CACHE_MAX_AGE}, immutable'
+    else:
+        response.headers['Cache-Control'] = f'public, max-age={max_age}'
+    return response
 
 @app.route('/share/<analysis_id>')
 def share_analysis(analysis_id):
     """チーム共有用のURL"""
-    # 実際の実装では分析結果をデータベースに保存し、analysis_idで取得
-    # ここではデモ用に基本ページを返す
-    return render_template('index.html', shared_analysis_id=analysis_id)
+    shared_analysis = analysis_store.get(analysis_id)
+    if shared_analysis is None:
+        return render_template('index.html', shared_analysis_id=analysis_id, shared_analysis=None), 404
+    
+    def build():
+        return render_template('index.html', shared_analysis_id=analysis_id, shared_analysis=shared_media(shared_analysis))
+    
+    # 画像が削除されるとページの内容が変わるため、画像の有無を ETag に含める
+    filename = issued_upload(shared_analysis.get('image_url'))
+    media = 'image' if filename and upload_store.resolve(filename) else 'no-image'
+    return immutable_response(f'share-{analysis_id}-{SHARE_PAGE_VERSION}-{media}', build, max_age=SHARE_PAGE_MAX_AGE)
+
+@app.route('/share/<analysis_id>/overlay.png')
+def share_overlay(analysis_id):
+    """共有する分析の骨格と角度を描画した画像"""
+    shared_analysis = analysis_store.get(analysis_id)
+    filename = issued_upload(shared_analysis.get('image_url')) if shared_analysis else None
+    source = resolve_upload(filename)
+    if source is None:
+        return jsonify({'error': '分析結果の画像が見つかりません'}), 404
+    
+    angles = shared_analysis['angles']
+    labels = [
+        (joints[1], f'{angles[name]}°')
+        for name, joints in metric_engine.metric_joints(shared_analysis['analysis_type'], angles.get('front_leg'))
+        if isinstance(angles.get(name), (int, float))
+    ]
+    try:
+        with stage_timer('derivative'):
+            path = derivative_store.overlay(source, filename.rsplit('.', 1)[0], analysis_id, shared_analysis['keypoints'], labels)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        metrics.inc('crouch_errors_total', stage='derivative')
+        logger.exception('Failed to render overlay', extra={'analysis_id': analysis_id})
+        return jsonify({'error': '画像を読み込めませんでした'}), 400
+    return send_cached_file(path, f'overlay-{analysis_id}-v{OVERLAY_VERSION}', 'image/png')
+
+@app.route('/api/analysis/<analysis_id>')
+def get_analysis(analysis_id):
+    """保存済み分析結果のJSON"""
+    def build():
+        shared_analysis = analysis_store.get(analysis_id)
+        if shared_analysis is None:
+            return jsonify({'error': '分析結果が見つかりません'}), 404
+        if issued_upload(shared_analysis.get('image_url')) is None:
+            shared_analysis['image_url'] = None
+        return jsonify(shared_analysis)
+    
+    return immutable_response(f'analysis-{analysis_id}-{APP_VERSION}', build)
+
+@app.route('/api/analyses')
+def list_analyses():
+    """保存済み分析の一覧（athlete / team / since / until で絞り込み）"""
+    try:
+        since = request.args.get('since', type=float)
+        until = request.args.get('until', type=float)
+        limit = min(request.args.get('limit', 50, type=int), 500)
+        analyses = analysis_store.search(
+            athlete=request.args.get('athlete'),
+            team=request.args.get('team'),
+            since=since,
+            until=until,
+            limit=limit
+        )
+        return jsonify({'success': True, 'count': len(analyses), 'analyses': analyses})
+    except Exception as e:
+        metrics.inc('crouch_errors_total', stage='analysis_store')
+        logger.exception('Failed to list analyses')
+        return jsonify({'error': f'一覧の取得中にエラーが発生しました: {str(e)}'}), 500
 
 @app.route('/simple-upload')
 def simple_upload_form():
@@ -354,6 +1418,11 @@ def simple_upload_form():
             <button type="submit">アップロード</button>
         </form>
         
+        <form action="/upload/video" method="post" enctype="multipart/form-data" target="result">
+            <input type="file" name="file" accept="video/*"><br><br>
+            <button type="submit">動画をアップロード</button>
+        </form>
+        
         <h3>レスポンス:</h3>
         <iframe name="result" style="width:100%;height:300px;"></iframe>
         
@@ -397,8 +1466,7 @@ def test_endpoint():
         })
         
     except Exception as e:
-        print(f"⚠️ API test error: {str(e)}")
-        traceback.print_exc()
+        logger.exception('API test failed')
         return jsonify({
             'status': 'error',
             'message': f'Test failed: {str(e)}',
@@ -413,12 +1481,23 @@ def health_check():
         'status': 'healthy',
         'dependencies_available': DEPENDENCIES_AVAILABLE,
         'mediapipe_available': MEDIAPIPE_AVAILABLE,
-        'version': '1.0.0',
+        'version': APP_VERSION,
         'features': {
             'manual_joint_setting': True,  # 常に利用可能
             'ai_pose_detection': MEDIAPIPE_AVAILABLE,
+            'video_analysis': MEDIAPIPE_AVAILABLE,
+            'live_camera': LIVE_AVAILABLE and MEDIAPIPE_AVAILABLE,
+            'reference_search': True,
+            'athlete_history': HISTORY_AVAILABLE,
             'angle_analysis': True  # numpy非依存の基本計算は常に利用可能
-        }
+        },
+        'pose_pool': pose_pool.status() if pose_pool is not None else {'started': False},
+        'pose_cache': pose_cache.stats(),
+        'admission': admission.status(),
+        'uploads': upload_store.stats(),
+        'references': reference_index.count(),
+        'jobs': job_queue.stats(),
+        'startup': STARTUP_INFO
     }
     
     if not DEPENDENCIES_AVAILABLE:
@@ -428,6 +1507,18 @@ def health_check():
     
     return jsonify(status_info)
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus形式のメトリクス（全gunicornワーカーの合算）"""
+    jobs = job_queue.stats()
+    body = metrics.render(extra_gauges=[
+        ('crouch_jobs', 'Asynchronous jobs by status.',
+         [({'status': 'queued'}, jobs['queued']), ({'status': 'running'}, jobs['running'])])
+    ])
+    response = Response(body, mimetype='text/plain; version=0.0.4')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
 @app.route('/debug')
 def debug_info():
     """デバッグ情報を表示"""
@@ -435,7 +1526,7 @@ def debug_info():
         'python_version': sys.version,
         'app_config': {
             'upload_folder': app.config['UPLOAD_FOLDER'],
-            'max_content_length': app.config['MAX_CONTENT_LENGTH']
+            'max_content_length': app.config['MAX_IMAGE_LENGTH']
         },
         'upload_folder_exists': os.path.exists(app.config['UPLOAD_FOLDER']),
         'upload_folder_writable': os.access(app.config['UPLOAD_FOLDER'], os.W_OK),
@@ -449,10 +1540,11 @@ def debug_info():
         }
     }
     
+    # フォルダは走査せず、索引の集計値を表示する
     try:
-        debug_data['upload_folder_contents'] = os.listdir(app.config['UPLOAD_FOLDER'])
-    except:
-        debug_data['upload_folder_contents'] = 'Error listing directory'
+        debug_data['upload_stats'] = upload_store.stats()
+    except sqlite3.Error:
+        debug_data['upload_stats'] = 'Error reading upload index'
     
     return render_template_string("""
     <!DOCTYPE html>
@@ -485,8 +1577,8 @@ def debug_info():
         </div>
         
         <div class="section">
-            <h2>アップロードフォルダの内容</h2>
-            <pre>{{ debug_data.upload_folder_contents }}</pre>
+            <h2>アップロードの保存状況</h2>
+            <pre>{{ debug_data.upload_stats }}</pre>
         </div>
         
         <div class="section">
@@ -508,7 +1600,21 @@ def debug_info():
     </html>
     """, debug_data=debug_data)
 
+# プリロードモード（gunicorn --preload）ではマスタープロセスで読み込んでおき、
+# フォークしたWebワーカー間でコピーオンライトで共有する
+if STARTUP_INFO['preloaded']:
+    load_numpy()
+
+STARTUP_INFO['import_seconds'] = round(time.perf_counter() - _IMPORT_STARTED, 3)
+logger.info('App loaded', extra={
+    'import_seconds': STARTUP_INFO['import_seconds'],
+    'ai_dependencies': DEPENDENCIES_AVAILABLE
+})
+
 if __name__ == '__main__':
     import os
     port = int(os.environ.get('PORT', 5000))
+    if MEDIAPIPE_AVAILABLE:
+        get_pose_pool()
+    job_queue.start()
     app.run(debug=False, host='0.0.0.0', port=port)
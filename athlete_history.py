@@ -0,0 +1,210 @@
+"""選手ごとの角度の履歴（列ごとの追記専用ファイル）
+
+選手・分析モードごとのディレクトリに、時刻（float64）と角度の指標ごと（float32、無い値はNaN）の
+バイナリファイルを1列1ファイルで追記する。集計はNumPyのmemmapで必要な期間の列だけを読み、
+移動平均・パーセンタイル・トレンドを配列演算で求める（履歴をPythonのオブジェクトにしない）。
+時刻の列は最後に書き、その長さを確定した行数とする（途中で止まった追記は次の追記時に切り詰める）。
+"""
+import os
+import json
+import math
+import time
+import hashlib
+import threading
+from array import array
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows では同じプロセス内の排他のみ
+    fcntl = None
+
+TIMESTAMP_FILE = 'timestamp.f8'
+METRIC_SUFFIX = '.f4'
+SECONDS_PER_DAY = 86400
+
+
+class HistoryStore:
+    """選手ごとの角度の履歴"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _athlete_dir(self, athlete):
+        # 選手名はファイル名に使えない文字を含みうるため、ハッシュをディレクトリ名にする
+        return os.path.join(self.directory, hashlib.sha1(athlete.encode('utf-8')).hexdigest()[:20])
+
+    def _mode_dir(self, athlete, mode):
+        return os.path.join(self._athlete_dir(athlete), mode)
+
+    @contextmanager
+    def _locked(self, athlete):
+        """選手ごとの追記の排他（gunicornワーカー間はファイルロック）"""
+        directory = self._athlete_dir(athlete)
+        os.makedirs(directory, exist_ok=True)
+        with self._lock, open(os.path.join(directory, '.lock'), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield directory
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def append(self, athlete, mode, values, timestamp=None):
+        """分析結果の数値の指標を1行追記する（時刻は単調増加にそろえる）"""
+        values = {
+            name: float(value) for name, value in values.items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)
+        }
+        if not values:
+            return
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._locked(athlete) as athlete_dir:
+            info_path = os.path.join(athlete_dir, 'athlete.json')
+            if not os.path.exists(info_path):
+                with open(info_path, 'w', encoding='utf-8') as f:
+                    json.dump({'athlete': athlete}, f, ensure_ascii=False)
+            directory = self._mode_dir(athlete, mode)
+            os.makedirs(directory, exist_ok=True)
+            timestamp_path = os.path.join(directory, TIMESTAMP_FILE)
+            rows = _file_rows(timestamp_path, 8)
+            if rows:
+                with open(timestamp_path, 'rb') as f:
+                    f.seek((rows - 1) * 8)
+                    last = array('d', f.read(8))[0]
+                timestamp = max(timestamp, last)
+
+            names = set(_metric_names(directory)) | set(values)
+            for name in sorted(names):
+                path = os.path.join(directory, name + METRIC_SUFFIX)
+                column_rows = _file_rows(path, 4)
+                with open(path, 'ab') as f:
+                    if column_rows > rows:
+                        # 時刻を書く前に止まった追記の残り
+                        f.truncate(rows * 4)
+                    elif column_rows < rows:
+                        # 新しい指標はそれまでの行をNaNで埋める
+                        array('f', [math.nan] * (rows - column_rows)).tofile(f)
+                    array('f', [values.get(name, math.nan)]).tofile(f)
+            with open(timestamp_path, 'ab') as f:
+                array('d', [timestamp]).tofile(f)
+
+    def metrics(self, athlete, mode):
+        """記録されている指標名"""
+        return sorted(_metric_names(self._mode_dir(athlete, mode)))
+
+    def count(self, athlete, mode):
+        return _file_rows(os.path.join(self._mode_dir(athlete, mode), TIMESTAMP_FILE), 8)
+
+    def columns(self, athlete, mode, names, since=None, until=None):
+        """期間内の (時刻の配列, {指標名: 値の配列}) をmemmapで返す（記録が無ければNone）"""
+        import numpy as np
+        directory = self._mode_dir(athlete, mode)
+        rows = self.count(athlete, mode)
+        if not rows:
+            return None
+        timestamps = np.memmap(os.path.join(directory, TIMESTAMP_FILE), dtype=np.float64, mode='r', shape=(rows,))
+        # 時刻は単調増加なので二分探索で期間の範囲を求める
+        start = 0 if since is None else int(np.searchsorted(timestamps, since, side='left'))
+        end = rows if until is None else int(np.searchsorted(timestamps, until, side='left'))
+        columns = {}
+        for name in names:
+            path = os.path.join(directory, name + METRIC_SUFFIX)
+            if _file_rows(path, 4) >= rows:
+                columns[name] = np.memmap(path, dtype=np.float32, mode='r', shape=(rows,))[start:end]
+        return timestamps[start:end], columns
+
+
+def _file_rows(path, itemsize):
+    try:
+        return os.path.getsize(path) // itemsize
+    except FileNotFoundError:
+        return 0
+
+
+def _metric_names(directory):
+    try:
+        return [name[:-len(METRIC_SUFFIX)] for name in os.listdir(directory) if name.endswith(METRIC_SUFFIX)]
+    except FileNotFoundError:
+        return []
+
+
+def _round(value, digits=2):
+    return None if value is None or not math.isfinite(value) else round(float(value), digits)
+
+
+def summarize(timestamps, values):
+    """件数・平均・標準偏差・最小・最大・最新値"""
+    import numpy as np
+    valid = np.isfinite(values)
+    count = int(valid.sum())
+    if not count:
+        return {'count': 0}
+    finite = values[valid]
+    last = int(np.flatnonzero(valid)[-1])
+    return {
+        'count': count,
+        'mean': _round(finite.mean(dtype=np.float64)),
+        'std': _round(finite.std(dtype=np.float64)),
+        'min': _round(finite.min()),
+        'max': _round(finite.max()),
+        'latest': _round(values[last]),
+        'latest_at': float(timestamps[last]),
+        'first_at': float(timestamps[int(np.flatnonzero(valid)[0])])
+    }
+
+
+def percentiles(values, quantiles):
+    """値のパーセンタイル（quantiles は0〜100）"""
+    import numpy as np
+    finite = values[np.isfinite(values)]
+    if not finite.size:
+        return {}
+    results = np.percentile(finite.astype(np.float64), quantiles)
+    return {f'p{q:g}': _round(result) for q, result in zip(quantiles, results)}
+
+
+def rolling_mean(timestamps, values, window, max_points):
+    """直近 window 件（NaNを除く）の移動平均の系列（max_points 点以下に間引く）"""
+    import numpy as np
+    valid = np.isfinite(values)
+    finite = values[valid].astype(np.float64)
+    times = timestamps[valid]
+    if not finite.size:
+        return []
+    sums = np.cumsum(finite)
+    windowed = sums.copy()
+    windowed[window:] -= sums[:-window]
+    counts = np.minimum(np.arange(1, finite.size + 1), window)
+    means = windowed / counts
+    indices = np.unique(np.linspace(0, finite.size - 1, min(max_points, finite.size)).round().astype(np.int64))
+    return [{'timestamp': float(times[i]), 'value': _round(means[i]), 'samples': int(counts[i])} for i in indices]
+
+
+def trend(timestamps, values):
+    """最小二乗法の回帰直線（傾きは1日あたりの変化）"""
+    import numpy as np
+    valid = np.isfinite(values)
+    if valid.sum() < 2:
+        return None
+    y = values[valid].astype(np.float64)
+    days = (timestamps[valid] - timestamps[valid][0]) / SECONDS_PER_DAY
+    x_mean, y_mean = days.mean(), y.mean()
+    dx = days - x_mean
+    variance = float(np.dot(dx, dx))
+    if variance == 0:
+        return None
+    slope = float(np.dot(dx, y - y_mean)) / variance
+    intercept = y_mean - slope * x_mean
+    residual = y - (intercept + slope * days)
+    total = float(np.dot(y - y_mean, y - y_mean))
+    return {
+        'slope_per_day': _round(slope, 4),
+        'start_value': _round(intercept),
+        'end_value': _round(intercept + slope * days[-1]),
+        'r2': _round(1 - float(np.dot(residual, residual)) / total, 4) if total else None,
+        'samples': int(valid.sum())
+    }
@@ -0,0 +1,170 @@
+"""ベンチマークとロードテストの共通処理
+
+アプリの読み込み（キャッシュ・DB・アップロード先を一時ディレクトリに切り替え）、
+合成画像の生成、パーセンタイル計算、ベースラインJSONの保存・比較を行う。
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import platform
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 比較する指標と「大きいほど良いか」
+COMPARED_METRICS = {
+    'median': False,
+    'p95': False,
+    'p99': False,
+    'rps': True
+}
+
+
+def load_app(workdir=None):
+    """一時ディレクトリを作業場所にしてアプリを読み込む
+
+    アップロード・キャッシュ・DBをすべて一時ディレクトリに置くため、計測が既存データの影響を受けず、
+    リポジトリも汚さない。戻り値は (appモジュール, 作業ディレクトリ)。
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix='crouch-bench-')
+    os.environ.setdefault('POSE_CACHE_DIR', os.path.join(workdir, 'pose'))
+    os.environ.setdefault('JOB_DB', os.path.join(workdir, 'jobs.sqlite3'))
+    os.environ.setdefault('ANALYSIS_DB', os.path.join(workdir, 'analyses.sqlite3'))
+    os.environ.setdefault('METRICS_DIR', os.path.join(workdir, 'metrics'))
+    os.environ.setdefault('DERIVATIVE_DIR', os.path.join(workdir, 'derivatives'))
+    os.environ.setdefault('UPLOAD_FOLDER', os.path.join(workdir, 'uploads'))
+    os.environ.setdefault('UPLOAD_INDEX_DB', os.path.join(workdir, 'uploads.sqlite3'))
+    os.environ.setdefault('REFERENCE_DB', os.path.join(workdir, 'references.sqlite3'))
+    os.environ.setdefault('HISTORY_DIR', os.path.join(workdir, 'history'))
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    try:
+        import app as app_module
+    finally:
+        os.chdir(cwd)
+    return app_module, workdir
+
+
+def synthetic_keypoints(count, seed=0):
+    """クラウチング姿勢らしい関節点をランダムに生成する（シード固定で再現可能）"""
+    rng = random.Random(seed)
+    base = {
+        'C7': (200, 50), 'LShoulder': (150, 100), 'RShoulder': (250, 100),
+        'LHip': (170, 200), 'RHip': (230, 200), 'LKnee': (180, 300),
+        'RKnee': (220, 300), 'LAnkle': (190, 400), 'RAnkle': (210, 400)
+    }
+    return [
+        {name: {'x': x + rng.randint(-40, 40), 'y': y + rng.randint(-40, 40)} for name, (x, y) in base.items()}
+        for _ in range(count)
+    ]
+
+
+def synthetic_jpeg(width, height, seed=0, quality=90):
+    """写真に近い（グラデーションとノイズのある）JPEGのバイト列を生成する"""
+    from PIL import Image
+    rng = random.Random(seed)
+    gradient = Image.linear_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    img = Image.merge('RGB', (gradient, noise, gradient.rotate(rng.choice((90, 180, 270)), expand=False)))
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def unique_payload(data, counter):
+    """JPEGの終端の後ろにバイトを足して、デコード結果は同じで内容ハッシュだけが異なるデータを作る
+
+    アップロードは内容ハッシュで保存・キャッシュされるため、毎回キャッシュされていない状態を計測するのに使う。
+    """
+    return data + counter.to_bytes(8, 'big')
+
+
+def percentile(sorted_values, q):
+    """ソート済みの値から線形補間でパーセンタイルを求める"""
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def latency_summary(latencies):
+    """レイテンシのリスト（秒）の統計"""
+    values = sorted(latencies)
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else None,
+        'min': values[0] if values else None,
+        'median': percentile(values, 50),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': values[-1] if values else None
+    }
+
+
+def environment_info(app_module=None):
+    """計測環境（ベースラインの比較時に環境の違いを確認するため）"""
+    info = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count()
+    }
+    try:
+        import numpy
+        info['numpy'] = numpy.__version__
+    except ImportError:
+        info['numpy'] = None
+    if app_module is not None:
+        info['app_version'] = app_module.APP_VERSION
+        info['ai_dependencies'] = app_module.DEPENDENCIES_AVAILABLE
+    return info
+
+
+def save_results(path, results, environment):
+    """結果をJSONで保存する"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'environment': environment, 'results': results}, f, ensure_ascii=False, indent=2)
+
+
+def compare_results(results, baseline_path, threshold):
+    """ベースラインと比較し、threshold（割合）を超えて悪化した項目のリストを返す"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            before = previous.get(metric)
+            after = current.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append({'name': name, 'metric': metric, 'baseline': before, 'current': after, 'change': change})
+    return regressions
+
+
+def print_regressions(regressions, threshold):
+    """比較結果を表示し、悪化があれば True を返す"""
+    if not regressions:
+        print(f'\nベースラインからの悪化なし（しきい値 {threshold:.0%}）')
+        return False
+    print(f'\n⚠️ ベースラインから {threshold:.0%} を超えて悪化した項目:')
+    for item in regressions:
+        print(f"  {item['name']} {item['metric']}: {item['baseline']:.6g} → {item['current']:.6g} ({item['change']:+.1%})")
+    return True
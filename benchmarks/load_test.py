@@ -0,0 +1,220 @@
+"""同時リクエストの負荷試験
+
+使い方:
+    # アプリをプロセス内で読み込み、Flaskテストクライアントで負荷をかける
+    python benchmarks/load_test.py --scenario analyze --concurrency 8 --requests 2000
+    # 起動済みのサーバー（gunicorn など）に負荷をかける
+    python benchmarks/load_test.py --url http://localhost:5000 --scenario upload --concurrency 4 --duration 30
+
+レイテンシの p50/p95/p99 と1秒あたりのリクエスト数を表示する。
+--save で結果をJSONに保存し、--compare で保存済みのベースラインと比較する（悪化があれば終了コード1）。
+"""
+import io
+import sys
+import json
+import time
+import uuid
+import shutil
+import argparse
+import threading
+import urllib.error
+import urllib.request
+
+import common
+
+SCENARIOS = ('analyze', 'batch', 'upload')
+
+
+class Scenario:
+    """シナリオごとのリクエスト内容（シード固定で生成）"""
+
+    def __init__(self, name, image_size, batch_size):
+        self.name = name
+        self.keypoints = common.synthetic_keypoints(256, seed=2)
+        self.batch_size = batch_size
+        if name == 'upload':
+            self.image = common.synthetic_jpeg(*image_size, seed=3)
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def next_index(self):
+        with self._lock:
+            self._counter += 1
+            return self._counter
+
+    def request(self):
+        """(パス, JSON本体 または None, アップロードするバイト列 または None)"""
+        index = self.next_index()
+        if self.name == 'analyze':
+            mode = 'set' if index % 2 else 'takeoff'
+            return '/analyze', {'keypoints': self.keypoints[index % len(self.keypoints)], 'analysis_mode': mode}, None
+        if self.name == 'batch':
+            start = index % len(self.keypoints)
+            items = [self.keypoints[(start + i) % len(self.keypoints)] for i in range(self.batch_size)]
+            return '/analyze/batch', {'keypoints_list': items, 'analysis_modes': ['set', 'takeoff']}, None
+        # 毎回異なる内容にして、キャッシュされていないアップロードを計測する
+        return '/upload', None, common.unique_payload(self.image, index)
+
+
+class TestClientTarget:
+    """プロセス内のFlaskテストクライアントに送る"""
+
+    def __init__(self, app_module):
+        self.app = app_module.app
+        self._local = threading.local()
+
+    def send(self, path, body, upload):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        if upload is not None:
+            response = client.post(path, data={'file': (io.BytesIO(upload), 'load.jpg')})
+        else:
+            response = client.post(path, json=body)
+        return response.status_code
+
+
+class HttpTarget:
+    """起動済みのサーバーにHTTPで送る"""
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def send(self, path, body, upload):
+        if upload is not None:
+            boundary = uuid.uuid4().hex
+            data = (
+                f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="load.jpg"\r\n'
+                f'Content-Type: image/jpeg\r\n\r\n'
+            ).encode() + upload + f'\r\n--{boundary}--\r\n'.encode()
+            content_type = f'multipart/form-data; boundary={boundary}'
+        else:
+            data = json.dumps(body).encode()
+            content_type = 'application/json'
+        req = urllib.request.Request(self.base_url + path, data=data, headers={'Content-Type': content_type})
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+
+def run_load(target, scenario, concurrency, total_requests=None, duration=None):
+    """同時実行数 concurrency でリクエストを送り、レイテンシとステータスを集める"""
+    latencies = []
+    statuses = {}
+    errors = []
+    lock = threading.Lock()
+    remaining = [total_requests]
+    deadline = time.perf_counter() + duration if duration else None
+
+    def take():
+        if deadline is not None:
+            return time.perf_counter() < deadline
+        with lock:
+            if remaining[0] <= 0:
+                return False
+            remaining[0] -= 1
+            return True
+
+    def worker():
+        while take():
+            path, body, upload = scenario.request()
+            started = time.perf_counter()
+            try:
+                status = target.send(path, body, upload)
+            except Exception as e:
+                status = 'exception'
+                with lock:
+                    errors.append(str(e))
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    summary = common.latency_summary(latencies)
+    summary['unit'] = 'seconds'
+    summary['concurrency'] = concurrency
+    summary['wall_seconds'] = wall
+    summary['rps'] = len(latencies) / wall if wall > 0 else None
+    summary['statuses'] = {str(key): value for key, value in statuses.items()}
+    summary['failed'] = sum(value for key, value in statuses.items() if key == 'exception' or key >= 400)
+    if errors:
+        summary['sample_error'] = errors[0]
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='同時リクエストの負荷試験')
+    parser.add_argument('--url', help='対象サーバーのURL（省略時はプロセス内のテストクライアント）')
+    parser.add_argument('--scenario', choices=SCENARIOS, default='analyze')
+    parser.add_argument('--concurrency', '-c', type=int, default=8)
+    parser.add_argument('--requests', '-n', type=int, default=1000, help='送信するリクエスト数')
+    parser.add_argument('--duration', type=float, help='指定した秒数だけ送り続ける（--requests より優先）')
+    parser.add_argument('--warmup', type=int, default=10, help='計測前に送るリクエスト数')
+    parser.add_argument('--image-size', default='1920x1080', help='upload シナリオの画像サイズ（幅x高さ）')
+    parser.add_argument('--batch-size', type=int, default=100, help='batch シナリオの1リクエストあたりの件数')
+    parser.add_argument('--timeout', type=float, default=60, help='HTTPリクエストのタイムアウト（秒）')
+    parser.add_argument('--save', metavar='PATH', help='結果をJSONで保存する')
+    parser.add_argument('--compare', metavar='PATH', help='ベースラインJSONと比較する')
+    parser.add_argument('--threshold', type=float, default=0.15, help='悪化とみなす割合（既定: 0.15 = 15%%）')
+    args = parser.parse_args(argv)
+
+    width, height = (int(value) for value in args.image_size.lower().split('x'))
+    scenario = Scenario(args.scenario, (width, height), args.batch_size)
+
+    app_module = workdir = None
+    if args.url:
+        target = HttpTarget(args.url, args.timeout)
+    else:
+        app_module, workdir = common.load_app()
+        if app_module.MEDIAPIPE_AVAILABLE:
+            app_module.get_pose_pool()
+        target = TestClientTarget(app_module)
+
+    try:
+        if args.warmup:
+            run_load(target, scenario, min(args.concurrency, args.warmup), total_requests=args.warmup)
+        summary = run_load(target, scenario, args.concurrency, total_requests=args.requests, duration=args.duration)
+
+        print(f"\nシナリオ: {args.scenario}  同時実行数: {args.concurrency}  対象: {args.url or 'テストクライアント'}")
+        print(f"リクエスト数: {summary['count']}  失敗: {summary['failed']}  ステータス: {summary['statuses']}")
+        print(f"スループット: {'n/a' if summary['rps'] is None else format(summary['rps'], '.1f') + ' req/s'}")
+        for key in ('p50', 'p95', 'p99', 'max'):
+            # 完了したリクエストが無ければパーセンタイルは None
+            value = 'n/a' if summary[key] is None else f'{summary[key] * 1000:.2f} ms'
+            print(f"{key:>4}: {value}")
+        if 'sample_error' in summary:
+            print(f"エラー例: {summary['sample_error']}")
+
+        name = f'load[{args.scenario},c={args.concurrency}]'
+        results = {name: summary}
+        environment = common.environment_info(app_module)
+        environment['target'] = args.url or 'test_client'
+        if args.save:
+            common.save_results(args.save, results, environment)
+            print(f'\n結果を保存しました: {args.save}')
+        if args.compare:
+            regressions = common.compare_results(results, args.compare, args.threshold)
+            if common.print_regressions(regressions, args.threshold):
+                return 1
+        return 1 if summary['failed'] else 0
+    finally:
+        if app_module is not None:
+            if app_module.pose_pool is not None:
+                app_module.pose_pool.shutdown()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""角度計算・分析・画像アップロードのベンチマーク
+
+使い方:
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --save benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --compare benchmarks/baseline.json --threshold 0.15
+
+各ケースは timeit と同様に「number 回の実行」を repeat 回繰り返し、1回あたりの時間（秒）の
+最小値・中央値を記録する。入力はシード固定で生成するため、同じ環境なら同じ条件で計測できる。
+ベースラインとの比較で悪化があれば終了コード1を返す。
+"""
+import gc
+import io
+import sys
+import time
+import shutil
+import itertools
+import argparse
+import statistics
+from contextlib import contextmanager
+
+import common
+
+RESOLUTIONS = [(640, 480), (1920, 1080), (4032, 3024)]
+
+
+def measure(func, number, repeat, warmup=1):
+    """func を number 回実行する計測を repeat 回行い、1回あたりの秒数を返す"""
+    for _ in range(warmup):
+        func()
+    timings = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            for _ in range(number):
+                func()
+            timings.append((time.perf_counter() - started) / number)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return {
+        'unit': 'seconds/op',
+        'number': number,
+        'repeat': repeat,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'max': max(timings)
+    }
+
+
+@contextmanager
+def numpy_mode(app_module, enabled):
+    """calculate_angle と metric_engine の一括計算の NumPy 経路と基本計算経路を切り替える"""
+    saved = app_module.DEPENDENCIES_AVAILABLE, app_module.NUMPY_AVAILABLE, app_module.np
+    try:
+        if enabled:
+            import numpy
+            app_module.DEPENDENCIES_AVAILABLE, app_module.NUMPY_AVAILABLE, app_module.np = True, True, numpy
+        else:
+            app_module.NUMPY_AVAILABLE, app_module.np = False, None
+        yield
+    finally:
+        app_module.DEPENDENCIES_AVAILABLE, app_module.NUMPY_AVAILABLE, app_module.np = saved
+
+
+def angle_cases(app_module, scale):
+    """calculate_angle と analyze_crouch_angles の計測
+
+    analyze_crouch_angles は1件ずつ metric_engine で計算し NumPy を使わないため、経路を分けずに計測する。
+    NumPy の有無で経路が変わる calculate_angle と analyze_crouch_angles_batch は両方の経路を計測する。
+    """
+    keypoints = common.synthetic_keypoints(1000, seed=1)
+    triples = [
+        ([k['LHip']['x'], k['LHip']['y']], [k['LKnee']['x'], k['LKnee']['y']], [k['LAnkle']['x'], k['LAnkle']['y']])
+        for k in keypoints
+    ]
+    modes = [('math', False)]
+    try:
+        import numpy  # noqa: F401
+        modes.append(('numpy', True))
+    except ImportError:
+        print('NumPyが無いため NumPy 経路の計測を省略します')
+
+    results = {}
+    for mode in ('set', 'takeoff'):
+        results[f'analyze_crouch_angles[{mode}]'] = measure(
+            lambda: [app_module.analyze_crouch_angles(k, mode) for k in keypoints[:100]], 5 * scale, 5
+        )
+        results[f'analyze_crouch_angles[{mode}]']['items_per_op'] = 100
+
+    batch = keypoints * 10
+    for label, enabled in modes:
+        with numpy_mode(app_module, enabled):
+            cycle = itertools.cycle(triples)
+
+            def angle():
+                a, b, c = next(cycle)
+                app_module.calculate_angle(a, b, c)
+
+            results[f'calculate_angle[{label}]'] = measure(angle, 2000 * scale, 5)
+            results[f'analyze_crouch_angles_batch[10000,{label}]'] = measure(
+                lambda: app_module.analyze_crouch_angles_batch(batch, ('set', 'takeoff')), scale, 5
+            )
+    return results
+
+
+def upload_cases(app_module, scale, cached):
+    """Flaskテストクライアント経由の /upload の計測（解像度別）"""
+    client = app_module.app.test_client()
+    results = {}
+    for width, height in RESOLUTIONS:
+        data = common.synthetic_jpeg(width, height, seed=width)
+        counter = iter(range(10 ** 9))
+        ai_used = []
+
+        def upload():
+            payload = data if cached else common.unique_payload(data, next(counter))
+            response = client.post('/upload', data={'file': (io.BytesIO(payload), 'bench.jpg')})
+            if response.status_code != 200:
+                raise RuntimeError(f'/upload が {response.status_code} を返しました: {response.get_data(as_text=True)}')
+            ai_used.append(response.get_json()['ai_detection_used'])
+
+        name = f"upload[{width}x{height}{',cached' if cached else ''}]"
+        results[name] = measure(upload, max(1, 3 * scale), 5)
+        results[name]['bytes'] = len(data)
+        results[name]['ai_detection_used'] = any(ai_used)
+    return results
+
+
+def print_table(results):
+    print(f"\n{'ケース':<44} {'中央値':>12} {'最小':>12}")
+    for name, result in results.items():
+        print(f"{name:<44} {format_seconds(result['median']):>12} {format_seconds(result['min']):>12}")
+
+
+def format_seconds(value):
+    if value < 1e-3:
+        return f'{value * 1e6:.2f} µs'
+    if value < 1:
+        return f'{value * 1e3:.2f} ms'
+    return f'{value:.3f} s'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='角度計算・分析・画像アップロードのベンチマーク')
+    parser.add_argument('--only', choices=['angles', 'upload'], help='指定したグループだけ計測する')
+    parser.add_argument('--scale', type=int, default=1, help='反復回数の倍率（大きいほど安定するが時間がかかる）')
+    parser.add_argument('--save', metavar='PATH', help='結果をJSONで保存する')
+    parser.add_argument('--compare', metavar='PATH', help='ベースラインJSONと比較する')
+    parser.add_argument('--threshold', type=float, default=0.15, help='悪化とみなす割合（既定: 0.15 = 15%%）')
+    args = parser.parse_args(argv)
+
+    app_module, workdir = common.load_app()
+    try:
+        if app_module.MEDIAPIPE_AVAILABLE:
+            # 姿勢推定プールの起動時間を計測に含めない
+            app_module.get_pose_pool()
+
+        results = {}
+        if args.only in (None, 'angles'):
+            results.update(angle_cases(app_module, args.scale))
+        if args.only in (None, 'upload'):
+            results.update(upload_cases(app_module, args.scale, cached=False))
+            results.update(upload_cases(app_module, args.scale, cached=True))
+        print_table(results)
+
+        environment = common.environment_info(app_module)
+        if args.save:
+            common.save_results(args.save, results, environment)
+            print(f'\n結果を保存しました: {args.save}')
+        if args.compare:
+            regressions = common.compare_results(results, args.compare, args.threshold)
+            if common.print_regressions(regressions, args.threshold):
+                return 1
+        return 0
+    finally:
+        if app_module.pose_pool is not None:
+            app_module.pose_pool.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
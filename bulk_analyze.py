@@ -0,0 +1,343 @@
+"""フォルダ内の画像・動画をまとめて分析するコマンド
+
+使い方:
+    python bulk_analyze.py photos/2025 --output results.jsonl
+    python bulk_analyze.py photos/ clips/ --output results.csv --workers 8 --modes set,takeoff
+    python bulk_analyze.py photos/2025 --output results.jsonl --resume   # 中断したところから再開
+
+姿勢推定はアプリと同じワーカープール（POSE_WORKERS 相当のプロセス数）で並列に行い、
+関節点の変換・角度分析もアプリと同じ関数を使う。推定結果はアプリのキャッシュと共有される。
+結果は完了した順に1件ずつ書き出すため、出力ファイルがそのまま進捗の記録になる（--resume で続きから処理）。
+--resume では成功したファイルだけを飛ばし、失敗したファイルは処理し直す（同じパスの行は後のものが最新の結果）。
+"""
+import os
+import sys
+import csv
+import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+BASE_COLUMNS = [
+    'path', 'kind', 'status', 'error', 'hash', 'width', 'height', 'ai_detection_used', 'cache_hit',
+    'fps', 'analyzed_frames', 'set_time', 'takeoff_time', 'seconds'
+]
+
+
+def find_files(inputs, allowed_file, allowed_video, include_video):
+    """入力のファイル・フォルダから対象ファイルを探す（フォルダは再帰的に、名前順）"""
+    files = []
+    for path in inputs:
+        if os.path.isfile(path):
+            candidates = [path]
+        else:
+            candidates = []
+            for directory, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                candidates.extend(os.path.join(directory, name) for name in sorted(filenames))
+        for candidate in candidates:
+            name = os.path.basename(candidate)
+            if allowed_file(name):
+                files.append((os.path.abspath(candidate), 'image'))
+            elif include_video and allowed_video(name):
+                files.append((os.path.abspath(candidate), 'video'))
+    return files
+
+
+class ResultWriter:
+    """結果をJSONLまたはCSVに1件ずつ追記する"""
+
+    def __init__(self, path, output_format, columns, resume):
+        self.path = path
+        self.format = output_format
+        self.columns = columns
+        self._lock = threading.Lock()
+        exists = resume and os.path.exists(path) and os.path.getsize(path) > 0
+        if exists:
+            _truncate_partial_line(path)
+        self._file = open(path, 'a' if exists else 'w', encoding='utf-8', newline='')
+        if self.format == 'csv':
+            self._csv = csv.DictWriter(self._file, fieldnames=columns, extrasaction='ignore')
+            if not exists:
+                self._csv.writeheader()
+
+    def write(self, record):
+        with self._lock:
+            if self.format == 'csv':
+                self._csv.writerow(flatten_record(record))
+            else:
+                self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            # 中断しても書き終えた行は残るよう、1件ごとにフラッシュする
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def _truncate_partial_line(path):
+    """中断時に途中まで書かれた最終行を削除する"""
+    with open(path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            f.truncate(end)
+
+
+def completed_paths(path, output_format):
+    """既存の出力ファイルから成功したパスを読み込む（一時的なタイムアウトなどで失敗したものは再処理する）"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding='utf-8', newline='') as f:
+        if output_format == 'csv':
+            for row in csv.DictReader(f):
+                if row.get('path') and row.get('status') == 'ok':
+                    done.add(row['path'])
+        else:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    if record.get('status') == 'ok':
+                        done.add(record['path'])
+                except (ValueError, KeyError, AttributeError):
+                    continue
+    return done
+
+
+def flatten_record(record):
+    """CSV用に角度を '<モード>.<指標名>' の列に展開する"""
+    row = {key: value for key, value in record.items() if key in BASE_COLUMNS}
+    for mode, angles in (record.get('angles') or {}).items():
+        for name, value in angles.items():
+            row[f'{mode}.{name}'] = value
+    return row
+
+
+class BulkAnalyzer:
+    """1ファイルずつの分析処理（スレッドから並列に呼ばれる）"""
+
+    def __init__(self, app_module, modes, front_leg):
+        self.app = app_module
+        self.modes = modes
+        self.front_leg = front_leg
+
+    def analyze_angles(self, keypoints):
+        angles = {}
+        for mode in self.modes:
+            result = self.app.analyze_crouch_angles(keypoints, mode, self.front_leg)
+            result.pop('analysis_type', None)
+            angles[mode] = result
+        return angles
+
+    def analyze_image(self, path):
+        app = self.app
+        with open(path, 'rb') as f:
+            data = f.read()
+        image_hash = hashlib.sha256(data).hexdigest()
+        img = app.open_image(data, app.app.config['MAX_IMAGE_PIXELS'])
+        with img:
+            width, height = app.oriented_size(img)
+            keypoints, ai_detection_used, cache_hit, _, _ = app.detect_image_keypoints(img, image_hash, adaptive=False)
+        return {
+            'hash': image_hash,
+            'width': width,
+            'height': height,
+            'ai_detection_used': ai_detection_used,
+            'cache_hit': cache_hit,
+            'keypoints': keypoints,
+            'angles': self.analyze_angles(keypoints)
+        }
+
+    def analyze_video(self, path):
+        app = self.app
+        with open(path, 'rb') as f:
+            video_hash = _file_hash(f)
+        result = app.analyze_uploaded_video(path, os.path.basename(path), video_hash)
+        set_frame = result['set_frame']
+        takeoff_frame = result['takeoff_frame']
+        # 各モードの角度はキーフレーム（飛び出しは飛び出しフレーム、それ以外はセットフレーム）で求める
+        angles = {}
+        for mode in self.modes:
+            frame = takeoff_frame if mode == 'takeoff' else set_frame
+            if frame is not None and frame['keypoints']:
+                angles[mode] = self.analyze_angles(frame['keypoints'])[mode]
+        return {
+            'hash': video_hash,
+            'width': result['video_width'],
+            'height': result['video_height'],
+            'ai_detection_used': result['detected_frames'] > 0,
+            'fps': result['fps'],
+            'analyzed_frames': result['analyzed_frames'],
+            'set_time': set_frame['time'] if set_frame else None,
+            'takeoff_time': takeoff_frame['time'] if takeoff_frame else None,
+            'keypoints': {
+                'set': set_frame['keypoints'] if set_frame else None,
+                'takeoff': takeoff_frame['keypoints'] if takeoff_frame else None
+            },
+            'angles': angles
+        }
+
+    def process(self, path, kind):
+        started = time.perf_counter()
+        record = {'path': path, 'kind': kind}
+        try:
+            if kind == 'video':
+                record.update(self.analyze_video(path))
+            else:
+                record.update(self.analyze_image(path))
+            record['status'] = 'ok'
+        except Exception as e:
+            record['status'] = 'error'
+            record['error'] = f'{type(e).__name__}: {e}'
+        record['seconds'] = round(time.perf_counter() - started, 4)
+        return record
+
+
+def _file_hash(f):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Progress:
+    """処理件数とスループットの集計"""
+
+    def __init__(self, total, interval):
+        self.total = total
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.last_report = self.started
+        self.done = 0
+        self.errors = 0
+        self.ai = 0
+        self.cache_hits = 0
+        self.latencies = []
+
+    def add(self, record):
+        self.done += 1
+        self.latencies.append(record['seconds'])
+        if record['status'] != 'ok':
+            self.errors += 1
+        if record.get('ai_detection_used'):
+            self.ai += 1
+        if record.get('cache_hit'):
+            self.cache_hits += 1
+        now = time.perf_counter()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(now)
+
+    def report(self, now):
+        elapsed = now - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0
+        eta = (self.total - self.done) / rate if rate > 0 else float('inf')
+        print(f'{self.done}/{self.total} 件  {rate:.1f} 件/秒  エラー {self.errors}  残り約 {eta:.0f} 秒', file=sys.stderr)
+
+    def summary(self, skipped):
+        elapsed = time.perf_counter() - self.started
+        latencies = sorted(self.latencies)
+
+        def percentile(q):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * q))] if latencies else 0
+
+        print('\n=== 処理結果 ===', file=sys.stderr)
+        print(f'処理: {self.done} 件（スキップ {skipped} 件、エラー {self.errors} 件）', file=sys.stderr)
+        print(f'AI推定: {self.ai} 件（キャッシュ {self.cache_hits} 件）、デフォルト関節点: '
+              f'{self.done - self.errors - self.ai} 件', file=sys.stderr)
+        print(f'経過時間: {elapsed:.1f} 秒  スループット: {self.done / elapsed if elapsed > 0 else 0:.2f} 件/秒',
+              file=sys.stderr)
+        if latencies:
+            print(f'1件あたり: 中央値 {percentile(0.5) * 1000:.0f} ms  p95 {percentile(0.95) * 1000:.0f} ms',
+                  file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='フォルダ内の画像・動画をまとめて姿勢分析する')
+    parser.add_argument('inputs', nargs='+', help='画像・動画ファイルまたはフォルダ')
+    parser.add_argument('--output', '-o', required=True, help='結果の出力先（.jsonl または .csv）')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], help='出力形式（省略時は拡張子から判断）')
+    parser.add_argument('--workers', '-w', type=int, default=os.cpu_count() or 1, help='姿勢推定のプロセス数')
+    parser.add_argument('--modes', default='set,takeoff', help='分析モード（カンマ区切り）')
+    parser.add_argument('--front-leg', choices=['auto', 'left', 'right'], default='auto')
+    parser.add_argument('--no-video', action='store_true', help='動画を対象にしない')
+    parser.add_argument('--resume', action='store_true', help='出力ファイルに成功として記録済みのファイルを飛ばして続きから処理する（失敗したファイルは処理し直す）')
+    parser.add_argument('--progress-interval', type=float, default=5.0, help='進捗を表示する間隔（秒）')
+    args = parser.parse_args(argv)
+
+    output = os.path.abspath(args.output)
+    output_format = args.format or ('csv' if output.lower().endswith('.csv') else 'jsonl')
+    inputs = [os.path.abspath(path) for path in args.inputs]
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+
+    # アプリと同じキャッシュを使うため、リポジトリのディレクトリで読み込む。
+    # メトリクスはサーバーの /metrics に混ざらないよう記録先を持たない
+    os.environ['POSE_WORKERS'] = str(args.workers)
+    os.environ['METRICS_DIR'] = ''
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    import app as app_module
+
+    unknown = [mode for mode in modes if mode not in app_module.metric_engine.modes]
+    if unknown:
+        parser.error(f"未知の分析モードです: {', '.join(unknown)}（利用可能: {', '.join(app_module.metric_engine.modes)}）")
+
+    files = find_files(inputs, app_module.allowed_file, app_module.allowed_video, not args.no_video)
+    done = completed_paths(output, output_format) if args.resume else set()
+    pending = [(path, kind) for path, kind in files if path not in done]
+    skipped = len(files) - len(pending)
+    print(f'対象 {len(files)} 件（処理済み {skipped} 件）、ワーカー {args.workers}', file=sys.stderr)
+
+    if app_module.MEDIAPIPE_AVAILABLE:
+        try:
+            app_module.get_pose_pool()
+        except Exception as e:
+            print(f'姿勢推定ワーカーを起動できません: {e}', file=sys.stderr)
+    if not app_module.MEDIAPIPE_AVAILABLE:
+        print('MediaPipeが利用できないため、画像はデフォルト関節点で分析し、動画はエラーになります', file=sys.stderr)
+
+    columns = BASE_COLUMNS + [
+        f'{mode}.{name}'
+        for mode in modes
+        for name in ['front_leg', 'front_leg_detected'] + list(app_module.metric_engine.definitions[mode]['metrics'])
+    ]
+    writer = ResultWriter(output, output_format, columns, args.resume)
+    analyzer = BulkAnalyzer(app_module, modes, args.front_leg)
+    progress = Progress(len(pending), args.progress_interval)
+
+    # 推論待ちで全ワーカーが埋まるよう、ワーカー数より多めのファイルを同時に処理する
+    max_in_flight = args.workers * 2
+    try:
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            queue = iter(pending)
+            in_flight = set()
+            while True:
+                for path, kind in queue:
+                    in_flight.add(executor.submit(analyzer.process, path, kind))
+                    if len(in_flight) >= max_in_flight:
+                        break
+                if not in_flight:
+                    break
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    record = future.result()
+                    writer.write(record)
+                    progress.add(record)
+    except KeyboardInterrupt:
+        print('\n中断しました。--resume で続きから処理できます', file=sys.stderr)
+        return 130
+    finally:
+        writer.close()
+        progress.summary(skipped)
+        if app_module.pose_pool is not None:
+            app_module.pose_pool.shutdown()
+    return 1 if progress.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
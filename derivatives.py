@@ -0,0 +1,154 @@
+"""アップロード画像の派生画像（サムネイル・プレビュー・骨格オーバーレイ）
+
+派生画像は初回のリクエストで1回だけ生成してディスクに保存し、以降は保存済みのファイルを返す。
+元画像は内容ハッシュのファイル名で保存されて変更されず、保存済みの分析も変更されないため、
+派生画像は作り直す必要がなく、長期間のHTTPキャッシュを付けて配信できる。
+"""
+import os
+import tempfile
+import threading
+from PIL import Image, ImageDraw, ImageFont
+from image_pipeline import resize_image, oriented_size
+
+# 描画する骨格の線（フロントエンドの drawJointLines と同じ組）
+SKELETON_CONNECTIONS = [
+    ('LShoulder', 'RShoulder'),
+    ('LShoulder', 'LHip'),
+    ('RShoulder', 'RHip'),
+    ('LHip', 'RHip'),
+    ('LHip', 'LKnee'),
+    ('RHip', 'RKnee'),
+    ('LKnee', 'LAnkle'),
+    ('RKnee', 'RAnkle'),
+    ('LShoulder', 'C7'),
+    ('RShoulder', 'C7')
+]
+
+# 描画内容を変えたら上げる（保存済みの派生画像を作り直すため）
+# 2: EXIFの向きを適用
+RESIZED_VERSION = 2
+OVERLAY_VERSION = 2
+
+LINE_COLOR = (0, 200, 255)
+JOINT_COLOR = (255, 64, 64)
+LABEL_COLOR = (255, 255, 255)
+LABEL_BACKGROUND = (0, 0, 0, 160)
+
+
+class DerivativeStore:
+    """派生画像のディスクキャッシュ"""
+
+    def __init__(self, directory, sizes):
+        self.directory = directory
+        self.sizes = dict(sizes)
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, kind, key, extension):
+        return os.path.join(self.directory, kind, key[:2], f'{key}.{extension}')
+
+    def _lock_for(self, path):
+        with self._locks_lock:
+            return self._locks.setdefault(path, threading.Lock())
+
+    def _generate(self, path, render, image_format, **save_options):
+        """path が無ければ render() の画像を保存する（同じ派生画像を同時に生成しない）"""
+        if os.path.exists(path):
+            return path
+        with self._lock_for(path):
+            if os.path.exists(path):
+                return path
+            image = render()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    image.save(f, image_format, **save_options)
+                # 複数プロセスで同時に生成しても、リネームなので壊れたファイルは見えない
+                os.replace(temp_path, path)
+            except Exception:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+        with self._locks_lock:
+            self._locks.pop(path, None)
+        return path
+
+    def resized(self, kind, source_path, key):
+        """サムネイル（thumb）またはプレビュー（preview）のJPEGのパス"""
+        max_side = self.sizes[kind]
+
+        def render():
+            with Image.open(source_path) as img:
+                return resize_image(img, max_side).copy()
+
+        return self._generate(self._path(kind, f'{key}-v{RESIZED_VERSION}', 'jpg'), render, 'JPEG',
+                              quality=85, optimize=True, progressive=True)
+
+    def discard(self, key, legacy_overlay_keys=()):
+        """元画像の削除に合わせてサムネイル・プレビュー・骨格オーバーレイを削除する（古い版の名前も含む）
+
+        legacy_overlay_keys は元画像のキーを含まない名前（分析IDだけ）で保存したオーバーレイのキー。
+        """
+        paths = [self._path(kind, name, 'jpg') for kind in self.sizes for name in (key, f'{key}-v{RESIZED_VERSION}')]
+        overlay_dir = os.path.dirname(self._path('overlay', key, 'png'))
+        try:
+            paths.extend(os.path.join(overlay_dir, name) for name in os.listdir(overlay_dir) if name.startswith(f'{key}-'))
+        except FileNotFoundError:
+            pass
+        paths.extend(self._path('overlay', f'{legacy}-v{version}', 'png')
+                     for legacy in legacy_overlay_keys for version in range(1, OVERLAY_VERSION + 1))
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def overlay(self, source_path, key, analysis_id, keypoints, labels=()):
+        """プレビューサイズの画像に骨格と角度を描画したPNGのパス
+
+        key は元画像のキーで、元画像と一緒に discard で削除できるようにファイル名の先頭に付ける。
+
+        keypoints は元画像（EXIFの向きを適用後）のピクセル座標。labels は (頂点の関節点名, 表示文字列) のリスト。
+        """
+        max_side = self.sizes['preview']
+
+        def render():
+            with Image.open(source_path) as img:
+                original_width = oriented_size(img)[0]
+                image = resize_image(img, max_side).copy()
+            scale = image.size[0] / original_width
+            draw = ImageDraw.Draw(image, 'RGBA')
+            line_width = max(2, round(max(image.size) / 300))
+            radius = line_width * 2
+            points = {
+                name: (point['x'] * scale, point['y'] * scale)
+                for name, point in keypoints.items()
+                if isinstance(point, dict) and isinstance(point.get('x'), (int, float)) and isinstance(point.get('y'), (int, float))
+            }
+            for start, end in SKELETON_CONNECTIONS:
+                if start in points and end in points:
+                    draw.line([points[start], points[end]], fill=LINE_COLOR, width=line_width)
+            for x, y in points.values():
+                draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill=JOINT_COLOR)
+            font = _font(max(12, round(max(image.size) / 45)))
+            for joint, text in labels:
+                if joint not in points:
+                    continue
+                x, y = points[joint]
+                left, top, right, bottom = draw.textbbox((x + radius * 2, y), text, font=font)
+                draw.rectangle([left - 3, top - 2, right + 3, bottom + 2], fill=LABEL_BACKGROUND)
+                draw.text((x + radius * 2, y), text, fill=LABEL_COLOR, font=font)
+            return image
+
+        return self._generate(self._path('overlay', f'{key}-{analysis_id}-v{OVERLAY_VERSION}', 'png'),
+                              render, 'PNG', optimize=True)
+
+
+def _font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        # Pillow 10.1 より前はサイズ指定できない
+        return ImageFont.load_default()
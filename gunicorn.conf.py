@@ -0,0 +1,37 @@
+# Gunicorn設定（`gunicorn app:app` 実行時に自動で読み込まれる）
+import gc
+import os
+
+# 姿勢推定はワーカープールで並列に処理されるため、
+# Webワーカーはスレッドで複数リクエストを受け付ける
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+
+# PRELOAD_APP=1 でマスタープロセスがアプリを1回だけ読み込み、各ワーカーはそこからフォークする。
+# 読み込み済みのモジュールはコピーオンライトで共有され、ワーカーの起動が速くなる。
+# スレッド・SQLite接続・姿勢推定プールはフォーク後（post_worker_init）に作る。
+preload_app = os.environ.get('PRELOAD_APP', '').lower() in ('1', 'true', 'yes')
+
+
+def on_starting(server):
+    """前回起動時のメトリクスのスナップショットを削除する（/metrics はワーカーごとのファイルを合算する）"""
+    from metrics import Metrics
+    Metrics(os.environ.get('METRICS_DIR', 'cache/metrics')).clear()
+
+
+def when_ready(server):
+    """フォーク前に読み込み済みオブジェクトをGC対象から外し、共有ページへの書き込みを防ぐ"""
+    if preload_app:
+        gc.freeze()
+
+
+def post_worker_init(worker):
+    """Webワーカー起動後に姿勢推定プールのウォームアップとジョブワーカーの起動を行う"""
+    from app import MEDIAPIPE_AVAILABLE, get_pose_pool, job_queue
+    job_queue.start()
+    if MEDIAPIPE_AVAILABLE:
+        try:
+            get_pose_pool()
+        except Exception as e:
+            worker.log.warning(f"Pose worker pool warm-up failed: {e}")
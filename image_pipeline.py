@@ -0,0 +1,90 @@
+"""アップロード画像のデコード処理
+
+アップロードされたバイト列を1回だけデコードし、姿勢推定に必要な解像度まで縮小したRGB配列を作る。
+JPEGはデコード時にDCTスケーリング（draft）で縮小するため、大きな写真でもデコード負荷が小さい。
+MediaPipeの座標は正規化値なので、縮小画像で推定しても元画像のピクセル座標に戻せる。
+スマートフォンの縦向き写真はEXIFの向き（Orientation）を適用してから推定し、
+関節点の座標・画像サイズも向きを適用した後の画像（ブラウザでの表示と同じ向き）で扱う。
+"""
+import io
+from PIL import Image, ImageOps
+
+EXIF_ORIENTATION = 0x0112
+# 幅と高さが入れ替わる向き（90度・270度回転を含む）
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+class ImageTooLargeError(ValueError):
+    """ピクセル数が上限を超えている"""
+
+
+def open_image(data, max_pixels):
+    """ヘッダーだけを読み込み、ピクセル数の上限をチェックする"""
+    try:
+        img = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError:
+        raise ImageTooLargeError('画像の画素数が大きすぎます')
+    width, height = img.size
+    if width * height > max_pixels:
+        img.close()
+        raise ImageTooLargeError(f'画像の画素数が大きすぎます（{width}x{height}）')
+    return img
+
+
+def exif_orientation(img):
+    """EXIFの向き（1〜8、指定が無ければ1）"""
+    try:
+        return img.getexif().get(EXIF_ORIENTATION) or 1
+    except Exception:
+        # 壊れたEXIFは向きの指定が無いものとして扱う
+        return 1
+
+
+def oriented_size(img):
+    """EXIFの向きを適用した後の (幅, 高さ)（ヘッダーだけで求める）"""
+    width, height = img.size
+    return (height, width) if exif_orientation(img) in _TRANSPOSED_ORIENTATIONS else (width, height)
+
+
+def orient_image(img):
+    """EXIFの向きを適用した画像（向きの指定が無ければ同じImageをそのまま返す）"""
+    if exif_orientation(img) == 1:
+        return img
+    return ImageOps.exif_transpose(img)
+
+
+def resize_image(img, max_side):
+    """開いた画像をEXIFの向きを適用した長辺 max_side 以下のRGB画像にする
+
+    JPEGは元のImageのデコード自体が縮小される（draft）が、それ以上は縮小しないため、
+    同じImageから領域を切り出して推定し直すときは縮小前の解像度を使える。
+    """
+    if img.format == 'JPEG':
+        # 指定サイズ以上を保つ範囲で、デコード時に1/2〜1/8へ縮小
+        img.draft('RGB', (max_side, max_side))
+    # 縮小・切り出しの前に向きをそろえる（縦向きの写真を横倒しのまま推定しない）
+    img = orient_image(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    width, height = img.size
+    if max(width, height) > max_side:
+        scale = max_side / max(width, height)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        img = img.resize(size, Image.BILINEAR, reducing_gap=2.0)
+    return img
+
+
+def decode_for_pose(img, max_side):
+    """開いた画像を推論用に縮小してRGB配列に変換する"""
+    import numpy as np
+    return np.asarray(resize_image(img, max_side))
+
+
+def landmarks_to_keypoints(landmarks, joint_mapping, width, height):
+    """正規化ランドマークを元画像のピクセル座標の関節点に変換する"""
+    keypoints = {}
+    for mp_idx, frontend_name in joint_mapping.items():
+        if mp_idx < len(landmarks):
+            x, y = landmarks[mp_idx][0], landmarks[mp_idx][1]
+            keypoints[frontend_name] = {'x': int(x * width), 'y': int(y * height)}
+    return keypoints
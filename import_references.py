@@ -0,0 +1,97 @@
+"""関節点のJSONLから基準姿勢ライブラリにまとめて登録するコマンド
+
+使い方:
+    python import_references.py elite_starts.jsonl
+    python import_references.py results.jsonl --label-field path --athlete "Elite 2025"
+
+1行に1件の JSON で、keypoints（関節点）と任意の label / athlete / analysis_type / source を読む。
+bulk_analyze.py の出力（.jsonl）もそのまま読め、動画の行は keypoints の set / takeoff を別々に登録する。
+関節点が足りない行は飛ばし、件数を表示する。登録先は REFERENCE_DB（アプリと同じ既定値）。
+"""
+import os
+import sys
+import json
+import argparse
+
+from metric_engine import MetricEngine, load_metric_sets
+from reference_index import ReferenceIndex, InvalidPoseError, JOINTS, normalize_pose
+
+BATCH_SIZE = 1000
+
+
+def iter_entries(lines, label_field, athlete, analysis_type):
+    """JSONLの各行から登録する基準姿勢を作る（読めない行は None を返す）"""
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield number, None
+            continue
+        if not isinstance(record, dict) or record.get('status', 'ok') != 'ok':
+            yield number, None
+            continue
+        keypoints = record.get('keypoints')
+        if not isinstance(keypoints, dict):
+            yield number, None
+            continue
+        label = str(record.get(label_field) or record.get('label') or f'line {number}')
+        base = {
+            'label': label,
+            'athlete': record.get('athlete') or athlete,
+            'source': record.get('source') or record.get('path')
+        }
+        if any(joint in keypoints for joint in JOINTS):
+            yield number, dict(base, keypoints=keypoints, analysis_type=record.get('analysis_type') or analysis_type)
+        else:
+            # 動画の分析結果はモードごとの関節点
+            for mode, mode_keypoints in keypoints.items():
+                if isinstance(mode_keypoints, dict):
+                    yield number, dict(base, keypoints=mode_keypoints, analysis_type=mode)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='関節点のJSONLを基準姿勢ライブラリに登録する')
+    parser.add_argument('input', help='関節点のJSONL（- で標準入力）')
+    parser.add_argument('--db', default=os.environ.get('REFERENCE_DB', 'data/references.sqlite3'), help='基準姿勢ライブラリのSQLite')
+    parser.add_argument('--label-field', default='label', help='基準姿勢の名前に使う項目')
+    parser.add_argument('--athlete', help='athlete が無い行に設定する選手名')
+    parser.add_argument('--analysis-type', default='set', help='analysis_type が無い行の分析モード')
+    args = parser.parse_args(argv)
+
+    # 前足の判定はアプリと同じ指標定義を使う
+    index = ReferenceIndex(args.db, MetricEngine(load_metric_sets(os.environ.get('METRIC_SETS_FILE'))))
+    added = skipped = 0
+    batch = []
+
+    def flush():
+        nonlocal added
+        if batch:
+            added += len(index.add_many(batch))
+            batch.clear()
+
+    source = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+    with source:
+        for number, entry in iter_entries(source, args.label_field, args.athlete, args.analysis_type):
+            if entry is None:
+                skipped += 1
+                continue
+            try:
+                # 登録前に検証して、1行の不備でまとめて失敗しないようにする
+                normalize_pose(entry['keypoints'])
+            except InvalidPoseError as e:
+                print(f'{args.input}:{number}: {e}', file=sys.stderr)
+                skipped += 1
+                continue
+            batch.append(entry)
+            if len(batch) >= BATCH_SIZE:
+                flush()
+    flush()
+    print(f'{added}件を登録しました（{skipped}件を飛ばしました）')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
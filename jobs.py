@@ -0,0 +1,279 @@
+"""非同期分析ジョブキュー
+
+ジョブはSQLiteファイルに保存されるため、外部ブローカー無しで複数のgunicornワーカー間で共有できる。
+各Webプロセスのジョブワーカースレッドがキューからジョブを取り出して実行し、
+リクエストスレッドはジョブIDを返してすぐに解放される。
+"""
+import os
+import time
+import uuid
+import json
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+FINISHED_STATUSES = (STATUS_DONE, STATUS_FAILED)
+
+
+class QueueFullError(RuntimeError):
+    """キューが満杯"""
+
+
+class JobQueue:
+    """SQLiteをバックエンドにした上限つきジョブキュー"""
+
+    def __init__(self, db_path, max_pending=32, workers=2, lease_seconds=600, retention_seconds=86400):
+        self.db_path = db_path
+        self.max_pending = max_pending
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.retention_seconds = retention_seconds
+        self._handlers = {}
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._threads_pid = None
+        self._start_lock = threading.Lock()
+        self._last_cleanup = 0.0
+
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    progress REAL NOT NULL DEFAULT 0,
+                    message TEXT,
+                    payload TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at)")
+
+    def _connect(self):
+        # フォーク前に作った接続は子プロセスで使わない
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or conn.pid != os.getpid():
+            raw = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            raw.row_factory = sqlite3.Row
+            raw.execute('PRAGMA journal_mode=WAL')
+            raw.execute('PRAGMA synchronous=NORMAL')
+            conn = self._local.conn = _Transaction(raw)
+        return conn
+
+    def register(self, kind, handler):
+        """ジョブ種別ごとの処理関数を登録する
+
+        handler(payload, report) の report(progress, message) で進捗を通知できる。
+        """
+        self._handlers[kind] = handler
+
+    def submit(self, kind, payload):
+        """ジョブを登録してIDを返す（上限を超える場合は QueueFullError）"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            pending = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", (STATUS_QUEUED, STATUS_RUNNING)
+            ).fetchone()[0]
+            if pending >= self.max_pending:
+                raise QueueFullError('処理待ちのジョブが多すぎます')
+            conn.execute(
+                "INSERT INTO jobs (id, kind, status, message, payload, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, STATUS_QUEUED, '処理待ち', json.dumps(payload), now, now)
+            )
+        self.start()
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        """ジョブの状態を辞書で返す（存在しなければNone）"""
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = {
+            'job_id': row['id'],
+            'kind': row['kind'],
+            'status': row['status'],
+            'progress': row['progress'],
+            'message': row['message'],
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at']
+        }
+        if row['status'] == STATUS_DONE:
+            job['result'] = json.loads(row['result']) if row['result'] else None
+        if row['status'] == STATUS_FAILED:
+            job['error'] = row['error']
+        return job
+
+    def stats(self):
+        """ヘルスチェック用の統計"""
+        rows = self._connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = {status: count for status, count in rows}
+        return {
+            'queued': counts.get(STATUS_QUEUED, 0),
+            'running': counts.get(STATUS_RUNNING, 0),
+            'max_pending': self.max_pending,
+            'workers': len(self._threads)
+        }
+
+    def report(self, job_id, progress, message=None):
+        """実行中ジョブの進捗を更新する"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET progress = ?, message = COALESCE(?, message), updated_at = ? WHERE id = ?",
+                (progress, message, time.time(), job_id)
+            )
+
+    def _claim(self):
+        """次のジョブを取り出して実行中にする
+
+        リース期限を過ぎた実行中ジョブ（プロセスが落ちたもの）も再実行の対象にする。
+        """
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, kind, payload FROM jobs "
+                "WHERE status = ? OR (status = ? AND updated_at < ?) "
+                "ORDER BY created_at LIMIT 1",
+                (STATUS_QUEUED, STATUS_RUNNING, now - self.lease_seconds)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, message = ?, updated_at = ? WHERE id = ?",
+                (STATUS_RUNNING, '処理中', now, row['id'])
+            )
+        return row['id'], row['kind'], json.loads(row['payload'])
+
+    def _finish(self, job_id, result=None, error=None):
+        with self._connect() as conn:
+            if error is None:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, progress = 1, message = ?, result = ?, updated_at = ? WHERE id = ?",
+                    (STATUS_DONE, '完了', json.dumps(result), time.time(), job_id)
+                )
+            else:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, message = ?, error = ?, updated_at = ? WHERE id = ?",
+                    (STATUS_FAILED, '失敗', error, time.time(), job_id)
+                )
+
+    def _cleanup(self):
+        """保持期限を過ぎた完了済みジョブを削除する"""
+        now = time.time()
+        if now - self._last_cleanup < 60:
+            return
+        self._last_cleanup = now
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+                (STATUS_DONE, STATUS_FAILED, now - self.retention_seconds)
+            )
+
+    def _run_worker(self):
+        while True:
+            try:
+                claimed = self._claim()
+            except sqlite3.Error:
+                logger.exception('Failed to claim job')
+                claimed = None
+            if claimed is None:
+                # 他プロセスが登録したジョブも拾えるように定期的にポーリングする
+                self._wakeup.wait(1.0)
+                self._wakeup.clear()
+                self._cleanup()
+                continue
+
+            job_id, kind, payload = claimed
+            handler = self._handlers.get(kind)
+            try:
+                if handler is None:
+                    raise ValueError(f'未知のジョブ種別です: {kind}')
+                result = handler(payload, lambda progress, message=None: self.report(job_id, progress, message))
+                self._finish(job_id, result=result)
+            except Exception as e:
+                logger.exception('Job failed', extra={'job_id': job_id, 'kind': kind})
+                self._finish(job_id, error=str(e))
+
+    def start(self):
+        """このプロセスのジョブワーカースレッドを起動する"""
+        if self._threads_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._threads_pid == os.getpid():
+                return
+            # フォークした子プロセスには親のスレッドは引き継がれないため作り直す
+            self._threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run_worker, name=f'job-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._threads_pid = os.getpid()
+
+    def events(self, job_id, poll_interval=0.5, keepalive=15.0, max_duration=None):
+        """Server-Sent Events 形式で進捗を流すジェネレータ
+
+        配信中はWebワーカーのスレッドを1つ使うため、max_duration 秒を過ぎたら timeout イベントを送って終了する
+        （クライアントは再接続するか、ジョブの状態をポーリングする）。
+        """
+        last_update = None
+        last_sent = started = time.monotonic()
+        while True:
+            if max_duration is not None and time.monotonic() - started > max_duration:
+                yield _sse('timeout', {'job_id': job_id})
+                return
+            job = self.get(job_id)
+            if job is None:
+                yield _sse('error', {'error': 'ジョブが見つかりません'})
+                return
+            if job['updated_at'] != last_update:
+                last_update = job['updated_at']
+                last_sent = time.monotonic()
+                event = job['status'] if job['status'] in FINISHED_STATUSES else 'progress'
+                yield _sse(event, job)
+                if job['status'] in FINISHED_STATUSES:
+                    return
+            elif time.monotonic() - last_sent > keepalive:
+                last_sent = time.monotonic()
+                yield ': keepalive\n\n'
+            time.sleep(poll_interval)
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class _Transaction:
+    """`with` で BEGIN IMMEDIATE〜COMMIT を行うSQLite接続のラッパー"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.pid = os.getpid()
+
+    def execute(self, *args):
+        return self.conn.execute(*args)
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            self.conn.execute('ROLLBACK')
+        return False
@@ -0,0 +1,45 @@
+"""ライブカメラのフレーム受け渡し
+
+ブラウザから届くフレームは推論より速く届くことがあるため、未処理のフレームは最新の1枚だけを残す。
+古いフレームを捨てることで、推論が追いつかなくても遅延が積み上がらない。
+"""
+import time
+import threading
+
+
+class LatestFrame:
+    """最新のフレームだけを保持する受け渡し口（受信スレッドが put し、処理スレッドが get する）"""
+
+    def __init__(self):
+        self._frame = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self.received = 0
+        self.dropped = 0
+
+    def put(self, data):
+        """フレームを置く（未処理のフレームがあれば捨てる）"""
+        with self._condition:
+            self.received += 1
+            if self._frame is not None:
+                self.dropped += 1
+            self._frame = (data, time.monotonic())
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """次のフレーム (データ, 受信時刻) を待って取り出す（閉じられたかタイムアウトならNone）"""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._frame is not None or self._closed, timeout):
+                return None
+            frame, self._frame = self._frame, None
+            return frame
+
+    def close(self):
+        """待機中の get を終了させる"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
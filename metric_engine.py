@@ -0,0 +1,370 @@
+"""宣言的な角度指標エンジン
+
+指標は「分析モードごとの (指標名 → 3関節点)」として定義し、起動時に関節点番号の配列へ変換（コンパイル）しておく。
+関節点は 'front:Knee' / 'rear:Hip' のように前足・後足で指定でき、どちらの脚が前足かは
+関節点の位置から判定する（右足前でセットする選手にも対応）。'C7' や 'LHip' のような固定の関節点も使える。
+
+指標を増やしても、1件の分析は関節点の読み出し1回と指標数ぶんの角度計算だけで済む。
+複数件はNumPyで全指標を一括計算する（NumPyが無ければ1件ずつ計算する）。
+"""
+import json
+import math
+
+# 配列化する際の関節点の並び
+JOINT_ORDER = ['LShoulder', 'RShoulder', 'LHip', 'RHip', 'LKnee', 'RKnee', 'LAnkle', 'RAnkle', 'C7']
+JOINT_INDEX = {name: i for i, name in enumerate(JOINT_ORDER)}
+
+SIDES = ('left', 'right')
+_SIDE_PREFIX = {'left': 'L', 'right': 'R'}
+
+# 前足の判定方法
+#   ankle_ahead:  進行方向に足首が前にある脚を前足とする（セット姿勢）
+#   ankle_behind: 足首が後ろに残っている脚を前足とする（飛び出し時は前足でブロックを押している）
+#   left / right: 判定せずに固定
+FRONT_LEG_RULES = ('ankle_ahead', 'ankle_behind', 'left', 'right')
+
+# 足首の前後差が胴の長さのこの割合より小さい場合は判定できないものとして左足を前足とする
+AMBIGUOUS_RATIO = 0.05
+
+DEFAULT_METRIC_SETS = {
+    'set': {
+        'front_leg': 'ankle_ahead',
+        'metrics': {
+            'front_angle': ['front:Hip', 'front:Knee', 'front:Ankle'],
+            'rear_angle': ['rear:Hip', 'rear:Knee', 'rear:Ankle'],
+            'front_hip_angle': ['front:Shoulder', 'front:Hip', 'front:Knee']
+        }
+    },
+    'takeoff': {
+        'front_leg': 'ankle_behind',
+        'metrics': {
+            'lower_angle': ['front:Hip', 'front:Knee', 'front:Ankle'],
+            'upper_angle': ['front:Shoulder', 'front:Hip', 'front:Knee'],
+            'kunoji_angle': ['front:Shoulder', 'front:Hip', 'front:Ankle']
+        }
+    }
+}
+
+_INVALID = object()
+
+
+class MetricDefinitionError(ValueError):
+    """指標定義が正しくない"""
+
+
+def load_metric_sets(path=None):
+    """既定の指標定義に、JSONファイルの定義（同名のモードは置き換え）を加える"""
+    metric_sets = dict(DEFAULT_METRIC_SETS)
+    if path:
+        with open(path, encoding='utf-8') as f:
+            custom = json.load(f)
+        if not isinstance(custom, dict):
+            raise MetricDefinitionError(f'{path}: モード名をキーにしたオブジェクトが必要です')
+        metric_sets.update(custom)
+    return metric_sets
+
+
+def _resolve_joint(token, front_side):
+    """'front:Knee' などを左右の決まった関節点名に変換する"""
+    if ':' not in token:
+        name = token
+    else:
+        role, part = token.split(':', 1)
+        if role not in ('front', 'rear'):
+            raise MetricDefinitionError(f'関節点の指定が正しくありません: {token}')
+        side = front_side if role == 'front' else SIDES[1 - SIDES.index(front_side)]
+        name = _SIDE_PREFIX[side] + part
+    if name not in JOINT_INDEX:
+        raise MetricDefinitionError(f'未知の関節点です: {token}')
+    return JOINT_INDEX[name]
+
+
+class _CompiledSet:
+    """1つの分析モードの指標を、前足が左・右それぞれの場合の関節点番号に変換したもの"""
+
+    def __init__(self, mode, definition):
+        if not isinstance(definition, dict) or not isinstance(definition.get('metrics'), dict) \
+                or not definition['metrics']:
+            raise MetricDefinitionError(f"{mode}: 'metrics' に指標名と3関節点の対応が必要です")
+        self.mode = mode
+        self.front_leg = definition.get('front_leg', 'ankle_ahead')
+        if self.front_leg not in FRONT_LEG_RULES:
+            raise MetricDefinitionError(f'{mode}: front_leg は {", ".join(FRONT_LEG_RULES)} のいずれかです')
+        self.names = list(definition['metrics'])
+        self.triples = {}
+        for side in SIDES:
+            triples = []
+            for name, joints in definition['metrics'].items():
+                if not isinstance(joints, (list, tuple)) or len(joints) != 3:
+                    raise MetricDefinitionError(f'{mode}.{name}: 関節点は3つ指定してください')
+                triples.append(tuple(_resolve_joint(token, side) for token in joints))
+            self.triples[side] = triples
+
+
+class MetricEngine:
+    """コンパイル済みの指標定義で角度を計算する"""
+
+    def __init__(self, metric_sets=None):
+        metric_sets = DEFAULT_METRIC_SETS if metric_sets is None else metric_sets
+        self.definitions = metric_sets
+        self._sets = {mode: _CompiledSet(mode, definition) for mode, definition in metric_sets.items()}
+
+    @property
+    def modes(self):
+        return list(self._sets)
+
+    def analyze(self, keypoints, mode, front_leg='auto'):
+        """1件の関節点を分析する（analyze_crouch_angles と同じ形式の辞書を返す）"""
+        compiled = self._sets.get(mode)
+        if compiled is None:
+            return {'analysis_type': mode}
+        coords = _read_coords(keypoints)
+        side, detected = self._choose_side(compiled, coords, front_leg)
+        result = {}
+        for name, (a, b, c) in zip(compiled.names, compiled.triples[side]):
+            p1, p2, p3 = coords[a], coords[b], coords[c]
+            if p1 is None or p2 is None or p3 is None:
+                continue
+            if p1 is _INVALID or p2 is _INVALID or p3 is _INVALID:
+                # calculate_angle は計算エラー時に0を返すため、同じ扱いにする
+                result[name] = 0
+                continue
+            result[name] = _angle(p1, p2, p3)
+        result['front_leg'] = side
+        result['front_leg_detected'] = detected
+        result['analysis_type'] = mode
+        return result
+
+    def analyze_batch(self, keypoints_list, modes, front_leg='auto', np=None):
+        """複数件をまとめて分析し、モードごとの結果リストを返す
+
+        np にNumPyモジュールを渡すと全件・全指標を1回の配列演算で計算する。
+        結果は analyze を1件ずつ呼んだ場合と同じになる。
+        """
+        modes = list(modes)
+        if np is None:
+            return {mode: [self.analyze(keypoints, mode, front_leg) for keypoints in keypoints_list]
+                    for mode in modes}
+
+        results = {mode: [] for mode in modes}
+        if not keypoints_list:
+            return results
+        points, invalid = _keypoints_to_array(keypoints_list, np)
+        present = ~np.isnan(points[..., 0])
+        # 判定には数値の座標だけを使う
+        located = np.where(invalid[..., None], np.nan, points)
+        count = len(keypoints_list)
+
+        for mode in modes:
+            compiled = self._sets.get(mode)
+            if compiled is None:
+                results[mode] = [{'analysis_type': mode} for _ in range(count)]
+                continue
+            left_front, detected = self._choose_sides(compiled, located, front_leg, np)
+            triples = np.array([compiled.triples['left'], compiled.triples['right']], dtype=np.intp)
+            # 各件の前足に応じた関節点番号で (件数, 指標数, 3) を組み立てる
+            index = np.where(left_front[:, None, None], triples[0], triples[1])
+            rows = np.arange(count)[:, None]
+            first = points[rows, index[..., 0]]
+            vertex = points[rows, index[..., 1]]
+            last = points[rows, index[..., 2]]
+            angles = _angles_vectorized(first, vertex, last, np)
+            available = (present[rows, index[..., 0]] & present[rows, index[..., 1]] & present[rows, index[..., 2]])
+            errored = (invalid[rows, index[..., 0]] | invalid[rows, index[..., 1]] | invalid[rows, index[..., 2]])
+            zero = errored | np.isnan(angles)
+
+            angle_rows = angles.tolist()
+            available_rows = available.tolist()
+            zero_rows = zero.tolist()
+            left_rows = left_front.tolist()
+            detected_rows = detected.tolist()
+            mode_results = results[mode]
+            for i in range(count):
+                result = {}
+                for column, name in enumerate(compiled.names):
+                    if available_rows[i][column]:
+                        result[name] = 0 if zero_rows[i][column] else round(angle_rows[i][column], 1)
+                result['front_leg'] = 'left' if left_rows[i] else 'right'
+                result['front_leg_detected'] = detected_rows[i]
+                result['analysis_type'] = mode
+                mode_results.append(result)
+        return results
+
+    def metric_joints(self, mode, front_leg='left'):
+        """指標名と3関節点名の組のリスト（前足の側を指定。描画などに使う）"""
+        compiled = self._sets.get(mode)
+        if compiled is None:
+            return []
+        side = front_leg if front_leg in SIDES else 'left'
+        return [(name, tuple(JOINT_ORDER[j] for j in triple))
+                for name, triple in zip(compiled.names, compiled.triples[side])]
+
+    def front_side(self, keypoints, mode='set', front_leg='auto'):
+        """1件の関節点の前足の側（'left' / 'right'）。analyze と同じく判定できなければ 'left'"""
+        compiled = self._sets.get(mode)
+        if compiled is None:
+            return front_leg if front_leg in SIDES else 'left'
+        side, _ = self._choose_side(compiled, _read_coords(keypoints), front_leg)
+        return side
+
+    def dominant_front_leg(self, keypoints_list, mode='set'):
+        """複数フレームで多く判定された前足（動画全体で前足を揃えるため）。判定できなければ 'auto'"""
+        compiled = self._sets.get(mode)
+        if compiled is None:
+            return 'auto'
+        votes = {'left': 0, 'right': 0}
+        for keypoints in keypoints_list:
+            side, detected = self._choose_side(compiled, _read_coords(keypoints), 'auto')
+            if detected:
+                votes[side] += 1
+        if votes['left'] == votes['right']:
+            return 'auto'
+        return 'left' if votes['left'] > votes['right'] else 'right'
+
+    def _choose_side(self, compiled, coords, front_leg):
+        """前足の側と、位置から判定できたかを返す"""
+        if front_leg in SIDES:
+            return front_leg, False
+        if compiled.front_leg in SIDES:
+            return compiled.front_leg, False
+        order = _ankle_order(coords)
+        if order is None:
+            return 'left', False
+        left_ahead = order > 0
+        if compiled.front_leg == 'ankle_behind':
+            left_ahead = not left_ahead
+        return ('left' if left_ahead else 'right'), True
+
+    def _choose_sides(self, compiled, located, front_leg, np):
+        """_choose_side の配列版。(前足が左か, 判定できたか) の配列を返す"""
+        count = len(located)
+        if front_leg in SIDES or compiled.front_leg in SIDES:
+            side = front_leg if front_leg in SIDES else compiled.front_leg
+            return np.full(count, side == 'left'), np.zeros(count, dtype=bool)
+        order = _ankle_order_vectorized(located, np)
+        detected = order != 0
+        left_ahead = order > 0
+        if compiled.front_leg == 'ankle_behind':
+            left_ahead = ~left_ahead & detected
+        return left_ahead | ~detected, detected
+
+
+def _read_coords(keypoints):
+    """関節点辞書を JOINT_ORDER 順の座標リストにする（欠損はNone、数値でないものは _INVALID）"""
+    coords = [None] * len(JOINT_ORDER)
+    for name, point in keypoints.items():
+        j = JOINT_INDEX.get(name)
+        if j is None:
+            continue
+        try:
+            x, y = point['x'], point['y']
+        except (TypeError, KeyError):
+            x = y = None
+        if isinstance(x, (int, float)) and isinstance(y, (int, float)):
+            coords[j] = (x, y)
+        else:
+            coords[j] = _INVALID
+    return coords
+
+
+def _angle(p1, p2, p3):
+    """3点の角度（calculate_angle の基本計算と同じ手順）"""
+    v1x, v1y = p1[0] - p2[0], p1[1] - p2[1]
+    v2x, v2y = p3[0] - p2[0], p3[1] - p2[1]
+    magnitude1 = math.sqrt(v1x ** 2 + v1y ** 2)
+    magnitude2 = math.sqrt(v2x ** 2 + v2y ** 2)
+    if magnitude1 == 0 or magnitude2 == 0:
+        return 0
+    cos_theta = (v1x * v2x + v1y * v2y) / (magnitude1 * magnitude2)
+    cos_theta = max(-1.0, min(1.0, cos_theta))
+    return round(math.degrees(math.acos(cos_theta)), 1)
+
+
+def _mean(values):
+    values = [value for value in values if value is not None and value is not _INVALID]
+    if not values:
+        return None
+    return (sum(v[0] for v in values) / len(values), sum(v[1] for v in values) / len(values))
+
+
+def _ankle_order(coords):
+    """進行方向で左足首が前なら正、右足首が前なら負、判定できなければNone
+
+    進行方向は腰の中点から肩（無ければC7）の中点への水平方向とする。
+    クラウチングでは上体が前に倒れるため、頭側が進行方向になる。
+    """
+    hip = _mean([coords[JOINT_INDEX['LHip']], coords[JOINT_INDEX['RHip']]])
+    upper = _mean([coords[JOINT_INDEX['LShoulder']], coords[JOINT_INDEX['RShoulder']]]) \
+        or _mean([coords[JOINT_INDEX['C7']]])
+    left = coords[JOINT_INDEX['LAnkle']]
+    right = coords[JOINT_INDEX['RAnkle']]
+    if hip is None or upper is None or left in (None, _INVALID) or right in (None, _INVALID):
+        return None
+    forward = upper[0] - hip[0]
+    torso = math.sqrt((upper[0] - hip[0]) ** 2 + (upper[1] - hip[1]) ** 2)
+    if forward == 0 or torso == 0:
+        return None
+    ahead = (left[0] - right[0]) * (1 if forward > 0 else -1)
+    if abs(ahead) < AMBIGUOUS_RATIO * torso:
+        return None
+    return ahead
+
+
+def _ankle_order_vectorized(located, np):
+    """_ankle_order の配列版（判定できない件は0）"""
+    def mean(columns):
+        selected = located[:, [JOINT_INDEX[name] for name in columns]]
+        counts = (~np.isnan(selected[..., 0])).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.nansum(selected, axis=1) / counts[:, None]
+
+    hip = mean(['LHip', 'RHip'])
+    shoulders = mean(['LShoulder', 'RShoulder'])
+    upper = np.where(np.isnan(shoulders), located[:, JOINT_INDEX['C7']], shoulders)
+    left = located[:, JOINT_INDEX['LAnkle']]
+    right = located[:, JOINT_INDEX['RAnkle']]
+    forward = upper[:, 0] - hip[:, 0]
+    torso = np.sqrt((upper[:, 0] - hip[:, 0]) ** 2 + (upper[:, 1] - hip[:, 1]) ** 2)
+    ahead = (left[:, 0] - right[:, 0]) * np.where(forward > 0, 1, -1)
+    with np.errstate(invalid='ignore'):
+        valid = (forward != 0) & (torso != 0) & (np.abs(ahead) >= AMBIGUOUS_RATIO * torso)
+    valid &= ~np.isnan(ahead) & ~np.isnan(torso)
+    return np.where(valid, ahead, 0.0)
+
+
+def _keypoints_to_array(keypoints_list, np):
+    """関節点辞書のリストを (N, 関節数, 2) の配列に変換する
+
+    欠損している関節点はNaN。数値でない座標を持つ関節点は0にして invalid マスクで示す。
+    """
+    missing = (math.nan, math.nan)
+    coords = []
+    flags = []
+    for keypoints in keypoints_list:
+        for coord in _read_coords(keypoints):
+            if coord is None:
+                coords.append(missing)
+                flags.append(False)
+            elif coord is _INVALID:
+                coords.append((0.0, 0.0))
+                flags.append(True)
+            else:
+                coords.append(coord)
+                flags.append(False)
+    count = len(keypoints_list)
+    points = np.array(coords, dtype=float).reshape(count, len(JOINT_ORDER), 2)
+    invalid = np.array(flags, dtype=bool).reshape(count, len(JOINT_ORDER))
+    return points, invalid
+
+
+def _angles_vectorized(first, vertex, last, np):
+    """3点の座標配列から角度を一括計算する（ベクトル長が0の場合はNaN）"""
+    vector1 = first - vertex
+    vector2 = last - vertex
+    dot_product = vector1[..., 0] * vector2[..., 0] + vector1[..., 1] * vector2[..., 1]
+    magnitude1 = np.sqrt(vector1[..., 0] ** 2 + vector1[..., 1] ** 2)
+    magnitude2 = np.sqrt(vector2[..., 0] ** 2 + vector2[..., 1] ** 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cos_theta = np.clip(dot_product / (magnitude1 * magnitude2), -1.0, 1.0)
+        angles = np.degrees(np.arccos(cos_theta))
+    return np.where((magnitude1 == 0) | (magnitude2 == 0), np.nan, angles)
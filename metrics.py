@@ -0,0 +1,213 @@
+"""処理段階ごとのレイテンシ・件数の計測（Prometheusテキスト形式で公開）
+
+各プロセスはメモリ上で集計し、定期的に METRICS_DIR/<pid>.json へスナップショットを書き出す。
+/metrics では全プロセスのスナップショットを合算するため、gunicornのワーカーが複数あっても正しい値になる。
+記録処理はロックと加算だけなので、リクエスト処理中に呼んでも負荷はほとんどない。
+"""
+import os
+import json
+import time
+import uuid
+import bisect
+import tempfile
+import threading
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metrics:
+    """カウンターとヒストグラムのレジストリ"""
+
+    def __init__(self, directory=None, flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._definitions = {}
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._path = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def counter(self, name, help_text):
+        """カウンターを定義する"""
+        self._definitions[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        """ヒストグラムを定義する"""
+        self._definitions[name] = ('histogram', help_text, tuple(buckets))
+
+    def inc(self, name, value=1, **labels):
+        """カウンターを加算する"""
+        key = (name, tuple(sorted(labels.items())))
+        self._ensure_process()
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ヒストグラムに値を記録する"""
+        buckets = self._definitions[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(buckets, value)
+        self._ensure_process()
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """with ブロックの所要時間をヒストグラムに記録する"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        """このプロセスの集計値"""
+        with self._lock:
+            return {
+                'counters': [[name, dict(labels), value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, dict(labels), list(entry[0]), entry[1], entry[2]]
+                               for (name, labels), entry in self._histograms.items()]
+            }
+
+    def flush(self):
+        """スナップショットをファイルに書き出す"""
+        if not self.directory or self._path is None:
+            return
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(temp_path, self._path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _ensure_process(self):
+        """プロセスで最初の記録時に集計値とスナップショットファイルを用意する
+
+        フォークした子プロセスには親の集計値がコピーされるため、二重計上しないよう捨てる。
+        ファイル名にはランダムな接尾辞を付け、PIDが再利用されても終了済みプロセスの値を上書きしない。
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._counters = {}
+            self._histograms = {}
+            self._pid = os.getpid()
+            if not self.directory:
+                return
+            self._path = os.path.join(self.directory, f'{self._pid}-{uuid.uuid4().hex[:8]}.json')
+
+        def run():
+            while True:
+                time.sleep(self.flush_interval)
+                self.flush()
+
+        threading.Thread(target=run, name='metrics-flush', daemon=True).start()
+
+    def _collect(self):
+        """全プロセスのスナップショットを合算する
+
+        終了したワーカーのファイルも残して合算するため、カウンターはワーカーの再起動で減らない。
+        """
+        if not self.directory:
+            snapshots = [self.snapshot()]
+        else:
+            self.flush()
+            snapshots = []
+            for filename in os.listdir(self.directory):
+                if not filename.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(self.directory, filename)) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+
+        counters = {}
+        histograms = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(sorted(labels.items())))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, bucket_counts, total, count in snapshot['histograms']:
+                key = (name, tuple(sorted(labels.items())))
+                entry = histograms.get(key)
+                if entry is None:
+                    histograms[key] = [list(bucket_counts), total, count]
+                elif len(entry[0]) == len(bucket_counts):
+                    entry[0] = [a + b for a, b in zip(entry[0], bucket_counts)]
+                    entry[1] += total
+                    entry[2] += count
+        return counters, histograms
+
+    def clear(self):
+        """スナップショットファイルを削除する（サーバー起動時に前回の値を消すため）"""
+        if not self.directory:
+            return
+        for filename in os.listdir(self.directory):
+            if filename.endswith(('.json', '.tmp')):
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
+
+    def render(self, extra_gauges=()):
+        """Prometheusテキスト形式で出力する
+
+        extra_gauges には (名前, 説明, [(ラベル辞書, 値), ...]) を渡す（スクレイプ時点の値）。
+        """
+        counters, histograms = self._collect()
+        lines = []
+        for name, (kind, help_text, buckets) in sorted(self._definitions.items()):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f'{name}{_labels(labels)} {_number(value)}')
+            else:
+                for (metric, labels), (bucket_counts, total, count) in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket_count in zip(buckets, bucket_counts):
+                        cumulative += bucket_count
+                        lines.append(f'{name}_bucket{_labels(labels, le=_number(bound))} {cumulative}')
+                    lines.append(f'{name}_bucket{_labels(labels, le="+Inf")} {count}')
+                    lines.append(f'{name}_sum{_labels(labels)} {_number(total)}')
+                    lines.append(f'{name}_count{_labels(labels)} {count}')
+        for name, help_text, samples in extra_gauges:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            for labels, value in samples:
+                lines.append(f'{name}{_labels(tuple(sorted(labels.items())))} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ''
+    escaped = ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in items
+    )
+    return '{' + escaped + '}'
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
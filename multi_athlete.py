@@ -0,0 +1,95 @@
+"""ヒート写真（複数の選手が並んだスタート写真）の選手ごとの姿勢推定
+
+MediaPipe Poseは1枚の画像から1人しか推定しないため、画像全体と横方向に重なりのある縦長のタイルを
+1回だけまとめてワーカープールで推定（ワーカー数まで並列）し、見つかった選手を集める。
+推論の回数はタイル数（tile_regions の長さ）で決まり、写っている選手数によらない。
+タイルは半分ずつ重なるため、タイルの端で切れた選手も隣のタイルでは全身が写る。
+同じ選手の検出が複数あれば、タイルの端で切れていないタイルの検出を使う（画像全体より選手あたりの画素が多い）。
+座標は roi と同じく正規化値（0〜1）で扱う。
+"""
+from image_pipeline import decode_for_pose
+from roi import landmark_box, to_pixels, to_full_frame
+
+DUPLICATE_IOU = 0.3         # これ以上重なる検出は同じ選手とみなす
+EDGE_MARGIN = 0.01          # タイルの左右の端からこれより近い検出は切れているとみなす
+
+
+def tile_regions(columns, overlap=0.5):
+    """画像全体と、横方向に overlap の割合で重なる columns 列幅のタイル（正規化座標）"""
+    regions = [(0.0, 0.0, 1.0, 1.0)]
+    if columns > 1:
+        width = 1.0 / columns
+        stride = width * (1.0 - overlap)
+        count = int(round((1.0 - width) / stride)) + 1
+        for index in range(count):
+            x0 = min(index * stride, 1.0 - width)
+            regions.append((x0, 0.0, x0 + width, 1.0))
+    return regions
+
+
+def box_iou(a, b):
+    """2つの矩形の IoU"""
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def is_duplicate(box, other, threshold=DUPLICATE_IOU):
+    """2つの検出が同じ選手か（どちらかの中心がもう一方の内側にあるか、十分に重なる）"""
+    for a, b in ((box, other), (other, box)):
+        cx, cy = (a[0] + a[2]) / 2, (a[1] + a[3]) / 2
+        if b[0] <= cx <= b[2] and b[1] <= cy <= b[3]:
+            return True
+    return box_iou(box, other) >= threshold
+
+
+def is_clipped(box, region, margin=EDGE_MARGIN):
+    """検出がタイルの左右の端（画像の端を除く）で切れているか"""
+    return (region[0] > 0 and box[0] - region[0] < margin) or (region[2] < 1 and region[2] - box[2] < margin)
+
+
+def box_area(box):
+    return (box[2] - box[0]) * (box[3] - box[1])
+
+
+def crop_for_pose(img, region, input_size):
+    """領域を切り出した推論用のRGB配列と、切り出したピクセル矩形を返す"""
+    width, height = img.size
+    box = to_pixels(region, width, height)
+    return decode_for_pose(img.crop(box), input_size), box
+
+
+def detect_athletes(img, detect_batch, input_size, columns=4, max_athletes=8):
+    """画像に写っている選手ごとのランドマーク（元画像全体の正規化座標）を左から順に返す
+
+    img はRGBに縮小済みのPIL画像。detect_batch は推論用のRGB配列のリストを受け取り、
+    同じ順のランドマーク（検出できなければNone）のリストを返す関数で、1回だけ呼ぶ。
+    """
+    width, height = img.size
+    regions = tile_regions(columns)
+    crops = [crop_for_pose(img, region, input_size) for region in regions]
+    results = detect_batch([image for image, _ in crops])
+    found = []  # (優先度, 矩形, ランドマーク)
+    for index, (region, (_, pixel_box), landmarks) in enumerate(zip(regions, crops, results)):
+        if not landmarks:
+            continue
+        full = to_full_frame(landmarks, pixel_box, width, height)
+        box = landmark_box(full)
+        if box is None:
+            continue
+        # 端で切れていない検出、画像全体よりタイルの検出を優先する
+        priority = (not is_clipped(box, region), index > 0)
+        duplicate = next((i for i, (_, known, _) in enumerate(found) if is_duplicate(box, known)), None)
+        if duplicate is None:
+            found.append((priority, box, full))
+        elif priority > found[duplicate][0]:
+            found[duplicate] = (priority, box, full)
+    # 優先度の高い（端で切れていない）検出、同じ優先度なら大きく写っている選手を上限まで残し、左から順に並べる
+    found.sort(key=lambda athlete: (athlete[0], box_area(athlete[1])), reverse=True)
+    found = found[:max_athletes]
+    found.sort(key=lambda athlete: athlete[1][0] + athlete[1][2])
+    return [landmarks for _, _, landmarks in found]
@@ -0,0 +1,498 @@
+"""MediaPipe姿勢推定ワーカープール
+
+MediaPipeのPoseグラフはスレッドセーフではないため、推論は専用のワーカープロセスで実行する。
+各ワーカーは起動時にPoseを1つ構築してウォームアップし、パイプ経由で推論要求を受け付ける。
+タイムアウトしたワーカーや異常終了したワーカーは自動的に再起動される。
+ライブカメラのセッションには、トラッキングモードのPoseを持つ専用ワーカー（PoseTracker）を割り当てる。
+"""
+import os
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class PoseWorkerError(RuntimeError):
+    """ワーカーでの推論失敗"""
+
+
+class PoseTimeoutError(PoseWorkerError):
+    """推論がタイムアウトした"""
+
+
+class PoseBusyError(PoseTimeoutError):
+    """待機時間内に空きワーカーがなかった（ワーカーは入れ替えない）"""
+
+
+class PoseUnavailableError(PoseWorkerError):
+    """ワーカーでMediaPipeを読み込めない"""
+
+
+class PoseTrackerLimitError(PoseWorkerError):
+    """同時に開けるトラッキングセッションの上限に達した"""
+
+
+# forkserver方式では、これらのモジュールをフォークサーバーで1回だけ読み込み、
+# 各ワーカーはそこからフォークする（読み込み済みのモジュールはコピーオンライトで共有される）
+PRELOAD_MODULES = ['numpy', 'cv2', 'mediapipe', 'pose_pool', 'video_analysis']
+
+
+# ---- ワーカープロセス側 ----
+
+def _create_pose(options):
+    """ワーカー内でMediaPipe Poseを構築する"""
+    import mediapipe as mp
+    return mp.solutions.pose.Pose(
+        static_image_mode=options.get('static_image_mode', True),
+        model_complexity=options.get('model_complexity', 1),
+        min_detection_confidence=options.get('min_detection_confidence', 0.5),
+        min_tracking_confidence=options.get('min_tracking_confidence', 0.5)
+    )
+
+
+def _landmarks_to_list(pose_landmarks):
+    """ランドマークを (x, y, visibility) の正規化座標リストに変換"""
+    return [(lm.x, lm.y, lm.visibility) for lm in pose_landmarks.landmark]
+
+
+def _pose_for(state, model_complexity=None):
+    """指定した複雑度のPose（ワーカー起動時に構築したものを使い回し、無ければ構築する）"""
+    if model_complexity is None:
+        model_complexity = state['options'].get('model_complexity', 1)
+    pose = state['poses'].get(model_complexity)
+    if pose is None:
+        pose = state['poses'][model_complexity] = _create_pose(dict(state['options'], model_complexity=model_complexity))
+    return pose
+
+
+def _task_detect(state, image, model_complexity=None):
+    """RGB画像から姿勢を推定する"""
+    results = _pose_for(state, model_complexity).process(image)
+    if not results.pose_landmarks:
+        return None
+    return _landmarks_to_list(results.pose_landmarks)
+
+
+def _task_track_video(state, path, joints, target_fps=None, max_side=640, max_frames=None, roi_padding=None):
+    """動画をトラッキングモードで解析し、フレームごとの関節点（正規化座標）を返す
+
+    トラッキング状態は動画ごとに独立させるため、専用のPoseをタスク内で生成する。
+    roi_padding を指定すると、前のフレームのランドマークの周囲だけを切り出して推定する。
+    """
+    import mediapipe as mp
+    from video_analysis import iter_frames, video_info
+    from roi import RegionTracker, to_full_frame
+
+    info = video_info(path)
+    stride = 1
+    if target_fps and info['fps'] > target_fps:
+        stride = max(1, int(round(info['fps'] / target_fps)))
+
+    frames = []
+    regions = RegionTracker(roi_padding) if roi_padding is not None else None
+    tracker = mp.solutions.pose.Pose(
+        static_image_mode=False,
+        min_detection_confidence=state['options'].get('min_detection_confidence', 0.5),
+        min_tracking_confidence=0.5
+    )
+    try:
+        for index, timestamp, image, box in iter_frames(path, stride=stride, max_side=max_side, max_frames=max_frames,
+                                                        region=regions.pixel_box if regions else None):
+            results = tracker.process(image)
+            all_landmarks = landmarks = None
+            if results.pose_landmarks:
+                all_landmarks = _landmarks_to_list(results.pose_landmarks)
+                if box is not None:
+                    all_landmarks = to_full_frame(all_landmarks, box, *regions.frame_size)
+                landmarks = [all_landmarks[i][:2] for i in joints]
+            if regions:
+                regions.update(all_landmarks)
+            frames.append((index, timestamp, landmarks))
+    finally:
+        tracker.close()
+
+    info['stride'] = stride
+    info['frames'] = frames
+    info['roi_area'] = regions.mean_area if regions else None
+    return info
+
+
+def _task_ping(state):
+    """死活確認"""
+    return os.getpid()
+
+
+_TASKS = {
+    'detect': _task_detect,
+    'track_video': _task_track_video,
+    'ping': _task_ping,
+}
+
+
+def _worker_main(conn, options):
+    """ワーカープロセスのメインループ"""
+    try:
+        import numpy as np
+        state = {'poses': {}, 'options': options}
+        # 最初の推論はグラフ初期化で遅いため、使う複雑度のPoseをすべて起動時に空画像で済ませておく
+        complexities = options.get('model_complexities') or [options.get('model_complexity', 1)]
+        for complexity in complexities:
+            _pose_for(state, complexity).process(np.zeros((256, 256, 3), dtype=np.uint8))
+        conn.send(('ready', os.getpid()))
+    except (ImportError, AttributeError) as e:
+        conn.send(('unavailable', f'{type(e).__name__}: {e}'))
+        return
+    except Exception as e:
+        conn.send(('error', f'{type(e).__name__}: {e}'))
+        return
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError, KeyboardInterrupt):
+            break
+        if message is None:
+            break
+
+        task_name, kwargs = message
+        try:
+            result = _TASKS[task_name](state, **kwargs)
+            conn.send(('ok', result))
+        except Exception as e:
+            logger.exception('Pose task failed', extra={'task': task_name})
+            conn.send(('error', f'{type(e).__name__}: {e}'))
+
+
+# ---- 親プロセス側 ----
+
+class _Worker:
+    """ワーカープロセスとパイプの組"""
+
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.pid = None
+
+    def kill(self):
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(1)
+            if self.process.is_alive():
+                self.process.kill()
+        self.process.join(1)
+
+
+class PoseTracker:
+    """1つのセッション専用のトラッキングモードのワーカー
+
+    前のフレームのランドマークから追跡するため、連続したフレームでは検出器を毎回実行するより速い。
+    セッションごとに状態を持つので、プールのワーカーとは共有しない。
+    """
+
+    def __init__(self, pool, worker):
+        self._pool = pool
+        self._worker = worker
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def detect(self, image_rgb, timeout=None):
+        """フレームの姿勢を推定し、正規化ランドマーク (x, y, visibility) のリストを返す"""
+        timeout = self._pool.timeout if timeout is None else timeout
+        with self._lock:
+            if self.closed:
+                raise PoseWorkerError('トラッキングセッションは終了しています')
+            try:
+                self._worker.conn.send(('detect', {'image': image_rgb}))
+                if not self._worker.conn.poll(timeout):
+                    self._close()
+                    raise PoseTimeoutError(f'姿勢推定が{timeout}秒以内に完了しませんでした')
+                status, payload = self._worker.conn.recv()
+            except (EOFError, OSError):
+                self._close()
+                raise PoseWorkerError('姿勢推定ワーカーが異常終了しました')
+        if status == 'error':
+            raise PoseWorkerError(payload)
+        return payload
+
+    def close(self):
+        """ワーカーを停止する"""
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._worker.conn.send(None)
+        except OSError:
+            pass
+        self._worker.kill()
+        self._pool._release_tracker(self)
+
+
+class PosePool:
+    """姿勢推定ワーカーのプール
+
+    `run()` は空いているワーカーを1つ確保して推論を実行するため、
+    複数のリクエストスレッドから同時に呼び出すとワーカー数まで並列に処理される。
+    """
+
+    def __init__(self, workers=None, timeout=10.0, startup_timeout=60.0, min_detection_confidence=0.5,
+                 start_method=None, max_trackers=2, model_complexities=(1,)):
+        self.size = max(1, int(workers or os.cpu_count() or 1))
+        self.max_trackers = max_trackers
+        self.timeout = timeout
+        self.startup_timeout = startup_timeout
+        # 先頭の複雑度が既定。負荷に応じて切り替える複雑度もワーカー起動時に構築しておく
+        self.options = {
+            'min_detection_confidence': min_detection_confidence,
+            'model_complexity': model_complexities[0],
+            'model_complexities': list(model_complexities)
+        }
+        self.restarts = 0
+        self.started = False
+        self.startup_seconds = None
+        # forkではスレッドを持つWebプロセスの状態を引き継いでしまうため使わない
+        if start_method is None:
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.start_method = start_method
+        self._ctx = multiprocessing.get_context(start_method)
+        if start_method == 'forkserver':
+            self._ctx.set_forkserver_preload(PRELOAD_MODULES)
+        self._idle = queue.Queue()
+        self._workers = set()
+        self._trackers = set()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._batch_executor = None
+
+    def start(self):
+        """全ワーカーを起動し、ウォームアップ完了まで待つ"""
+        with self._lock:
+            if self.started:
+                return
+            started_at = time.monotonic()
+            pending = [self._spawn() for _ in range(self.size)]
+            try:
+                for worker in pending:
+                    self._wait_ready(worker)
+            except Exception:
+                for worker in pending:
+                    worker.kill()
+                raise
+            for worker in pending:
+                self._workers.add(worker)
+                self._idle.put(worker)
+            self.started = True
+            self.startup_seconds = time.monotonic() - started_at
+
+    def _spawn(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(child_conn, self.options),
+            name='pose-worker',
+            daemon=True
+        )
+        process.start()
+        child_conn.close()
+        return _Worker(process, parent_conn)
+
+    def _wait_ready(self, worker):
+        if not worker.conn.poll(self.startup_timeout):
+            raise PoseTimeoutError('ワーカーの起動がタイムアウトしました')
+        try:
+            status, payload = worker.conn.recv()
+        except (EOFError, OSError):
+            raise PoseWorkerError('ワーカーが起動中に終了しました')
+        if status == 'unavailable':
+            raise PoseUnavailableError(payload)
+        if status != 'ready':
+            raise PoseWorkerError(f'ワーカーの起動に失敗しました: {payload}')
+        worker.pid = payload
+
+    def _replace(self, worker):
+        """壊れたワーカーを破棄し、バックグラウンドで代わりを起動する"""
+        with self._lock:
+            self._workers.discard(worker)
+            self.restarts += 1
+        logger.warning('Replacing pose worker', extra={'worker_pid': worker.pid})
+        worker.kill()
+        if self._closed:
+            return
+
+        def respawn():
+            while not self._closed:
+                new_worker = self._spawn()
+                try:
+                    self._wait_ready(new_worker)
+                except PoseWorkerError as e:
+                    logger.warning('Failed to restart pose worker', extra={'error': str(e)})
+                    new_worker.kill()
+                    time.sleep(1)
+                    continue
+                with self._lock:
+                    self._workers.add(new_worker)
+                self._idle.put(new_worker)
+                return
+
+        threading.Thread(target=respawn, name='pose-worker-respawn', daemon=True).start()
+
+    def _acquire(self, deadline):
+        while True:
+            try:
+                # 空いているワーカーは待ち時間の予算が残っていなくても使う
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoseBusyError('空きワーカーの待機がタイムアウトしました')
+                try:
+                    worker = self._idle.get(timeout=remaining)
+                except queue.Empty:
+                    raise PoseBusyError('空きワーカーの待機がタイムアウトしました')
+            if worker.process.is_alive():
+                return worker
+            self._replace(worker)
+
+    def run(self, task_name, timeout=None, wait_timeout=None, **kwargs):
+        """ワーカーでタスクを実行して結果を返す
+
+        wait_timeout は空きワーカーを待つ時間の上限（省略時は timeout）で、超えると PoseBusyError になる。
+        timeout はワーカーを確保してからの推論時間の上限で、待ち時間は含まない。
+        """
+        if not self.started:
+            self.start()
+        timeout = self.timeout if timeout is None else timeout
+        wait_timeout = timeout if wait_timeout is None else wait_timeout
+        worker = self._acquire(time.monotonic() + wait_timeout)
+
+        # 待ち時間で推論の持ち時間を減らすと、混雑時に正常なワーカーを推論途中で入れ替えてしまう
+        deadline = time.monotonic() + timeout
+        try:
+            worker.conn.send((task_name, kwargs))
+            if not worker.conn.poll(max(0.0, deadline - time.monotonic())):
+                # 推論中のワーカーは中断できないため、プロセスごと入れ替える
+                self._replace(worker)
+                raise PoseTimeoutError(f'姿勢推定が{timeout}秒以内に完了しませんでした')
+            status, payload = worker.conn.recv()
+        except (EOFError, OSError):
+            self._replace(worker)
+            raise PoseWorkerError('姿勢推定ワーカーが異常終了しました')
+
+        self._idle.put(worker)
+        if status == 'error':
+            raise PoseWorkerError(payload)
+        return payload
+
+    def detect(self, image_rgb, timeout=None, wait_timeout=None, model_complexity=None):
+        """RGB画像の姿勢を推定し、正規化ランドマーク (x, y, visibility) のリストを返す"""
+        return self.run('detect', timeout=timeout, wait_timeout=wait_timeout, image=image_rgb,
+                        model_complexity=model_complexity)
+
+    def detect_batch(self, images_rgb, timeout=None, model_complexity=None):
+        """複数のRGB画像の姿勢をワーカー数まで並列に推定し、入力と同じ順のランドマークのリストを返す
+
+        1枚でも推定に失敗すれば、その例外を送出する。
+        """
+        if len(images_rgb) <= 1:
+            return [self.detect(image, timeout=timeout, model_complexity=model_complexity) for image in images_rgb]
+        with self._lock:
+            if self._batch_executor is None:
+                self._batch_executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix='pose-batch')
+            executor = self._batch_executor
+        futures = [
+            executor.submit(self.detect, image, timeout, None, model_complexity)
+            for image in images_rgb
+        ]
+        return [future.result() for future in futures]
+
+    def open_tracker(self, model_complexity=0):
+        """トラッキングモードの専用ワーカーを起動する（同時に max_trackers 個まで）
+
+        CPUのみの環境でも対話的な速度を保つため、既定では軽量モデル（model_complexity=0）を使う。
+        """
+        with self._lock:
+            if self._closed:
+                raise PoseWorkerError('ワーカープールは停止しています')
+            if len(self._trackers) >= self.max_trackers:
+                raise PoseTrackerLimitError(f'ライブセッションは同時に{self.max_trackers}件までです')
+            # 起動中の枠も確保しておく
+            placeholder = object()
+            self._trackers.add(placeholder)
+        try:
+            parent_conn, child_conn = self._ctx.Pipe()
+            options = dict(self.options, static_image_mode=False, model_complexity=model_complexity,
+                           model_complexities=[model_complexity])
+            process = self._ctx.Process(
+                target=_worker_main,
+                args=(child_conn, options),
+                name='pose-tracker',
+                daemon=True
+            )
+            process.start()
+            child_conn.close()
+            worker = _Worker(process, parent_conn)
+            try:
+                self._wait_ready(worker)
+            except Exception:
+                worker.kill()
+                raise
+            tracker = PoseTracker(self, worker)
+            with self._lock:
+                self._trackers.add(tracker)
+            return tracker
+        finally:
+            with self._lock:
+                self._trackers.discard(placeholder)
+
+    def _release_tracker(self, tracker):
+        with self._lock:
+            self._trackers.discard(tracker)
+
+    def status(self):
+        """ヘルスチェック用の状態"""
+        with self._lock:
+            alive = sum(1 for worker in self._workers if worker.process.is_alive())
+            trackers = len(self._trackers)
+        return {
+            'started': self.started,
+            'workers': self.size,
+            'alive': alive,
+            'idle': self._idle.qsize(),
+            'trackers': trackers,
+            'max_trackers': self.max_trackers,
+            'restarts': self.restarts,
+            'timeout': self.timeout,
+            'start_method': self.start_method,
+            'startup_seconds': self.startup_seconds
+        }
+
+    def shutdown(self):
+        """全ワーカーを停止する"""
+        self._closed = True
+        with self._lock:
+            workers = list(self._workers)
+            self._workers.clear()
+            trackers = [tracker for tracker in self._trackers if isinstance(tracker, PoseTracker)]
+            executor, self._batch_executor = self._batch_executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+        for tracker in trackers:
+            tracker.close()
+        for worker in workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.kill()
+        self.started = False
@@ -0,0 +1,300 @@
+"""基準姿勢ライブラリ（トップ選手のスタート姿勢）の類似検索
+
+9つの関節点を、重心を原点・重心からの二乗平均距離を1にそろえ、頭が右側になる向きにそろえ、
+左右の関節点を前足の側・後ろ足の側の順に並べた18次元のベクトルにする。
+写真の大きさ・位置・撮影した側と、左足前か右足前かによらず、姿勢の形だけを比べられる。
+基準姿勢はSQLite（WALモード）に保存し、検索時は全件を1つのfloat32配列に読み込んで距離を一括計算する。
+他のプロセスで追加・削除された基準姿勢は、変更番号を比べて次の検索時に読み込み直す。
+"""
+import os
+import json
+import math
+import time
+import secrets
+import sqlite3
+import threading
+from array import array
+
+from metric_engine import MetricEngine
+
+# ベクトルに含める関節点の順序（MEDIAPIPE_TO_FRONTEND の関節点）
+JOINTS = ('LShoulder', 'RShoulder', 'LHip', 'RHip', 'LKnee', 'RKnee', 'LAnkle', 'RAnkle', 'C7')
+DIMENSIONS = len(JOINTS) * 2
+
+# ベクトルの作り方の版（変えたら保存済みのベクトルを起動時に計算し直す）
+NORMALIZATION_VERSION = 2
+
+# 前足が右のときに入れ替える関節点（ベクトルでは L の位置に前足の側を並べる）
+MIRRORED_JOINTS = {
+    'LShoulder': 'RShoulder', 'RShoulder': 'LShoulder',
+    'LHip': 'RHip', 'RHip': 'LHip',
+    'LKnee': 'RKnee', 'RKnee': 'LKnee',
+    'LAnkle': 'RAnkle', 'RAnkle': 'LAnkle',
+    'C7': 'C7'
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS reference_poses (
+    id TEXT PRIMARY KEY,
+    label TEXT NOT NULL,
+    athlete TEXT,
+    analysis_type TEXT NOT NULL,
+    source TEXT,
+    keypoints TEXT NOT NULL,
+    vector BLOB NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reference_version (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO reference_version (id, version) VALUES (0, 0);
+CREATE TRIGGER IF NOT EXISTS reference_poses_inserted AFTER INSERT ON reference_poses BEGIN
+    UPDATE reference_version SET version = version + 1 WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS reference_poses_deleted AFTER DELETE ON reference_poses BEGIN
+    UPDATE reference_version SET version = version + 1 WHERE id = 0;
+END;
+"""
+
+_INSERT = (
+    "INSERT INTO reference_poses (id, label, athlete, analysis_type, source, keypoints, vector, created_at) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+_VERSION = "SELECT version FROM reference_version WHERE id = 0"
+_LOAD = "SELECT id, label, athlete, analysis_type, vector FROM reference_poses ORDER BY rowid"
+_SELECT_BY_ID = "SELECT * FROM reference_poses WHERE id = ?"
+_DELETE = "DELETE FROM reference_poses WHERE id = ?"
+_COUNT = "SELECT analysis_type, COUNT(*) AS total FROM reference_poses GROUP BY analysis_type"
+_LOAD_KEYPOINTS = "SELECT id, analysis_type, keypoints FROM reference_poses"
+_UPDATE_VECTOR = "UPDATE reference_poses SET vector = ? WHERE id = ?"
+_BUMP_VERSION = "UPDATE reference_version SET version = version + 1 WHERE id = 0"
+
+
+class InvalidPoseError(ValueError):
+    """関節点が足りないか、大きさのない姿勢"""
+
+
+def normalize_pose(keypoints, front_leg='left'):
+    """関節点（ピクセル座標）を位置・大きさ・向き・前足の側によらないベクトルにする
+
+    戻り値は (JOINTS の順の x, y を並べたリスト, 重心からの二乗平均距離（ピクセル）, 左右反転したか,
+    左右の関節点を入れ替えたか)。頭（C7）が腰より左にある姿勢は x を反転して右向きにそろえる。
+    front_leg='right'（右足が前）なら左右の関節点を入れ替え、L の位置に前足の側を並べる。
+    """
+    points = {}
+    for joint in JOINTS:
+        point = keypoints.get(joint) if isinstance(keypoints, dict) else None
+        if not isinstance(point, dict) or not all(
+                isinstance(point.get(axis), (int, float)) and math.isfinite(point[axis]) for axis in ('x', 'y')):
+            raise InvalidPoseError(f'関節点 {joint} の座標がありません')
+        points[joint] = (float(point['x']), float(point['y']))
+
+    cx = sum(x for x, _ in points.values()) / len(JOINTS)
+    cy = sum(y for _, y in points.values()) / len(JOINTS)
+    scale = math.sqrt(sum((x - cx) ** 2 + (y - cy) ** 2 for x, y in points.values()) / len(JOINTS))
+    if scale == 0:
+        raise InvalidPoseError('関節点がすべて同じ位置にあります')
+
+    mirrored = points['C7'][0] < (points['LHip'][0] + points['RHip'][0]) / 2
+    swapped = front_leg == 'right'
+    vector = []
+    for joint in JOINTS:
+        x, y = points[MIRRORED_JOINTS[joint] if swapped else joint]
+        dx = (x - cx) / scale
+        vector.extend((-dx if mirrored else dx, (y - cy) / scale))
+    return vector, scale, mirrored, swapped
+
+
+def joint_deltas(query_vector, reference_vector, scale, mirrored, swapped):
+    """基準姿勢に近づけるための関節点ごとの差（元画像の関節点名とピクセル単位を含む）
+
+    dx, dy, distance は体の大きさ（重心からの二乗平均距離）を1とした単位。
+    pixel_dx, pixel_dy は問い合わせた画像の座標で、関節点をその分動かすと基準姿勢に近づく。
+    """
+    deltas = {}
+    for index, joint in enumerate(JOINTS):
+        dx = float(reference_vector[index * 2]) - float(query_vector[index * 2])
+        dy = float(reference_vector[index * 2 + 1]) - float(query_vector[index * 2 + 1])
+        name = MIRRORED_JOINTS[joint] if swapped else joint
+        deltas[name] = {
+            'dx': round(dx, 4),
+            'dy': round(dy, 4),
+            'distance': round(math.hypot(dx, dy), 4),
+            'pixel_dx': round((-dx if mirrored else dx) * scale, 1),
+            'pixel_dy': round(dy * scale, 1)
+        }
+    return deltas
+
+
+class ReferenceIndex:
+    """基準姿勢のSQLiteストアと、全件を並べた検索用の配列"""
+
+    def __init__(self, db_path, engine=None):
+        self.db_path = db_path
+        self.engine = MetricEngine() if engine is None else engine
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._loaded = None  # (変更番号, NumPyで読み込んだか, 検索用データ)
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connect().executescript(_SCHEMA)
+        self._migrate()
+
+    def _connect(self):
+        # フォーク前に作った接続は子プロセスで使わない
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, cached_statements=64)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _normalize(self, keypoints, analysis_type, front_leg='auto'):
+        """分析モードの前足の判定方法で前足の側を決めて normalize_pose する"""
+        side = self.engine.front_side(keypoints, analysis_type or 'set', front_leg)
+        return normalize_pose(keypoints, side)
+
+    def _migrate(self):
+        """ベクトルの作り方が変わっていれば、保存済みの関節点からベクトルを計算し直す"""
+        conn = self._connect()
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= NORMALIZATION_VERSION:
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # 他のプロセスが先に計算し直していれば何もしない
+            if conn.execute('PRAGMA user_version').fetchone()[0] < NORMALIZATION_VERSION:
+                rows = conn.execute(_LOAD_KEYPOINTS).fetchall()
+                conn.executemany(_UPDATE_VECTOR, [
+                    (array('f', self._normalize(json.loads(row['keypoints']), row['analysis_type'])[0]).tobytes(), row['id'])
+                    for row in rows
+                ])
+                conn.execute(_BUMP_VERSION)
+                conn.execute(f'PRAGMA user_version = {NORMALIZATION_VERSION}')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _row(self, entry):
+        analysis_type = entry.get('analysis_type') or 'set'
+        vector = self._normalize(entry['keypoints'], analysis_type)[0]
+        return (
+            secrets.token_urlsafe(9), entry.get('label') or 'reference', entry.get('athlete'),
+            analysis_type, entry.get('source'),
+            json.dumps(entry['keypoints']), array('f', vector).tobytes(), time.time()
+        )
+
+    def add(self, keypoints, label, athlete=None, analysis_type='set', source=None):
+        """基準姿勢を追加してIDを返す（関節点が足りなければ InvalidPoseError）"""
+        row = self._row({'keypoints': keypoints, 'label': label, 'athlete': athlete,
+                         'analysis_type': analysis_type, 'source': source})
+        self._connect().execute(_INSERT, row)
+        return row[0]
+
+    def add_many(self, entries):
+        """基準姿勢（add と同じキーの辞書）をまとめて1トランザクションで追加し、IDのリストを返す"""
+        rows = [self._row(entry) for entry in entries]
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(_INSERT, rows)
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return [row[0] for row in rows]
+
+    def get(self, reference_id):
+        """IDで基準姿勢を取得する（無ければNone）"""
+        row = self._connect().execute(_SELECT_BY_ID, (reference_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'reference_id': row['id'],
+            'label': row['label'],
+            'athlete': row['athlete'],
+            'analysis_type': row['analysis_type'],
+            'source': row['source'],
+            'keypoints': json.loads(row['keypoints']),
+            'created_at': row['created_at']
+        }
+
+    def delete(self, reference_id):
+        """基準姿勢を削除する（削除したらTrue）"""
+        return self._connect().execute(_DELETE, (reference_id,)).rowcount > 0
+
+    def _data(self, np):
+        """検索用のデータ（変更があれば読み込み直す）"""
+        version = self._connect().execute(_VERSION).fetchone()[0]
+        loaded = self._loaded
+        if loaded is not None and loaded[0] == version and loaded[1] == (np is not None):
+            return loaded[2]
+        with self._lock:
+            loaded = self._loaded
+            if loaded is not None and loaded[0] == version and loaded[1] == (np is not None):
+                return loaded[2]
+            rows = self._connect().execute(_LOAD).fetchall()
+            entries = [(row['id'], row['label'], row['athlete'], row['analysis_type']) for row in rows]
+            blob = b''.join(row['vector'] for row in rows)
+            if np is not None:
+                vectors = np.frombuffer(blob, dtype=np.float32).reshape(len(rows), DIMENSIONS)
+                types = np.array([entry[3] for entry in entries])
+            else:
+                flat = array('f')
+                flat.frombytes(blob)
+                vectors = [flat[i * DIMENSIONS:(i + 1) * DIMENSIONS] for i in range(len(rows))]
+                types = [entry[3] for entry in entries]
+            data = {'entries': entries, 'vectors': vectors, 'types': types}
+            self._loaded = (version, np is not None, data)
+            return data
+
+    def count(self):
+        """種類（set / takeoff）ごとの基準姿勢の件数"""
+        rows = self._connect().execute(_COUNT).fetchall()
+        return {row['analysis_type']: row['total'] for row in rows}
+
+    def search(self, keypoints, k=5, analysis_type=None, np=None, front_leg='auto'):
+        """最も近い基準姿勢を k 件返す（距離は関節点あたりの二乗平均誤差、体の大きさを1とした単位）
+
+        np を渡すと全件との距離をNumPyで一括計算する（渡さなければ1件ずつ計算する）。
+        front_leg（'left' / 'right'）を渡すと、関節点の位置から判定せずにその側を前足とする。
+        """
+        query, scale, mirrored, swapped = self._normalize(keypoints, analysis_type, front_leg)
+        data = self._data(np)
+        entries = data['entries']
+        if not entries or k <= 0:
+            return []
+        if np is not None:
+            vectors = data['vectors']
+            diff = vectors - np.asarray(query, dtype=np.float32)
+            distances = np.sqrt(np.einsum('ij,ij->i', diff, diff) / len(JOINTS))
+            if analysis_type:
+                distances = np.where(data['types'] == analysis_type, distances, np.inf)
+            k = min(k, len(entries))
+            nearest = np.argpartition(distances, k - 1)[:k]
+            nearest = nearest[np.argsort(distances[nearest])]
+            candidates = [(float(distances[i]), int(i)) for i in nearest if np.isfinite(distances[i])]
+        else:
+            candidates = sorted(
+                (math.sqrt(sum((a - b) ** 2 for a, b in zip(vector, query)) / len(JOINTS)), i)
+                for i, vector in enumerate(data['vectors'])
+                if not analysis_type or data['types'][i] == analysis_type
+            )[:k]
+
+        matches = []
+        for distance, i in candidates:
+            reference_id, label, athlete, reference_type = entries[i]
+            matches.append({
+                'reference_id': reference_id,
+                'label': label,
+                'athlete': athlete,
+                'analysis_type': reference_type,
+                'distance': round(distance, 4),
+                'joint_deltas': joint_deltas(query, data['vectors'][i], scale, mirrored, swapped)
+            })
+        return matches
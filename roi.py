@@ -0,0 +1,119 @@
+"""関心領域（ROI）の切り出し
+
+トラック脇から撮った横長の画像では、選手は画面の一部にしか写っていない。
+前のフレーム（静止画では画像全体での1回目の推定）のランドマークから選手の周囲を切り出して推論すると、
+縮小・色変換・プロセス間転送する画素数が減り、選手に割り当てられる解像度も上がる。
+座標は正規化値（0〜1）で扱い、切り出した領域での推定結果は元画像全体の座標に戻す。
+"""
+import math
+
+MIN_VISIBILITY = 0.3   # 領域の計算に使うランドマークの可視度の下限
+DEFAULT_PADDING = 0.3  # ランドマークの範囲の大きさに対する余白の割合
+MIN_SIDE = 0.1         # 領域の最小の辺（画像の辺に対する割合）
+
+
+def landmark_box(landmarks, min_visibility=MIN_VISIBILITY):
+    """ランドマークを囲む矩形 (x0, y0, x1, y1)（可視のランドマークが3点未満ならNone）"""
+    points = [
+        (landmark[0], landmark[1]) for landmark in landmarks
+        if len(landmark) < 3 or landmark[2] >= min_visibility
+    ]
+    if len(points) < 3:
+        return None
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def padded_region(box, padding=DEFAULT_PADDING, min_side=MIN_SIDE):
+    """矩形を padding だけ広げて画像内に収めた領域"""
+    x0, y0, x1, y1 = box
+    half_width = max(x1 - x0, min_side) * (0.5 + padding)
+    half_height = max(y1 - y0, min_side) * (0.5 + padding)
+    cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+    return (max(0.0, cx - half_width), max(0.0, cy - half_height),
+            min(1.0, cx + half_width), min(1.0, cy + half_height))
+
+
+def region_area(region):
+    """領域の面積（画像全体に対する割合）"""
+    return (region[2] - region[0]) * (region[3] - region[1])
+
+
+def to_pixels(region, width, height):
+    """正規化した領域をピクセルの (left, top, right, bottom) にする（外側に丸める）"""
+    left = int(region[0] * width)
+    top = int(region[1] * height)
+    right = min(width, max(left + 1, int(math.ceil(region[2] * width))))
+    bottom = min(height, max(top + 1, int(math.ceil(region[3] * height))))
+    return left, top, right, bottom
+
+
+def to_full_frame(landmarks, pixel_box, width, height):
+    """切り出した領域内の正規化ランドマークを元画像全体の正規化座標に戻す"""
+    left, top, right, bottom = pixel_box
+    scale_x = (right - left) / width
+    scale_y = (bottom - top) / height
+    offset_x = left / width
+    offset_y = top / height
+    return [
+        (offset_x + landmark[0] * scale_x, offset_y + landmark[1] * scale_y, *landmark[2:])
+        for landmark in landmarks
+    ]
+
+
+def still_region(landmarks, padding=DEFAULT_PADDING, max_area=0.5):
+    """静止画で切り出して推定し直す領域（選手が十分大きく写っていればNone）"""
+    box = landmark_box(landmarks)
+    if box is None:
+        return None
+    region = padded_region(box, padding)
+    return region if region_area(region) <= max_area else None
+
+
+class RegionTracker:
+    """連続するフレームの切り出し領域を前のフレームのランドマークから決める
+
+    MediaPipeのトラッキングは前のフレームでの位置を手がかりにするため、
+    領域はランドマークが端に近づいたときと、選手に対して大きすぎるときだけ更新する。
+    姿勢を見失ったら次のフレームは画像全体で推定する。
+    """
+
+    def __init__(self, padding=DEFAULT_PADDING):
+        self.padding = padding
+        self.region = None
+        self.frame_size = None
+        self.frames = 0
+        self.area_total = 0.0
+
+    def pixel_box(self, width, height):
+        """次のフレームを切り出す領域（画像全体で推定する場合はNone）"""
+        self.frames += 1
+        self.frame_size = (width, height)
+        if self.region is None:
+            self.area_total += 1.0
+            return None
+        box = to_pixels(self.region, width, height)
+        self.area_total += (box[2] - box[0]) * (box[3] - box[1]) / (width * height)
+        return box
+
+    def update(self, landmarks):
+        """推定結果（元画像全体の正規化座標、見つからなければNone）で領域を更新する"""
+        box = landmarks and landmark_box(landmarks)
+        if not box:
+            self.region = None
+            return
+        if self.region is not None:
+            # ランドマークが端から余白の半分以上内側にあり、余白を2倍にした範囲より小さければ領域を動かさない
+            inner = padded_region(box, self.padding / 2)
+            outer = padded_region(box, self.padding * 2)
+            x0, y0, x1, y1 = self.region
+            if (x0 <= inner[0] and y0 <= inner[1] and x1 >= inner[2] and y1 >= inner[3]
+                    and region_area(self.region) <= region_area(outer)):
+                return
+        self.region = padded_region(box, self.padding)
+
+    @property
+    def mean_area(self):
+        """推定した画素の割合の平均（画像全体に対する）"""
+        return self.area_total / self.frames if self.frames else None
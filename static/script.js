@@ -132,7 +132,8 @@ function handleFileUpload(file) {
         
         if (data.success) {
             currentKeypoints = data.keypoints;
-            loadImageToCanvas(data.image_url, data.image_width, data.image_height);
+            // キャンバス表示には縮小済みのプレビューを使う（座標は元画像のサイズでスケール）
+            loadImageToCanvas(data.preview_url || data.image_url, data.image_width, data.image_height);
             createJointButtons();
             updateModeDisplay();
             document.getElementById('analyzeBtn').disabled = false;
@@ -0,0 +1,46 @@
+"""構造化ログの設定
+
+ログは1行1レコードのJSON（LOG_FORMAT=text で従来の可読形式）で標準エラー出力に書き出す。
+`logger.info('...', extra={'filename': ...})` のように渡した項目はそのままJSONのキーになる。
+出力レベルは LOG_LEVEL（既定: INFO）で切り替える。
+"""
+import json
+import time
+import logging
+
+# LogRecord が標準で持つ属性（extra で渡された項目と区別するため）
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """ログレコードを1行のJSONに変換する"""
+
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging(level='INFO', log_format='json'):
+    """ルートロガーにハンドラーを設定する（複数回呼んでも1つだけ）"""
+    root = logging.getLogger()
+    handler = next((h for h in root.handlers if getattr(h, '_structured', False)), None)
+    if handler is None:
+        handler = logging.StreamHandler()
+        handler._structured = True
+        root.addHandler(handler)
+    if log_format == 'text':
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s'))
+    else:
+        handler.setFormatter(JsonFormatter())
+    root.setLevel(getattr(logging, str(level).upper(), logging.INFO))
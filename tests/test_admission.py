@@ -0,0 +1,95 @@
+"""アドミッション制御と空きワーカーの確保のテスト（MediaPipe のワーカーは起動しない）"""
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import AdmissionController, DEFAULT_JOINTS_LEVEL
+from pose_pool import PosePool, PoseBusyError
+
+
+class _FakeProcess:
+    def is_alive(self):
+        return True
+
+
+class _FakeConn:
+    """送られたタスクにすぐ結果を返すパイプ"""
+
+    def send(self, message):
+        self.message = message
+
+    def poll(self, timeout):
+        return True
+
+    def recv(self):
+        return 'ok', [(0.5, 0.5, 0.9)]
+
+
+class _FakeWorker:
+    def __init__(self):
+        self.process = _FakeProcess()
+        self.conn = _FakeConn()
+
+
+def idle_pool(workers=1):
+    pool = PosePool(workers=workers, start_method='spawn')
+    pool.started = True
+    for _ in range(workers):
+        pool._idle.put(_FakeWorker())
+    return pool
+
+
+class AcquireTest(unittest.TestCase):
+
+    def test_idle_worker_used_without_wait_budget(self):
+        pool = idle_pool()
+        landmarks = pool.detect(object(), wait_timeout=0.0)
+        self.assertEqual(landmarks, [(0.5, 0.5, 0.9)])
+        # 推論後はワーカーが空きに戻る
+        self.assertEqual(pool._idle.qsize(), 1)
+
+    def test_busy_pool_times_out(self):
+        pool = idle_pool()
+        pool._idle.get_nowait()
+        with self.assertRaises(PoseBusyError):
+            pool.detect(object(), wait_timeout=0.0)
+
+
+class AdmissionTest(unittest.TestCase):
+
+    def test_saturated_estimate_with_idle_worker_still_infers(self):
+        controller = AdmissionController(workers=1, budget=3.0)
+        # 最初の遅い推論で見積もりがどのレベルでも予算を超える
+        controller.record(controller.levels[-1], 3.5)
+        with controller.admit() as ticket:
+            self.assertIs(ticket.level, controller.levels[-1])
+            self.assertFalse(ticket.queued)
+            self.assertEqual(ticket.wait_budget(), 0.0)
+            ticket.record(0.1)
+
+    def test_estimate_recovers_after_probes(self):
+        controller = AdmissionController(workers=1, budget=3.0)
+        controller.record(controller.levels[-1], 3.5)
+        pool = idle_pool()
+        for _ in range(20):
+            with controller.admit() as ticket:
+                self.assertIsNot(ticket.level, DEFAULT_JOINTS_LEVEL)
+                started = time.perf_counter()
+                pool.detect(object(), wait_timeout=ticket.wait_budget())
+                ticket.record(time.perf_counter() - started)
+        with controller.admit() as ticket:
+            self.assertIs(ticket.level, controller.levels[0])
+
+    def test_saturated_estimate_with_busy_workers_skips_inference(self):
+        controller = AdmissionController(workers=1, budget=3.0)
+        controller.record(controller.levels[-1], 3.5)
+        with controller.admit(adaptive=False):
+            with controller.admit() as ticket:
+                self.assertIs(ticket.level, DEFAULT_JOINTS_LEVEL)
+
+
+if __name__ == '__main__':
+    unittest.main()
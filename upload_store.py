@@ -0,0 +1,385 @@
+"""コンテンツアドレス方式のアップロード保存と姿勢推定結果キャッシュ
+
+アップロードは受信しながらSHA-256を計算し、`<ハッシュ先頭2文字>/<ハッシュ>.<拡張子>` として保存する。
+同じ画像は同じファイル名になるため、同時アップロードでの上書きが起きず、
+推定結果もハッシュをキーにキャッシュできる。
+保存したファイルはSQLiteの索引で管理し、期限切れや容量超過のファイルを最終アクセスの古い順に削除する。
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def shard_path(folder, filename):
+    """ファイル名の先頭2文字のサブディレクトリに置いたパス（1ディレクトリのファイル数を抑える）"""
+    return os.path.join(folder, filename[:2], filename)
+
+
+def save_stream(stream, folder, extension, buffer=None):
+    """ストリームを受信しながらハッシュを計算して保存する
+
+    buffer を渡すと受信したバイト列を同時に書き込む（再読み込みせずにデコードするため）。
+    戻り値は (ハッシュ, ファイル名, パス)。同じ内容のファイルがあっても置き換える
+    （同時に削除されても、保存後にファイルが必ず存在するように）。
+    """
+    digest = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.upload-', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                if buffer is not None:
+                    buffer.write(chunk)
+        content_hash = digest.hexdigest()
+        filename = f'{content_hash}.{extension.lower()}'
+        path = shard_path(folder, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        return content_hash, filename, path
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    filename TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_uploads_accessed ON uploads (accessed_at);
+CREATE TABLE IF NOT EXISTS upload_totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    files INTEGER NOT NULL,
+    bytes INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO upload_totals (id, files, bytes) VALUES (0, 0, 0);
+CREATE TRIGGER IF NOT EXISTS uploads_inserted AFTER INSERT ON uploads BEGIN
+    UPDATE upload_totals SET files = files + 1, bytes = bytes + NEW.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS uploads_deleted AFTER DELETE ON uploads BEGIN
+    UPDATE upload_totals SET files = files - 1, bytes = bytes - OLD.size WHERE id = 0;
+END;
+"""
+
+# 合計はトリガーで更新し、ヘルスチェックや削除判定でテーブル全体を集計しない
+_UPSERT = (
+    "INSERT INTO uploads (filename, size, created_at, accessed_at) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (filename) DO UPDATE SET accessed_at = excluded.accessed_at"
+)
+_TOUCH = "UPDATE uploads SET accessed_at = ? WHERE filename = ? AND accessed_at < ?"
+_EVICT = "DELETE FROM uploads WHERE filename = ? AND accessed_at = ?"
+_EXPIRED = "SELECT filename, accessed_at FROM uploads WHERE accessed_at < ? ORDER BY accessed_at LIMIT ?"
+_TOTALS = "SELECT files, bytes FROM upload_totals WHERE id = 0"
+_OLDEST = "SELECT MIN(accessed_at) FROM uploads"
+
+
+class UploadStore:
+    """アップロードの保存先と索引
+
+    ファイル一覧はSQLite（WALモード）の索引で管理し、ディレクトリを走査しない。
+    バックグラウンドのスイーパーが、最終アクセスから ttl 秒を過ぎたファイルと、
+    合計が max_bytes を超えた分のファイルを最終アクセスの古い順に削除する。
+    保存・アクセスから min_age 秒以内のファイルは容量超過でも削除しない（分析中・ジョブ待ちのため）。
+    on_sweep はスイーパーが削除のたびに呼ぶ関数（姿勢キャッシュなど他のディスクキャッシュの掃除用）。
+    """
+
+    def __init__(self, folder, index_path, max_bytes=0, ttl=0, min_age=300,
+                 sweep_interval=600, touch_interval=60, on_remove=None, on_sweep=None):
+        self.folder = folder
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.min_age = min_age
+        self.sweep_interval = sweep_interval
+        self.touch_interval = touch_interval
+        self.on_remove = on_remove
+        self.on_sweep = on_sweep
+        self._local = threading.local()
+        self._touched = {}
+        self._lock = threading.Lock()
+        self._sweeper_pid = None
+        os.makedirs(folder, exist_ok=True)
+        directory = os.path.dirname(index_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connect().executescript(_SCHEMA)
+
+    def _connect(self):
+        # フォーク前に作った接続は子プロセスで使わない
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def save(self, stream, extension, buffer=None):
+        """ストリームを保存して索引に登録する（戻り値は save_stream と同じ）"""
+        self._ensure_sweeper()
+        content_hash, filename, path = save_stream(stream, self.folder, extension, buffer=buffer)
+        now = time.time()
+        self._connect().execute(_UPSERT, (filename, os.path.getsize(path), now, now))
+        with self._lock:
+            self._touched[filename] = now
+        return content_hash, filename, path
+
+    def resolve(self, filename):
+        """ファイル名から保存先のパスを返す（無ければNone）
+
+        シャーディング前の直下に置かれたファイルは、参照されたときにサブディレクトリへ移して索引に登録する。
+        """
+        if os.path.basename(filename) != filename or filename.startswith('.'):
+            return None
+        path = shard_path(self.folder, filename)
+        if os.path.isfile(path):
+            return path
+        legacy = os.path.join(self.folder, filename)
+        if not os.path.isfile(legacy):
+            return None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(legacy, path)
+        except FileNotFoundError:
+            # 別のプロセスが先に移した
+            return path if os.path.isfile(path) else None
+        now = time.time()
+        self._connect().execute(_UPSERT, (filename, os.path.getsize(path), now, now))
+        return path
+
+    def touch(self, filename):
+        """最終アクセス時刻を更新する（プロセスごとに touch_interval 秒に1回まで書き込む）"""
+        self._ensure_sweeper()
+        now = time.time()
+        with self._lock:
+            if now - self._touched.get(filename, 0) < self.touch_interval:
+                return
+            if len(self._touched) > 10000:
+                self._touched.clear()
+            self._touched[filename] = now
+        self._connect().execute(_TOUCH, (now, filename, now - self.touch_interval))
+
+    def remove(self, filename):
+        """ファイルと索引のエントリを削除する"""
+        self._connect().execute("DELETE FROM uploads WHERE filename = ?", (filename,))
+        self._unlink(filename)
+
+    def _unlink(self, filename):
+        try:
+            os.remove(shard_path(self.folder, filename))
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self._touched.pop(filename, None)
+        if self.on_remove is not None:
+            try:
+                self.on_remove(filename)
+            except OSError:
+                logger.warning('Failed to remove upload derivatives', extra={'upload': filename})
+
+    def _evict(self, conn, filename, accessed_at):
+        # 選んだ後にアクセスされたファイルは削除しない
+        if conn.execute(_EVICT, (filename, accessed_at)).rowcount:
+            self._unlink(filename)
+            return True
+        return False
+
+    def sweep(self, now=None, batch_size=500):
+        """期限切れと容量超過のファイルを削除し、(削除数, 削除したバイト数) を返す"""
+        now = time.time() if now is None else now
+        conn = self._connect()
+        files_before, bytes_before = conn.execute(_TOTALS).fetchone()
+        if self.ttl:
+            while True:
+                expired = conn.execute(_EXPIRED, (now - self.ttl, batch_size)).fetchall()
+                removed = sum(self._evict(conn, filename, accessed_at) for filename, accessed_at in expired)
+                if len(expired) < batch_size or not removed:
+                    break
+        if self.max_bytes:
+            while conn.execute(_TOTALS).fetchone()[1] > self.max_bytes:
+                candidates = conn.execute(_EXPIRED, (now - self.min_age, batch_size)).fetchall()
+                if not candidates:
+                    break
+                for filename, accessed_at in candidates:
+                    self._evict(conn, filename, accessed_at)
+                    if conn.execute(_TOTALS).fetchone()[1] <= self.max_bytes:
+                        break
+        files_after, bytes_after = conn.execute(_TOTALS).fetchone()
+        removed_files, freed_bytes = files_before - files_after, bytes_before - bytes_after
+        if removed_files > 0:
+            logger.info('Evicted uploads', extra={'files': removed_files, 'bytes': freed_bytes})
+        return removed_files, freed_bytes
+
+    def _ensure_sweeper(self):
+        """プロセスで最初の保存・アクセス時にスイーパースレッドを開始する（フォーク後も開始し直す）"""
+        if not self.sweep_interval or not (self.ttl or self.max_bytes or self.on_sweep) or self._sweeper_pid == os.getpid():
+            return
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+
+        def run():
+            while True:
+                time.sleep(self.sweep_interval)
+                try:
+                    self.sweep()
+                except (sqlite3.Error, OSError):
+                    logger.exception('Upload sweep failed')
+                if self.on_sweep is not None:
+                    try:
+                        self.on_sweep()
+                    except OSError:
+                        logger.exception('Cache sweep failed')
+
+        threading.Thread(target=run, name='upload-sweeper', daemon=True).start()
+
+    def stats(self):
+        """ヘルスチェック用の統計（索引の集計値のみで、ディレクトリは走査しない）"""
+        conn = self._connect()
+        files, total_bytes = conn.execute(_TOTALS).fetchone()
+        oldest = conn.execute(_OLDEST).fetchone()[0]
+        return {
+            'files': files,
+            'bytes': total_bytes,
+            'max_bytes': self.max_bytes,
+            'ttl_seconds': self.ttl,
+            'oldest_access_age_seconds': round(time.time() - oldest) if oldest else None
+        }
+
+
+class PoseCache:
+    """姿勢推定結果の2層キャッシュ
+
+    1層目はプロセス内のLRU（件数上限つき）、2層目はディスク上のJSONファイル。
+    ディスク層は一時ファイルからのリネームで書き込むため、複数のgunicornワーカーから安全に共有できる。
+    ディスク層のエントリは元のアップロードの削除時に discard で消し、アップロード以外（一括分析）の
+    エントリも含めて、最後に読み書きしてから ttl 秒を過ぎたものは sweep で消す。
+    """
+
+    def __init__(self, directory, max_entries=1024, ttl=0):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.swept = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.json')
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, key):
+        """キャッシュされた値を返す（無ければNone）"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            # 最終利用時刻として更新時刻を使う（期限切れの判定用）
+            os.utime(path)
+        except OSError:
+            pass
+
+        self._remember(key, value)
+        with self._lock:
+            self.hits += 1
+            self.disk_hits += 1
+        return value
+
+    def put(self, key, value):
+        """値をメモリとディスクの両方に保存する"""
+        self._remember(key, value)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(value, f)
+            os.replace(temp_path, path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def discard(self, *keys):
+        """エントリをメモリとディスクから削除する"""
+        for key in keys:
+            with self._lock:
+                self._memory.pop(key, None)
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def sweep(self, now=None):
+        """ディスク層の期限切れのエントリと書き込み途中で残った一時ファイルを削除し、削除数を返す"""
+        if not self.ttl:
+            return 0
+        now = time.time() if now is None else now
+        removed = 0
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    if entry.stat().st_mtime < now - self.ttl:
+                        os.remove(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        with self._lock:
+            self.swept += removed
+        if removed:
+            logger.info('Evicted pose cache entries', extra={'entries': removed})
+        return removed
+
+    def stats(self):
+        """ヘルスチェック用の統計"""
+        with self._lock:
+            return {
+                'memory_entries': len(self._memory),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl,
+                'swept': self.swept,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses
+            }
@@ -0,0 +1,184 @@
+"""動画の逐次フレーム解析
+
+フレームはジェネレータで1枚ずつデコードするため、動画の長さに関係なくメモリ使用量は一定。
+姿勢推定はトラッキングモードのMediaPipeで行い（pose_pool.py の track_video タスク）、
+得られた関節点の時系列から「セット」と「飛び出し」のフレームを自動で検出する。
+"""
+import math
+
+VIDEO_EXTENSIONS = {'mp4', 'mov', 'm4v', 'avi', 'webm'}
+
+# 検出パラメータ（速度は 体長/秒）
+STILL_SPEED = 0.15      # これ未満なら静止とみなす
+ONSET_SPEED = 0.6       # これを超えたら動き出しとみなす
+SMOOTHING_SECONDS = 0.1  # 速度の移動平均の幅
+TAKEOFF_WINDOW_SECONDS = 0.6  # 動き出しから飛び出しを探す範囲
+
+
+def allowed_video(filename):
+    """許可された動画拡張子かチェック"""
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in VIDEO_EXTENSIONS
+
+
+def video_info(path):
+    """動画のfps・フレーム数・解像度を取得"""
+    import cv2
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError('動画を開けませんでした')
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+        return {
+            'fps': fps,
+            'frame_count': int(capture.get(cv2.CAP_PROP_FRAME_COUNT)),
+            'width': int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            'height': int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        }
+    finally:
+        capture.release()
+
+
+def iter_frames(path, stride=1, max_side=640, max_frames=None, region=None):
+    """フレームを (フレーム番号, 時刻[ms], RGB画像, 切り出し領域) として1枚ずつ返す
+
+    stride で間引いたフレームは grab() のみで読み飛ばし、色変換や縮小を行わない。
+    max_side を超える解像度のフレームは推論用に縮小する（座標は正規化値なので影響しない）。
+    region は (幅, 高さ) を受け取って切り出す領域 (left, top, right, bottom) を返す関数で、
+    領域を返したフレームは縮小・色変換の前に切り出す（Noneなら画像全体）。
+    """
+    import cv2
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError('動画を開けませんでした')
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+    stride = max(1, int(stride))
+    try:
+        index = 0
+        yielded = 0
+        while max_frames is None or yielded < max_frames:
+            if index % stride:
+                if not capture.grab():
+                    break
+                index += 1
+                continue
+            ok, frame = capture.read()
+            if not ok:
+                break
+            box = region(frame.shape[1], frame.shape[0]) if region else None
+            if box is not None:
+                left, top, right, bottom = box
+                frame = frame[top:bottom, left:right]
+            height, width = frame.shape[:2]
+            scale = max_side / max(height, width) if max_side else 1.0
+            if scale < 1.0:
+                frame = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+            yield index, round(index * 1000.0 / fps, 1), cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), box
+            yielded += 1
+            index += 1
+    finally:
+        capture.release()
+
+
+def _body_scale(keypoints):
+    """肩と足首の距離（体の大きさの目安）"""
+    best = 0.0
+    for shoulder, ankle in (('LShoulder', 'LAnkle'), ('RShoulder', 'RAnkle')):
+        if shoulder in keypoints and ankle in keypoints:
+            a, b = keypoints[shoulder], keypoints[ankle]
+            best = max(best, math.hypot(a['x'] - b['x'], a['y'] - b['y']))
+    return best
+
+
+def _joint_speeds(series, scale):
+    """隣接フレーム間の関節点の平均移動速度（体長/秒）"""
+    speeds = [None] * len(series)
+    previous = None
+    for i, entry in enumerate(series):
+        keypoints = entry.get('keypoints')
+        if not keypoints:
+            continue
+        if previous is not None:
+            prev_entry = series[previous]
+            dt = (entry['time'] - prev_entry['time']) / 1000.0
+            common = [name for name in keypoints if name in prev_entry['keypoints']]
+            if dt > 0 and common:
+                total = sum(
+                    math.hypot(keypoints[name]['x'] - prev_entry['keypoints'][name]['x'],
+                               keypoints[name]['y'] - prev_entry['keypoints'][name]['y'])
+                    for name in common
+                )
+                speeds[i] = total / len(common) / scale / dt
+        previous = i
+    return speeds
+
+
+def _smooth(values, window):
+    """None を無視した移動平均"""
+    half = max(0, window // 2)
+    smoothed = []
+    for i in range(len(values)):
+        chunk = [v for v in values[max(0, i - half):i + half + 1] if v is not None]
+        smoothed.append(sum(chunk) / len(chunk) if chunk else None)
+    return smoothed
+
+
+def detect_key_frames(series, fps):
+    """角度時系列からセットと飛び出しのフレームを検出する
+
+    series の各要素は {'frame', 'time', 'keypoints', 'takeoff': {...}} 形式。
+    セット: 動き出し直前の静止区間で最も動きの小さいフレーム
+    飛び出し: 動き出しから TAKEOFF_WINDOW_SECONDS 以内で、くの字角度（体の伸展）が最大のフレーム
+    戻り値は (セットの位置, 飛び出しの位置)。検出できなければ None。
+    """
+    scales = sorted(s for s in (_body_scale(e['keypoints']) for e in series if e.get('keypoints')) if s > 0)
+    if not scales:
+        return None, None
+    scale = scales[len(scales) // 2]
+
+    window = max(1, int(round(fps * SMOOTHING_SECONDS)))
+    speeds = _smooth(_joint_speeds(series, scale), window)
+
+    # 静止区間のあとに初めて速度が閾値を超えた位置を動き出しとする
+    onset = None
+    seen_still = False
+    for i, speed in enumerate(speeds):
+        if speed is None:
+            continue
+        if speed < STILL_SPEED:
+            seen_still = True
+        elif seen_still and speed > ONSET_SPEED:
+            onset = i
+            break
+
+    set_index = None
+    if onset is not None:
+        candidates = [i for i in range(onset) if speeds[i] is not None and speeds[i] < STILL_SPEED]
+        if candidates:
+            # 動き出しに最も近い静止区間の中で最も動きの小さいフレーム
+            last = candidates[-1]
+            block = [last]
+            for i in reversed(candidates[:-1]):
+                if block[-1] - i > window:
+                    break
+                block.append(i)
+            set_index = min(block, key=lambda i: (speeds[i], -i))
+    else:
+        still = [i for i, speed in enumerate(speeds) if speed is not None]
+        if still:
+            set_index = min(still, key=lambda i: speeds[i])
+
+    takeoff_index = None
+    if onset is not None:
+        end_time = series[onset]['time'] + TAKEOFF_WINDOW_SECONDS * 1000.0
+        best = None
+        for i in range(onset, len(series)):
+            if series[i]['time'] > end_time:
+                break
+            angles = series[i].get('takeoff') or {}
+            value = angles.get('kunoji_angle', angles.get('lower_angle'))
+            if value is not None and (best is None or value > best[0]):
+                best = (value, i)
+        if best is not None:
+            takeoff_index = best[1]
+
+    return set_index, takeoff_index